@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chat"
+
+    def ready(self):
+        # Registers the signal receivers keeping the presence of the connections in line with their rooms
+        from . import presence  # noqa: F401
+
+        if settings.CHAT_SERVER_TIMING:
+            from .timing import install
+
+            install()
@@ -0,0 +1,111 @@
+import logging
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+
+from chat.utils.image import crop_avatar_bytes, crop_avatar_img
+
+from .delivery import group_send_to_room, group_send_to_user
+from .image_jobs import image_jobs
+from .models import ChatRoom, Profile
+from .protocol import encode_payload
+from .timing import section
+from .versions import bump_room_versions
+
+logger = logging.getLogger(__name__)
+
+# Pending crop jobs are remembered for this long, after that the result of a job is discarded.
+AVATAR_JOB_TIMEOUT = 10 * 60
+
+
+@contextmanager
+def crop_avatar(instance: Profile | ChatRoom, image_file, filename, crop_data, request):
+    """
+    Crop the uploaded avatar of a profile or chat room, once the block saving the instance exits.
+
+    Without image workers the cropped avatar is saved right away. Otherwise a slot of the image pool is reserved
+    before the block runs, so `Throttled` is raised before anything is saved when the pool is full. The crop then runs
+    in the pool, the instance keeps its current avatar with `avatar_pending` set, and the avatar is replaced when the
+    crop finishes, followed by an `avatar_updated` event.
+    """
+    if not settings.CHAT_IMAGE_WORKERS:
+        yield
+        with section("image"):
+            instance.avatar_img = crop_avatar_img(image_file, filename, crop_data)
+            instance.save(update_fields=["avatar_img"])
+        return
+
+    with image_jobs.reserve() as submit:
+        yield
+
+        # Only the newest upload is applied if several are cropped concurrently
+        job_id = uuid.uuid4().hex
+        job_key = avatar_job_cache_key(instance)
+        cache.set(job_key, job_id, AVATAR_JOB_TIMEOUT)
+
+        image_file.seek(0)
+        submit(
+            crop_avatar_bytes,
+            image_file.read(),
+            crop_data,
+            on_done=lambda future: finish_avatar_crop(
+                future, type(instance), instance.pk, job_key, job_id, filename, request.build_absolute_uri("/")
+            ),
+        )
+    instance.avatar_pending = True
+
+
+def avatar_job_cache_key(instance: Profile | ChatRoom):
+    return f"chat:avatar-job:{instance._meta.model_name}:{instance.pk}"
+
+
+def finish_avatar_crop(future, model, pk, job_key, job_id, filename, base_url):
+    """
+    Store the cropped avatar and send the `avatar_updated` event. When the crop failed, the current avatar is kept and
+    the event is sent with an `error`, so the client doesn't wait for the new one.
+    """
+    try:
+        if cache.get(job_key) != job_id:
+            return
+
+        field = model._meta.get_field("avatar_img")
+        error = None
+        try:
+            content, extension = future.result()
+        except Exception:
+            logger.exception("Failed to crop the avatar of %s %s", model._meta.model_name, pk)
+            error = "The avatar couldn't be processed."
+            name = model.objects.values_list("avatar_img", flat=True).get(pk=pk)
+        else:
+            name = field.storage.save(field.generate_filename(None, f"{filename}.{extension}"), ContentFile(content))
+            model.objects.filter(pk=pk).update(avatar_img=name)
+        cache.delete(job_key)
+
+        payload = {"type": "avatar_updated", "avatar_img": urljoin(base_url, field.storage.url(name)) if name else None}
+        if error:
+            payload["error"] = error
+        if model is ChatRoom:
+            payload["room"] = pk
+            send, target = group_send_to_room, pk
+            if not error:
+                bump_room_versions(pk)
+        else:
+            payload["user"] = Profile.objects.values_list("user_id", flat=True).get(pk=pk)
+            send, target = group_send_to_user, payload["user"]
+            if not error:
+                # Saved with an update, which doesn't send the post_save signal invalidating the payload
+                Profile.invalidate_rendered(payload["user"])
+        event = {"type": "chat.avatar.updated", **encode_payload(payload)}
+        async_to_sync(send)(get_channel_layer(), target, event)
+    except Exception:
+        logger.exception("Failed to store the avatar of %s %s", model._meta.model_name, pk)
+    finally:
+        # This runs in a completion thread of the image jobs, outside of any request
+        close_old_connections()
@@ -0,0 +1,205 @@
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+
+from .models import Membership, Message, MessageMedia
+from .protocol import msgpack_array
+from .serializers import MessageSerializer, SendMessageSerializer, prefetch_user_payloads
+from .timing import detached_context
+
+
+class MessageBatcher:
+    """
+    Group-commits the messages sent over the WebSocket connections of this process.
+
+    Messages submitted within `window` seconds of each other (or until `max_size` of them are pending) are validated,
+    inserted with a single `bulk_create` and serialized together, in one transaction and one thread hop, so a busy
+    room doesn't pay for a transaction per message.
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def submit(self, user, data, context=None):
+        """
+        Persist a message sent by `user` and return its serialized representation, rendered with the serializer
+        `context`. Raises `ValidationError` if the message is invalid.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((user, data, context, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            # The batch holds the messages of several connections, its queries aren't timed as the sender's
+            task = asyncio.create_task(self.commit(batch), context=detached_context())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def commit(self, batch):
+        try:
+            results = await database_sync_to_async(create_messages)(
+                [(user, data, context) for user, data, context, _ in batch]
+            )
+        except Exception as exc:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                # The sender disconnected while waiting
+                continue
+            if isinstance(result, serializers.ValidationError):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def create_messages(submissions):
+    """
+    Validate and create the messages of a batch of `(user, data, context)` submissions, `context` being the serializer
+    context of the message or None.
+
+    Returns, in the same order, either the serialized message or the `ValidationError` that rejected it.
+    """
+    results = [None] * len(submissions)
+
+    valid = []
+    for index, (user, data, context) in enumerate(submissions):
+        serializer = SendMessageSerializer(data=data)
+        if serializer.is_valid():
+            valid.append((index, user, serializer.validated_data))
+        else:
+            results[index] = serializers.ValidationError(serializer.errors)
+
+    memberships = set(
+        Membership.objects.filter(
+            user_id__in={user.id for _, user, _ in valid}, room_id__in={data["room"] for *_, data in valid}
+        ).values_list("user_id", "room_id")
+    )
+    existing_reply_ids = set(
+        Message.objects.filter(id__in={data["reply_to_id"] for *_, data in valid if data["reply_to_id"]}).values_list(
+            "id", flat=True
+        )
+    )
+
+    pending = []
+    for index, user, data in valid:
+        if (user.id, data["room"]) not in memberships:
+            results[index] = serializers.ValidationError({"room": "You are not a member of this room."})
+        elif data["reply_to_id"] and data["reply_to_id"] not in existing_reply_ids:
+            results[index] = serializers.ValidationError({"reply_to_id": "Referenced message does not exist."})
+        else:
+            message = Message(room_id=data["room"], user=user, content=data["content"], reply_to_id=data["reply_to_id"])
+            pending.append((index, data["media_ids"], message))
+
+    if not pending:
+        return results
+
+    with transaction.atomic():
+        messages = Message.objects.bulk_create([message for *_, message in pending])
+
+        media_ids = [media_id for _, ids, _ in pending for media_id in ids]
+        unattached_media = MessageMedia.objects.filter(id__in=media_ids, message__isnull=True).in_bulk()
+        attached_media = []
+        for _, ids, message in pending:
+            for media_id in ids:
+                if media := unattached_media.pop(media_id, None):
+                    media.message = message
+                    attached_media.append(media)
+        MessageMedia.objects.bulk_update(attached_media, ["message"])
+
+        Message.record_created(messages, with_media={media.message_id for media in attached_media})
+
+    created = MessageSerializer.setup_eager_loading(Message.objects).in_bulk([message.pk for message in messages])
+    # The authors of the whole batch are looked up at once, the contexts of the submissions outlive it so they only get
+    # a copy of the payloads
+    user_payloads = {}
+    prefetch_user_payloads(user_payloads, MessageSerializer.rendered_users(created.values()))
+    for index, _, message in pending:
+        context = {**(submissions[index][2] or {}), **user_payloads}
+        results[index] = MessageSerializer(created[message.pk], context=context).data
+
+    return results
+
+
+class FrameBatcher:
+    """
+    Buffers the events sent to a WebSocket connection and sends them together as a single array frame, a JSON text
+    frame or a MessagePack binary frame if `binary` is set.
+
+    Events are sent `window` seconds after the first one buffered, or as soon as `max_size` of them are buffered, so a
+    burst of events costs the client (and the server) one frame instead of one per event. `send` is called with the
+    frame as `text_data` or `bytes_data`, and frames are sent in order.
+    """
+
+    def __init__(self, send, window, max_size, binary=False):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.binary = binary
+        self.pending = []
+        self.flush_handle = None
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+
+    async def add(self, data):
+        """Buffer an event, `data` being its encoded payload."""
+        self.pending.append(data)
+
+        if len(self.pending) >= self.max_size:
+            await self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.schedule_flush)
+
+    def schedule_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            # The lock is acquired in order, so a frame never overtakes the one flushed before it
+            async with self.lock:
+                if self.binary:
+                    await self.send(bytes_data=msgpack_array(batch))
+                else:
+                    await self.send(text_data=f"[{','.join(batch)}]")
+
+    def close(self):
+        """Drop the buffered events, the connection is gone."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.pending = []
+        for task in self.tasks:
+            task.cancel()
+
+
+message_batcher = MessageBatcher(settings.CHAT_MESSAGE_BATCH_WINDOW, settings.CHAT_MESSAGE_BATCH_SIZE)
@@ -1,192 +1,308 @@
-import json
 from typing import override
+from urllib.parse import parse_qs, urljoin
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.consumer import get_handler_name
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import DateTimeField
 
-from chat.serializers import MessageSerializer, UserSerializer
+from chat.serializers import MessageSerializer, UserSerializer, aprefetch_user_payloads
 
+from .batching import FrameBatcher, message_batcher
+from .delivery import group_send_to_room, room_group_name, user_group_name
 from .models import ChatRoom, Message
+from .presence import presence
+from .protocol import MSGPACK_SUBPROTOCOL, decode_frame, encode_payload, event_payload
+from .timing import measure
+from .typing_status import TypingTracker
+
+
+class ScopeRequest:
+    """
+    Stands in for the HTTP request in the serializer context of a WebSocket connection, so file URLs are rendered as
+    absolute URLs just like in the REST API responses.
+    """
+
+    def __init__(self, scope):
+        headers = dict(scope.get("headers", ()))
+        host = headers.get(b"host", b"").decode()
+        if not host and scope.get("server"):
+            host = "{}:{}".format(*scope["server"])
+        scheme = "https" if scope.get("scheme") == "wss" else "http"
+        self.base_url = f"{scheme}://{host}/"
+
+    def build_absolute_uri(self, location):
+        return urljoin(self.base_url, location)
 
 
 class UserChatConsumer(AsyncWebsocketConsumer):
+    # Group events whose handlers only forward the payload to the client, see `dispatch`
+    forwarded_events = frozenset(
+        {
+            "chat.user.left",
+            "chat.typing",
+            "chat.presence",
+            "chat.message",
+            "chat.edit.message",
+            "chat.delete.message",
+            "chat.add.message.reaction",
+            "chat.delete.message.reaction",
+            "chat.avatar.updated",
+        }
+    )
+
     @override
     async def connect(self):
         self.user = self.scope["user"]
+        self.room_ids = []
+        self.serializer_context = {"request": ScopeRequest(self.scope)}
+        self.typing = TypingTracker(self.user)
+        # Clients offering the MessagePack subprotocol exchange binary frames, the others JSON text frames
+        self.binary = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", ())
+        # Clients connecting with `?batch=1` receive the events in array frames, see `FrameBatcher`
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.frames = None
+        if query.get("batch") == ["1"]:
+            self.frames = FrameBatcher(
+                self.send, settings.CHAT_WS_BATCH_WINDOW, settings.CHAT_WS_BATCH_SIZE, binary=self.binary
+            )
 
         if not self.user.is_authenticated:
             await self.close()
             return
 
-        await self.accept()
+        await self.accept(MSGPACK_SUBPROTOCOL if self.binary else None)
 
-        chat_rooms = await self.get_user_chat_rooms(self.user)
+        # The per-user group is the only subscription in the "user" delivery mode, and is also used for events
+        # addressed to a single user.
+        await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
 
-        for room in chat_rooms:
-            await self.channel_layer.group_add(f"chat_{room.id}", self.channel_name)
+        self.room_ids = await self.get_user_chat_room_ids(self.user)
+        if settings.CHAT_DELIVERY_MODE != "user":
+            for room_id in self.room_ids:
+                await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+
+        await presence.connect(self.channel_name, self.user.id, self.room_ids)
 
     @override
     async def disconnect(self, code):
-        chat_rooms = await self.get_user_chat_rooms(self.user)
-        for room in chat_rooms:
-            await self.channel_layer.group_discard(f"chat_{room.id}", self.channel_name)
+        if self.frames is not None:
+            self.frames.close()
+        if not self.user.is_authenticated:
+            return
+
+        await self.typing.stop_all()
+        await presence.disconnect(self.channel_name)
+        await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
+        if settings.CHAT_DELIVERY_MODE != "user":
+            for room_id in self.room_ids:
+                await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+
+    @override
+    async def dispatch(self, message):
+        # Channels closes stale database connections before running any handler, which is a thread pool hop for every
+        # event delivered to every connection. The forwarding handlers never touch the database, so they skip it and
+        # only the other events pay for it.
+        if message["type"] in self.forwarded_events:
+            await getattr(self, get_handler_name(message))(message)
+            return
+        await super().dispatch(message)
 
     @override
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
+        data = decode_frame(text_data, bytes_data)
         msg_type = data["type"]
 
         if not self.user.is_authenticated:
             return
 
-        match msg_type:
-            case "start_typing":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}",
-                    {"type": "chat.typing", "user": self.user.username, "room": data["room"], "is_typing": True},
-                )
-            case "stop_typing":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}",
-                    {"type": "chat.typing", "user": self.user.username, "room": data["room"], "is_typing": False},
-                )
-            case "send_message":
-                room = data["message"]["room"]
-                await self.channel_layer.group_send(
-                    f"chat_{room}",
-                    {
-                        "type": "chat.message",  # call the `chat_message` method
-                        "message": text_data,
-                    },
-                )
-            case "delete_message":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}",
-                    {
-                        "type": "chat.delete.message",  # call the `chat_delete_message` method
-                        "message_id": data["message_id"],
-                        "room": data["room"],
-                    },
-                )
-            case "edit_message":
-                await self.channel_layer.group_send(
-                    f"chat_{data["message"]["room"]}", {"type": "chat.edit.message", "updated_message": text_data}
-                )
-            case "add_message_reaction":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}", {"type": "chat.add.message.reaction", "reaction": text_data}
-                )
-            case "delete_message_reaction":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}",
-                    {
-                        "type": "chat.delete.message.reaction",
-                        "message_id": data["message_id"],
-                        "room": data["room"],
+        with measure(f"websocket event {msg_type}"):
+            match msg_type:
+                case "start_typing":
+                    await self.typing.start(int(data["room"]))
+                case "stop_typing":
+                    await self.typing.stop(int(data["room"]))
+                case "send_message":
+                    await self.send_message(data)
+                case "delete_message":
+                    payload = await self.get_delete_message_payload(data["message_id"], data["room"])
+                    await self.group_send_to_room(
+                        data["room"],
+                        {
+                            "type": "chat.delete.message",  # call the `chat_delete_message` method
+                            **encode_payload(payload),
+                        },
+                    )
+                case "edit_message":
+                    await self.group_send_to_room(
+                        data["message"]["room"],
+                        {"type": "chat.edit.message", **encode_payload(data, text_data, bytes_data)},
+                    )
+                case "add_message_reaction":
+                    await self.group_send_to_room(
+                        data["room"],
+                        {"type": "chat.add.message.reaction", **encode_payload(data, text_data, bytes_data)},
+                    )
+                case "delete_message_reaction":
+                    message = await self.get_message(data["message_id"], data["room"])
+                    payload = {
+                        "type": "delete_message_reaction",
+                        "message": message,
                         "reaction_id": data["reaction_id"],
-                    },
-                )
-            case "user_left":
-                await self.channel_layer.group_send(
-                    f"chat_{data["room"]}",
-                    {
-                        "type": "chat.user.left",
+                    }
+                    await self.group_send_to_room(
+                        data["room"],
+                        {"type": "chat.delete.message.reaction", **encode_payload(payload)},
+                    )
+                case "user_left":
+                    payload = {
+                        "type": "user_left",
                         "room": data["room"],
                         "user": data["user"],
                         "new_owner": data["new_owner"],
-                    },
-                )
-            case t:
-                raise Exception(f"Message type not handled: {t}")
+                    }
+                    await self.group_send_to_room(data["room"], {"type": "chat.user.left", **encode_payload(payload)})
+                case t:
+                    raise Exception(f"Message type not handled: {t}")
 
-    async def chat_user_left(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_left",
-                    "room": event["room"],
-                    "user": event["user"],
-                    "new_owner": event["new_owner"],
-                }
-            )
+    async def send_message(self, data):
+        """
+        Persist a message and broadcast its canonical representation to the room.
+
+        Messages that were already created through the REST API (older clients announce them here with their `id`)
+        are only loaded and checked before being broadcast.
+        """
+        message_data = data["message"]
+        try:
+            if "id" in message_data:
+                message = await self.get_own_message(message_data["id"])
+            else:
+                message = await message_batcher.submit(self.user, message_data, self.serializer_context)
+        except ValidationError as exc:
+            error = {"type": "error", "event": "send_message", "detail": exc.detail}
+            if "client_id" in data:
+                error["client_id"] = data["client_id"]
+            await self.send_event(encode_payload(error))
+            return
+
+        payload = {"type": "send_message", "message": message}
+        if "client_id" in data:
+            # Lets the sender match the broadcast with its optimistic copy of the message
+            payload["client_id"] = data["client_id"]
+
+        await self.group_send_to_room(
+            message["room"],
+            {
+                "type": "chat.message",  # call the `chat_message` method
+                **encode_payload(payload),
+            },
         )
 
+    async def group_send_to_room(self, room_id, event):
+        await group_send_to_room(self.channel_layer, room_id, event)
+
+    async def send_event(self, event):
+        """Send an event to the client, in the format of the connection, see `encode_payload`."""
+        data = event_payload(event, self.binary)
+        if self.frames is not None:
+            await self.frames.add(data)
+        elif self.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    # Group event handlers run once per connected recipient, so they only forward the payload that was computed
+    # once by the sender in `receive`, and never touch the database. New ones are listed in `forwarded_events`.
+
+    async def chat_user_left(self, event):
+        await self.send_event(event)
+
     async def chat_typing(self, event):
-        if self.user.username != event["user"]:
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "typing_status",
-                        "user": event["user"],
-                        "room": event["room"],
-                        "is_typing": event["is_typing"],
-                    }
-                )
-            )
+        await self.send_event(event)
+
+    async def chat_presence(self, event):
+        await self.send_event(event)
 
     async def chat_message(self, event):
-        await self.send(text_data=event["message"])
+        await self.send_event(event)
 
     async def chat_edit_message(self, event):
-        await self.send(text_data=event["updated_message"])
+        await self.send_event(event)
 
     async def chat_delete_message(self, event):
-        response_data = {
+        await self.send_event(event)
+
+    async def chat_add_message_reaction(self, event):
+        await self.send_event(event)
+
+    async def chat_delete_message_reaction(self, event):
+        await self.send_event(event)
+
+    async def chat_avatar_updated(self, event):
+        await self.send_event(event)
+
+    async def chat_rooms_changed(self, event):
+        """The user joined or left rooms since connecting, the connection follows them."""
+        joined = [room_id for room_id in event["joined"] if room_id not in self.room_ids]
+        left = [room_id for room_id in event["left"] if room_id in self.room_ids]
+        self.room_ids = [room_id for room_id in self.room_ids if room_id not in left] + joined
+        if settings.CHAT_DELIVERY_MODE != "user":
+            for room_id in joined:
+                await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+            for room_id in left:
+                await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        await presence.update_rooms(self.channel_name, joined, left)
+
+    async def get_delete_message_payload(self, message_id, room_id):
+        message_id = int(message_id)
+        payload = {
             "type": "delete_message",
-            "message_id": event["message_id"],
-            "room": event["room"],
+            "message_id": message_id,
+            "room": room_id,
         }
 
-        is_last_message = await self.is_last_message_in_room(event["message_id"], event["room"])
-        if is_last_message:
-            last_msg = await self.get_prev_message_of_id(event["message_id"], event["room"])
-            if last_msg:
-                response_data["last_message"] = {
-                    "username": last_msg["user"]["username"],
-                    "content": last_msg["content"],
-                    "timestamp": last_msg["timestamp"],
-                    "room": last_msg["room"],
-                }
-
-        await self.send(text_data=json.dumps(response_data))
+        room = await self.get_room_summary(room_id)
+        # The message was already deleted through the API, which moved the room's last message summary back to the
+        # previous message. Since ids grow with time, the deleted message was the last one if it is newer than that.
+        if room and room.last_message_id and message_id > room.last_message_id:
+            payload["last_message"] = {
+                "username": room.last_message_user.username if room.last_message_user else None,
+                "content": room.last_message_preview,
+                "timestamp": DateTimeField().to_representation(room.last_message_timestamp),
+                "room": room.id,
+            }
 
-    async def chat_add_message_reaction(self, event):
-        await self.send(text_data=event["reaction"])
+        return payload
 
-    async def chat_delete_message_reaction(self, event):
-        message = await self.get_message(event["message_id"], event["room"])
-        await self.send(
-            text_data=json.dumps(
-                {"type": "delete_message_reaction", "message": message, "reaction_id": event["reaction_id"]}
-            )
-        )
+    # The data access below runs on the async ORM, so each lookup is a single query per event and the serialization
+    # of the eagerly loaded rows happens on the event loop.
 
-    @database_sync_to_async
-    def get_message(self, message_id, room_id):
+    async def get_message(self, message_id, room_id):
         try:
-            message = Message.objects.get(id=message_id)
-            return MessageSerializer(message).data
+            message = await MessageSerializer.setup_eager_loading(Message.objects).aget(id=message_id)
         except Message.DoesNotExist:
             raise Exception(f"Message with {message_id=} not found in {room_id}")
+        return await self.serialize_message(message)
 
-    @database_sync_to_async
-    def is_last_message_in_room(self, message_id, room):
-        try:
-            msg = Message.objects.get(id=message_id)
-            last_message = Message.objects.filter(room=room).order_by("-timestamp").first()
-            return last_message and msg.id == last_message.id
-        except Message.DoesNotExist:
-            return False
+    async def get_own_message(self, message_id):
+        message = (
+            await MessageSerializer.setup_eager_loading(Message.objects)
+            .filter(id=message_id, user=self.user, room__members=self.user)
+            .afirst()
+        )
+        if message is None:
+            raise ValidationError({"id": f"Message with {message_id=} not found."})
+        return await self.serialize_message(message)
 
-    @database_sync_to_async
-    def get_prev_message_of_id(self, message_id, room):
-        try:
-            msg = Message.objects.get(id=message_id)
-            prev_message = Message.objects.filter(room=room, timestamp__lt=msg.timestamp).order_by("-timestamp").first()
-            return MessageSerializer(prev_message).data if prev_message else None
-        except Message.DoesNotExist:
-            raise Exception(f"Message with {message_id=} not found in {room}")
+    async def serialize_message(self, message):
+        # The prefetched user payloads are only valid for this message, not for the lifetime of the connection
+        context = dict(self.serializer_context)
+        await aprefetch_user_payloads(context, MessageSerializer.rendered_users([message]))
+        return MessageSerializer(message, context=context).data
+
+    async def get_room_summary(self, room_id):
+        return await ChatRoom.objects.select_related("last_message_user").filter(id=room_id).afirst()
 
-    @database_sync_to_async
-    def get_user_chat_rooms(self, user):
-        return list(ChatRoom.objects.filter(members=user))
+    async def get_user_chat_room_ids(self, user):
+        return [room_id async for room_id in ChatRoom.objects.filter(members=user).values_list("id", flat=True)]
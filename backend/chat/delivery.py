@@ -0,0 +1,105 @@
+import asyncio
+import collections
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+
+from .models import Membership
+
+# Same as the script `RedisChannelLayer.group_send` runs for the channels of a group: add the message to every channel
+# that isn't over capacity, and return how many were
+GROUP_SEND_SCRIPT = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i = 1, #KEYS do
+    if redis.call("ZCOUNT", KEYS[i], "-inf", "+inf") < tonumber(ARGV[i + #KEYS]) then
+        redis.call("ZADD", KEYS[i], current_time, ARGV[i])
+        redis.call("EXPIRE", KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+def room_group_name(room_id):
+    return f"chat_{room_id}"
+
+
+def user_group_name(user_id):
+    return f"user_{user_id}"
+
+
+async def group_send_to_room(channel_layer, room_id, event):
+    """
+    Deliver a channel layer event to every connection of the room members.
+
+    In the "room" delivery mode the connections are subscribed to the room group, so this is a single `group_send`.
+    In the "user" mode the event is routed to the per-user groups of all the members of the room at once, see
+    `group_send_many`.
+    """
+    if settings.CHAT_DELIVERY_MODE != "user":
+        await channel_layer.group_send(room_group_name(room_id), event)
+        return
+
+    member_ids = await Membership.aget_member_ids(int(room_id))
+    await group_send_many(channel_layer, [user_group_name(user_id) for user_id in member_ids], event)
+
+
+async def group_send_to_user(channel_layer, user_id, event):
+    """Deliver a channel layer event to every connection of a user."""
+    await channel_layer.group_send(user_group_name(user_id), event)
+
+
+async def group_send_many(channel_layer, groups, event):
+    """
+    Deliver a channel layer event to every connection of several groups.
+
+    `RedisChannelLayer.group_send` costs four round trips per group, so sending to the group of each member of a big
+    room one by one would cost thousands of them. With the Redis channel layer, the channels of all the groups are
+    looked up in a single pipeline and the event is added to all of them by a single script, per Redis shard. The
+    other channel layers get one `group_send` per group.
+    """
+    if not isinstance(channel_layer, RedisChannelLayer):
+        await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
+        return
+
+    groups_by_connection = collections.defaultdict(list)
+    for group in groups:
+        groups_by_connection[channel_layer.consistent_hash(group)].append(channel_layer._group_key(group))
+
+    channel_names = set()
+    for index, group_keys in groups_by_connection.items():
+        async with channel_layer.connection(index).pipeline(transaction=False) as pipe:
+            for key in group_keys:
+                # Forget the channels that left without discarding themselves, as `group_send` does
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - channel_layer.group_expiry)
+                pipe.zrange(key, 0, -1)
+            results = await pipe.execute()
+        channel_names.update(name.decode() for members in results[1::2] for name in members)
+
+    if not channel_names:
+        return
+
+    channel_keys_by_connection, messages, capacities = channel_layer._map_channel_keys_to_connection(
+        list(channel_names), event
+    )
+    for index, channel_keys in channel_keys_by_connection.items():
+        connection = channel_layer.connection(index)
+        async with connection.pipeline(transaction=False) as pipe:
+            for key in channel_keys:
+                # Drop the expired messages, as `group_send` does
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - int(channel_layer.expiry))
+            await pipe.execute()
+        await connection.register_script(GROUP_SEND_SCRIPT)(
+            keys=channel_keys,
+            args=[
+                *(messages[key] for key in channel_keys),
+                *(capacities[key] for key in channel_keys),
+                time.time(),
+                channel_layer.expiry,
+            ],
+        )
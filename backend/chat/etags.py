@@ -0,0 +1,67 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import ChatRoom, Membership
+from .versions import ROOMS_VERSION_KEY, get_versions, room_version_key, user_rooms_version_key
+
+
+def make_etag(request, *versions):
+    """ETag of the response to `request`, from the versions of everything the response renders."""
+    parts = [request.get_host(), request.get_full_path(), request.accepted_renderer.format, request.user.id, *versions]
+    return quote_etag(hashlib.sha1(repr(parts).encode()).hexdigest())
+
+
+def visible_room_ids(user, epoch, rooms_version, user_rooms_version):
+    """Ids of the rooms listed to `user`, cached until a room or the rooms of the user change."""
+    key = f"chat:visible-rooms:{user.id}:{epoch}:{rooms_version}:{user_rooms_version}"
+    room_ids = cache.get(key)
+    if room_ids is None:
+        is_member = Exists(Membership.objects.filter(room=OuterRef("pk"), user=user))
+        room_ids = list(
+            ChatRoom.objects.filter(Q(is_private=False) | is_member).order_by("pk").values_list("pk", flat=True)
+        )
+        cache.set(key, room_ids, settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+    return room_ids
+
+
+def room_list_etag(request):
+    """ETag of the room list of the user, computed from the version counters without querying the rooms."""
+    epoch, rooms_version, user_rooms_version = get_versions(
+        [ROOMS_VERSION_KEY, user_rooms_version_key(request.user.id)]
+    )
+    room_ids = visible_room_ids(request.user, epoch, rooms_version, user_rooms_version)
+    room_versions = get_versions([room_version_key(room_id) for room_id in room_ids])
+    return make_etag(request, rooms_version, user_rooms_version, room_ids, room_versions)
+
+
+def message_list_etag(request, room_id):
+    """ETag of a page of the message history of a room."""
+    return make_etag(request, *get_versions([room_version_key(room_id)]))
+
+
+def conditional_response(request, etag, get_response):
+    """
+    Answer `304 Not Modified` without building the response when the client already has the representation tagged
+    `etag`, otherwise tag the response of `get_response` with it. The clients are asked to revalidate the response
+    every time they use it.
+    """
+    client_etags = {
+        client_etag.removeprefix("W/") for client_etag in parse_etags(request.headers.get("If-None-Match", ""))
+    }
+    if etag in client_etags or "*" in client_etags:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = get_response()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -0,0 +1,79 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+
+class ImageJobPool:
+    """
+    Runs CPU bound image processing in worker processes, so large images don't hold the request workers.
+
+    At most `queue_size` jobs can be queued or running at once in each server process, submitting more raises
+    `Throttled`. The processes are only started on the first submitted job.
+
+    The results are handled by a few threads of their own: the done callbacks of the process pool run on the thread
+    collecting the results of every job, which a slow storage or Redis would hold up.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.slots = BoundedSemaphore(queue_size)
+        self.executor = None
+        self.lock = Lock()
+        self.completions = ThreadPoolExecutor(workers or 1, thread_name_prefix="image-jobs")
+
+    def get_executor(self, broken=None):
+        with self.lock:
+            if self.executor is None or self.executor is broken:
+                # Forking a process that is running threads (the ASGI server, database connections) isn't safe
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+            return self.executor
+
+    def submit(self, fn, *args, on_done):
+        """Run `fn(*args)` in a worker process, and call `on_done(future)` from a completion thread when it finishes."""
+        with self.reserve() as submit:
+            return submit(fn, *args, on_done=on_done)
+
+    @contextmanager
+    def reserve(self):
+        """
+        Reserve the slot of a job, raising `Throttled` when the pool is full, so a request can check the capacity
+        before changing anything. Yields the function submitting the job, like `submit`, which is called in the block.
+        The slot is released if the block exits without submitting the job.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise Throttled(detail="Too many images are being processed, try again later.")
+
+        futures = []
+
+        def submit(fn, *args, on_done):
+            executor = self.get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OOM killer), start a new pool
+                future = self.get_executor(broken=executor).submit(fn, *args)
+            futures.append(future)
+
+            def complete(future):
+                try:
+                    on_done(future)
+                finally:
+                    self.slots.release()
+
+            # The slot is held until `on_done` returns, so the completions can't pile up either
+            future.add_done_callback(lambda future: self.completions.submit(complete, future))
+            return future
+
+        try:
+            yield submit
+        finally:
+            if not futures:
+                self.slots.release()
+
+
+image_jobs = ImageJobPool(settings.CHAT_IMAGE_WORKERS, settings.CHAT_IMAGE_QUEUE_SIZE)
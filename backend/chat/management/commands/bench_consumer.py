@@ -0,0 +1,136 @@
+import asyncio
+import json
+import time
+import uuid
+
+from asgiref.sync import SyncToAsync
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.consumers import UserChatConsumer
+from chat.models import ChatRoom, Membership, Message, MessageReaction
+
+EVENT_TYPES = ("delete_message_reaction", "delete_message", "add_message_reaction")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure how many WebSocket events per second a single worker broadcasts through UserChatConsumer. "
+        "Creates a temporary room with its members, and removes it when done."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=20, help="Number of connected room members.")
+        parser.add_argument("--events", type=int, default=500, help="Number of events sent by one of the members.")
+        parser.add_argument("--event", choices=EVENT_TYPES, default="delete_message_reaction")
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=10,
+            help="Number of events in flight at once, sent from as many connections of the sender.",
+        )
+        parser.add_argument(
+            "--configured-layer",
+            action="store_true",
+            help="Use the configured channel layer instead of an in-memory one, to include its overhead.",
+        )
+        parser.add_argument(
+            "--batch", action="store_true", help="Connect the receivers with `?batch=1`, to get the events in batches."
+        )
+
+    def handle(self, *args, connections, events, event, concurrency, configured_layer, batch, **options):
+        if not configured_layer:
+            channel_layers.set("default", InMemoryChannelLayer(capacity=max(100, events)))
+
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        users = User.objects.bulk_create([User(username=f"{prefix}-{i}") for i in range(connections)])
+        room = ChatRoom.objects.create(name=prefix, owner=users[0])
+        try:
+            Membership.objects.bulk_create([Membership(user=user, room=room) for user in users])
+            message = Message.objects.create(room=room, user=users[0], content="benchmark")
+            reaction = MessageReaction.objects.create(message=message, user=users[0], emoji="👍")
+
+            payloads = {
+                "delete_message_reaction": {
+                    "type": "delete_message_reaction",
+                    "room": room.id,
+                    "message_id": message.id,
+                    "reaction_id": reaction.id,
+                },
+                "delete_message": {"type": "delete_message", "room": room.id, "message_id": message.id},
+                "add_message_reaction": {
+                    "type": "add_message_reaction",
+                    "room": room.id,
+                    "reaction": {"id": reaction.id, "message": message.id, "emoji": "👍"},
+                },
+            }
+            elapsed, cpu, hops, frames = asyncio.run(self.run(users, payloads[event], events, concurrency, batch))
+        finally:
+            room.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.stdout.write(f"event: {event}")
+        self.stdout.write(f"connections: {connections}")
+        self.stdout.write(f"events: {events} in {elapsed:.3f}s")
+        self.stdout.write(f"thread hops per event: {hops / events:.2f}")
+        self.stdout.write(f"frames per receiver: {frames / (connections - 1):.0f}")
+        self.stdout.write(f"CPU time per event: {cpu / events * 1000:.3f}ms")
+        self.stdout.write(f"deliveries per second: {events * (connections - 1) / elapsed:.0f}")
+        self.stdout.write(self.style.SUCCESS(f"events per second: {events / elapsed:.0f}"))
+
+    async def run(self, users, payload, events, concurrency, batch):
+        application = UserChatConsumer.as_asgi()
+
+        async def connect(user, path="/ws/chat/"):
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope["user"] = user
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f"Could not connect as {user.username}")
+            return communicator
+
+        senders = [await connect(users[0]) for _ in range(concurrency)]
+        receivers = [await connect(user, "/ws/chat/?batch=1" if batch else "/ws/chat/") for user in users[1:]]
+        text_data = json.dumps(payload)
+
+        async def send(communicator, count):
+            for _ in range(count):
+                await communicator.send_to(text_data=text_data)
+
+        frames = 0
+
+        async def receive(communicator):
+            nonlocal frames
+            received = 0
+            while received < events:
+                data = json.loads(await communicator.receive_from(timeout=30))
+                received += len(data) if isinstance(data, list) else 1
+                frames += 1
+
+        counts = [events // concurrency + (i < events % concurrency) for i in range(concurrency)]
+        hops = 0
+        sync_to_async_call = SyncToAsync.__call__
+
+        async def counting_call(self, *args, **kwargs):
+            nonlocal hops
+            hops += 1
+            return await sync_to_async_call(self, *args, **kwargs)
+
+        SyncToAsync.__call__ = counting_call
+        try:
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            await asyncio.gather(
+                *(send(sender, count) for sender, count in zip(senders, counts)),
+                *(receive(receiver) for receiver in receivers),
+            )
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+        finally:
+            SyncToAsync.__call__ = sync_to_async_call
+            for communicator in senders + receivers:
+                await communicator.disconnect()
+
+        return elapsed, cpu, hops, frames
@@ -0,0 +1,83 @@
+import multiprocessing
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageDraw
+
+from chat.utils.image import crop_avatar_bytes, write_gif
+
+
+def generate_gif(path, frames, size):
+    """Write an animated GIF of `frames` distinct frames, with a square moving over a gradient background."""
+
+    def iter_frames():
+        background = Image.merge("RGB", [Image.linear_gradient("L").resize((size, size))] * 3).convert("RGBA")
+        for index in range(frames):
+            frame = background.copy()
+            position = index % (size // 2)
+            ImageDraw.Draw(frame).rectangle((position, position, position + size // 4, position + size // 4), "red")
+            yield frame, 40
+
+    with open(path, "wb") as fp:
+        write_gif(fp, iter_frames())
+
+
+def measure(path, crop_data, results):
+    with open(path, "rb") as fp:
+        data = fp.read()
+
+    before = current_rss()
+    start = time.perf_counter()
+    output, _ = crop_avatar_bytes(data, crop_data)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put((len(data), len(output), (peak - before) / 1024 / 1024, elapsed))
+
+
+def current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the peak memory of cropping animated GIF avatars as the number of frames grows. Each GIF is "
+        "processed in a fresh process, and how much its peak resident memory grows over the memory in use before the "
+        "crop is reported. Linux only."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--frames", type=int, nargs="+", default=[25, 50, 100, 200, 400], help="Frame counts to measure."
+        )
+        parser.add_argument("--size", type=int, default=480, help="Width and height of the source GIFs.")
+        parser.add_argument("--crop-size", type=int, default=256, help="Size of the cropped avatar.")
+
+    def handle(self, *args, frames, size, crop_size, **options):
+        crop_data = {
+            "x": 0,
+            "y": 0,
+            "scale": crop_size / size,
+            "crop_size": crop_size,
+            "container_width": crop_size,
+            "container_height": crop_size,
+        }
+        context = multiprocessing.get_context("spawn")
+
+        self.stdout.write(f"{'frames':>8} {'input KB':>10} {'output KB':>10} {'peak MB':>10} {'seconds':>8}")
+        for frame_count in frames:
+            with tempfile.NamedTemporaryFile(suffix=".gif") as source:
+                generate_gif(source.name, frame_count, size)
+
+                results = context.Queue()
+                process = context.Process(target=measure, args=(source.name, crop_data, results))
+                process.start()
+                input_size, output_size, peak, elapsed = results.get()
+                process.join()
+
+            self.stdout.write(
+                f"{frame_count:>8} {input_size / 1024:>10.0f} {output_size / 1024:>10.0f} {peak:>10.1f} {elapsed:>8.2f}"
+            )
@@ -0,0 +1,115 @@
+import json
+import random
+import time
+import uuid
+
+import msgpack
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+
+from chat.models import ChatRoom, Membership, Message, MessageReaction
+from chat.serializers import MessageReactionSerializer, MessageSerializer
+
+# Share of each event type in the generated traffic
+EVENT_MIX = {
+    "send_message": 40,
+    "add_message_reaction": 25,
+    "typing": 20,
+    "presence": 5,
+    "delete_message_reaction": 5,
+    "delete_message": 5,
+}
+
+WORDS = ["hello", "there", "how", "are", "you", "doing", "today", "see", "the", "new", "build", "works", "👋", "🎉"]
+
+CODECS = {
+    "json": (lambda payload: json.dumps(payload).encode(), json.loads),
+    "msgpack": (msgpack.packb, msgpack.unpackb),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the size and the encoding and decoding time of the WebSocket events in JSON and in MessagePack, for "
+        "a realistic mix of events built from a temporary room, which is removed when done."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=2000, help="Number of events in the mix.")
+        parser.add_argument("--members", type=int, default=20, help="Number of members of the room.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, events, members, seed, **options):
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        users = [User.objects.create(username=f"{prefix}-{i}") for i in range(members)]
+        room = ChatRoom.objects.create(name=prefix, owner=users[0])
+        try:
+            Membership.objects.bulk_create([Membership(user=user, room=room) for user in users])
+            payloads = self.build_events(random.Random(seed), room, users, events)
+        finally:
+            room.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.stdout.write(f"events: {events} ({', '.join(f'{name} {share}%' for name, share in EVENT_MIX.items())})")
+        self.stdout.write(f"{'codec':>8} {'avg bytes':>10} {'total KB':>10} {'encode us':>10} {'decode us':>10}")
+        for name, (encode, decode) in CODECS.items():
+            start = time.perf_counter()
+            frames = [encode(payload) for payload in payloads]
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for frame in frames:
+                decode(frame)
+            decode_time = time.perf_counter() - start
+
+            size = sum(map(len, frames))
+            self.stdout.write(
+                f"{name:>8} {size / events:>10.0f} {size / 1024:>10.0f} "
+                f"{encode_time / events * 1e6:>10.2f} {decode_time / events * 1e6:>10.2f}"
+            )
+
+    def build_events(self, rng, room, users, count):
+        """Build the payloads of `count` events, drawn from `EVENT_MIX`, as the consumer broadcasts them."""
+        context = {"request": APIRequestFactory().get("/")}
+        messages = []
+        for i in range(50):
+            message = Message.objects.create(
+                room=room,
+                user=rng.choice(users),
+                content=" ".join(rng.choices(WORDS, k=rng.randint(2, 40))),
+                reply_to=rng.choice(messages) if messages and i % 5 == 0 else None,
+            )
+            for user in rng.sample(users, rng.randint(0, 3)):
+                MessageReaction.objects.create(message=message, user=user, emoji=rng.choice(["👍", "❤️", "😂"]))
+            messages.append(message)
+
+        serialized = MessageSerializer(
+            MessageSerializer.setup_eager_loading(Message.objects.filter(room=room)), many=True, context=context
+        ).data
+        reactions = MessageReactionSerializer(
+            MessageReaction.objects.filter(message__room=room).select_related("user__profile"),
+            many=True,
+            context=context,
+        ).data
+
+        def event(kind):
+            match kind:
+                case "send_message":
+                    return {"type": "send_message", "message": rng.choice(serialized), "client_id": uuid.uuid4().hex}
+                case "add_message_reaction":
+                    return {"type": "add_message_reaction", "room": room.id, "reaction": rng.choice(reactions)}
+                case "typing":
+                    typing = rng.sample(users, rng.randint(0, 3))
+                    return {"type": "typing", "room": room.id, "users": sorted(user.username for user in typing)}
+                case "presence":
+                    return {"type": "presence", "room": room.id, "online": [rng.choice(users).id], "offline": []}
+                case "delete_message_reaction":
+                    message = rng.choice(serialized)
+                    return {"type": "delete_message_reaction", "message": message, "reaction_id": rng.randint(1, 1000)}
+                case "delete_message":
+                    return {"type": "delete_message", "message_id": rng.choice(serialized)["id"], "room": room.id}
+
+        kinds = rng.choices(list(EVENT_MIX), weights=list(EVENT_MIX.values()), k=count)
+        # Round trip through JSON, so the payloads are plain dicts like the ones decoded from the client frames
+        return [json.loads(json.dumps(event(kind))) for kind in kinds]
@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.read_positions import flush
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the read positions buffered in Redis to the memberships. With --loop, keep flushing them every "
+        "CHAT_READ_POSITION_FLUSH_INTERVAL seconds until stopped, which is how they are written in production. "
+        "Without it, flush them once, e.g. before a deploy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Flush the read positions every CHAT_READ_POSITION_FLUSH_INTERVAL seconds until stopped.",
+        )
+
+    def handle(self, *args, loop=False, **options):
+        if not loop:
+            updated = flush()
+            self.stdout.write(self.style.SUCCESS(f"Flushed the read positions of {updated} memberships."))
+            return
+
+        while True:
+            started = time.monotonic()
+            try:
+                updated = flush()
+                if updated:
+                    self.stdout.write(f"Flushed the read positions of {updated} memberships.")
+            except Exception:
+                # The positions that failed to be written stay buffered, and are flushed the next time
+                logger.exception("Failed to flush the read positions")
+            finally:
+                close_old_connections()
+            time.sleep(max(settings.CHAT_READ_POSITION_FLUSH_INTERVAL - (time.monotonic() - started), 0))
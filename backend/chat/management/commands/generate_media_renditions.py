@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import MessageMedia
+from chat.renditions import rendition_sizes, store_renditions
+from chat.utils.image import render_media_renditions
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate the placeholder and WebP renditions of the chat images that don't have them yet, such as the "
+        "images uploaded before the renditions existed or while the image pool was full."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of images loaded from the database at a time.",
+        )
+
+    def handle(self, *args, batch_size=100, **options):
+        generated = failed = 0
+        last_id = 0
+        while True:
+            batch = list(MessageMedia.objects.filter(placeholder="", id__gt=last_id).order_by("id")[:batch_size])
+            if not batch:
+                break
+
+            for media in batch:
+                try:
+                    with media.file.open("rb"):
+                        data = media.file.read()
+                    store_renditions(media.pk, media.file.name, render_media_renditions(data, rendition_sizes()))
+                    generated += 1
+                except Exception as exc:
+                    failed += 1
+                    self.stderr.write(f"Failed to generate the renditions of media {media.pk}: {exc}")
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f"Generated the renditions of {generated} images, {failed} failed."))
@@ -0,0 +1,413 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+import uuid
+from importlib import import_module
+from pathlib import Path
+
+import redis
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import ChatRoom, Membership, Message, Profile
+from chat.protocol import MSGPACK_SUBPROTOCOL, decode_frame
+
+# Relative frequency of the events sent by the simulated clients, unless overridden with --mix
+DEFAULT_MIX = {"send_message": 50, "typing": 25, "add_message_reaction": 15, "delete_message": 10}
+# The deleted message ids are made up, above any real id, so every delete announces a distinct id to match on
+DELETE_MESSAGE_ID_BASE = 10**15
+# Seconds a simulated client keeps typing before sending stop_typing
+TYPING_DURATION = 2
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        event, _, weight = item.partition("=")
+        if event not in DEFAULT_MIX or not weight.isdigit():
+            raise CommandError(
+                f"Invalid --mix item {item!r}, expected <event>=<weight> with one of {list(DEFAULT_MIX)}"
+            )
+        mix[event] = int(weight)
+    return mix
+
+
+def percentiles(samples):
+    """Latency percentiles in milliseconds of the samples, in seconds."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    return {
+        "count": len(samples),
+        "p50": round(quantiles[49] * 1000, 3),
+        "p90": round(quantiles[89] * 1000, 3),
+        "p99": round(quantiles[98] * 1000, 3),
+        "max": round(samples[-1] * 1000, 3),
+    }
+
+
+def rss_bytes():
+    """Resident set size of the process, None where /proc isn't available."""
+    try:
+        pages = int(Path("/proc/self/statm").read_text().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def redis_servers(configured_layer):
+    """Clients of the distinct Redis servers used by the chat state, the cache and the channel layer."""
+    urls = [settings.CHAT_REDIS_URL]
+    for cache in settings.CACHES.values():
+        if cache["BACKEND"].endswith("RedisCache"):
+            location = cache["LOCATION"]
+            urls.extend([location] if isinstance(location, str) else location)
+    if configured_layer:
+        layer = settings.CHANNEL_LAYERS["default"]
+        for host in layer.get("CONFIG", {}).get("hosts", ()):
+            if isinstance(host, dict):
+                host = host["address"]
+            urls.append(host if isinstance(host, str) else "redis://{}:{}".format(*host))
+
+    servers = {}
+    for url in urls:
+        client = redis.Redis.from_url(url)
+        kwargs = client.connection_pool.connection_kwargs
+        # INFO commandstats counts the commands of the whole server, whatever the database
+        servers.setdefault(kwargs.get("path") or "{}:{}".format(kwargs["host"], kwargs["port"]), client)
+    return servers
+
+
+def command_calls(servers):
+    return {
+        name: {
+            command.removeprefix("cmdstat_"): stats["calls"] for command, stats in client.info("commandstats").items()
+        }
+        for name, client in servers.items()
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the WebSocket fan-out: connect many simulated clients through the ASGI application of "
+        "core/asgi.py, spread over rooms of the given sizes, drive a mix of chat events at a fixed rate, and report "
+        "the delivery latency, the throughput, the Redis commands and the memory per connection as JSON. Creates "
+        "temporary users, rooms and sessions, and removes them when done."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000, help="Number of connected clients, one user each.")
+        parser.add_argument("--rooms", type=int, default=50, help="Number of rooms.")
+        parser.add_argument(
+            "--room-size",
+            type=int,
+            nargs="+",
+            default=[2, 10, 50],
+            help="Members of each room, the sizes are cycled over the rooms. Members are picked at random.",
+        )
+        parser.add_argument("--rate", type=float, default=200, help="Events sent per second, over all the clients.")
+        parser.add_argument("--duration", type=float, default=10, help="Seconds the events are sent for.")
+        parser.add_argument(
+            "--mix",
+            type=parse_mix,
+            default=DEFAULT_MIX,
+            help="Relative frequency of the events, e.g. send_message=50,typing=25,add_message_reaction=15,"
+            "delete_message=10. Events are sent by a random member of a room picked in proportion to its size.",
+        )
+        parser.add_argument(
+            "--layer",
+            choices=("configured", "memory"),
+            default="configured",
+            help="Use the configured channel layer (Redis), or an in-memory one standing in for it.",
+        )
+        parser.add_argument("--batch", action="store_true", help="Connect the clients with `?batch=1`.")
+        parser.add_argument("--binary", action="store_true", help="Connect the clients with the MessagePack protocol.")
+        parser.add_argument(
+            "--connect-concurrency", type=int, default=50, help="Number of connections opened at the same time."
+        )
+        parser.add_argument(
+            "--drain", type=float, default=2, help="Seconds without deliveries after which the run is over."
+        )
+        parser.add_argument("--seed", type=int, default=None, help="Seed of the room membership and the event mix.")
+        parser.add_argument("--output", help="Write the JSON report to this file instead of the standard output.")
+
+    def handle(self, *args, clients, rooms, room_size, layer, seed, output, **options):
+        if clients < 1 or rooms < 1 or min(room_size) < 1:
+            raise CommandError("--clients, --rooms and --room-size must be positive.")
+        if max(room_size) > clients:
+            raise CommandError("--room-size can't be larger than --clients.")
+
+        # The ASGI application sets up Django itself, which is done by now
+        from core.asgi import application
+
+        if layer == "memory":
+            channel_layers.set("default", InMemoryChannelLayer(capacity=10_000))
+
+        rng = random.Random(seed)
+        prefix = f"loadtest-{uuid.uuid4().hex[:8]}"
+        users = User.objects.bulk_create([User(username=f"{prefix}-{i}") for i in range(clients)])
+        created_rooms = []
+        sessions = []
+        try:
+            Profile.objects.bulk_create([Profile(user=user) for user in users])
+            created_rooms = ChatRoom.objects.bulk_create(
+                [ChatRoom(name=f"{prefix}-{i}", owner=users[0]) for i in range(rooms)]
+            )
+            members = {
+                room.id: rng.sample(users, size) for room, size in zip(created_rooms, itertools.cycle(room_size))
+            }
+            Membership.objects.bulk_create(
+                [
+                    Membership(user=user, room_id=room_id)
+                    for room_id, room_users in members.items()
+                    for user in room_users
+                ]
+            )
+            # Reactions are only forwarded, they don't need to exist, but refer to a real message of the room
+            seed_messages = {
+                room_id: Message.objects.create(room_id=room_id, user=room_users[0], content="load test").id
+                for room_id, room_users in members.items()
+            }
+            sessions = [self.create_session(user) for user in users]
+
+            servers = redis_servers(layer == "configured")
+            report = asyncio.run(self.run(application, users, sessions, members, seed_messages, servers, rng, options))
+        finally:
+            session_store = import_module(settings.SESSION_ENGINE).SessionStore
+            for session_key in sessions:
+                session_store(session_key).delete()
+            ChatRoom.objects.filter(id__in=[room.id for room in created_rooms]).delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        report["config"] = {
+            "clients": clients,
+            "rooms": rooms,
+            "room_size": room_size,
+            "layer": layer,
+            "delivery_mode": settings.CHAT_DELIVERY_MODE,
+            "seed": seed,
+            **{key: options[key] for key in ("rate", "duration", "mix", "batch", "binary")},
+        }
+        data = json.dumps(report, indent=2)
+        if output:
+            Path(output).write_text(data + "\n")
+            self.stderr.write(self.style.SUCCESS(f"Report written to {output}"))
+        else:
+            self.stdout.write(data)
+
+    def create_session(self, user):
+        """Log the user in a new session, as the login view does, and return the session key for the cookie."""
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session.session_key
+
+    async def run(self, application, users, sessions, members, seed_messages, servers, rng, options):
+        rate, duration, mix = options["rate"], options["duration"], options["mix"]
+        path = "/ws/chat/?batch=1" if options["batch"] else "/ws/chat/"
+        subprotocols = [MSGPACK_SUBPROTOCOL] if options["binary"] else None
+
+        async def connect(user, session_key):
+            communicator = WebsocketCommunicator(
+                application,
+                path,
+                headers=[
+                    (b"host", b"localhost"),
+                    (b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()),
+                ],
+                subprotocols=subprotocols,
+            )
+            connected, _ = await communicator.connect(timeout=30)
+            if not connected:
+                raise CommandError(f"Could not connect as {user.username}")
+            return communicator
+
+        # Python allocations are only traced while connecting, tracing slows down everything else
+        rss_before = rss_bytes()
+        tracemalloc.start()
+        connect_start = time.perf_counter()
+        communicators = {}
+        semaphore = asyncio.Semaphore(options["connect_concurrency"])
+
+        async def connect_user(user, session_key):
+            async with semaphore:
+                communicators[user.id] = await connect(user, session_key)
+
+        try:
+            await asyncio.gather(*(connect_user(user, key) for user, key in zip(users, sessions)))
+            connect_elapsed = time.perf_counter() - connect_start
+            traced, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rss_after = rss_bytes()
+
+            report = await self.drive(communicators, members, seed_messages, servers, rng, rate, duration, mix, options)
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            connected = list(communicators.values())
+            chunk = options["connect_concurrency"]
+            for i in range(0, len(connected), chunk):
+                await asyncio.gather(*(c.disconnect() for c in connected[i : i + chunk]), return_exceptions=True)
+
+        report["connections"] = {
+            "count": len(communicators),
+            "connect_seconds": round(connect_elapsed, 3),
+            "connects_per_second": round(len(communicators) / connect_elapsed, 1),
+            "python_heap_bytes_per_connection": round(traced / len(communicators)),
+            "rss_bytes_per_connection": (
+                round((rss_after - rss_before) / len(communicators)) if rss_before is not None else None
+            ),
+        }
+        return report
+
+    async def drive(self, communicators, members, seed_messages, servers, rng, rate, duration, mix, options):
+        # Key of every event sent (its client_id, or the id of the deleted message) => (event type, send time)
+        sent = {}
+        latencies = {event: [] for event in mix if event != "typing"}
+        sent_by_type = dict.fromkeys(mix, 0)
+        expected = dict.fromkeys(mix, 0)
+        delivered = {}
+        frames = 0
+        last_delivery = time.perf_counter()
+
+        def record(event):
+            nonlocal last_delivery
+            now = last_delivery = time.perf_counter()
+            event_type = event.get("type")
+            delivered[event_type] = delivered.get(event_type, 0) + 1
+            key = event.get("client_id") if event_type in ("send_message", "add_message_reaction") else None
+            if event_type == "delete_message":
+                key = event.get("message_id")
+            if key in sent:
+                latencies[sent[key][0]].append(now - sent[key][1])
+
+        async def receive(communicator):
+            nonlocal frames
+            # Read from the queue directly: `receive_output` kills the application when it times out
+            while True:
+                message = await communicator.output_queue.get()
+                if message["type"] != "websocket.send":
+                    continue
+                frames += 1
+                data = decode_frame(message.get("text"), message.get("bytes"))
+                for event in data if isinstance(data, list) else [data]:
+                    record(event)
+
+        readers = [asyncio.create_task(receive(communicator)) for communicator in communicators.values()]
+        room_ids = list(members)
+        room_weights = [len(members[room_id]) for room_id in room_ids]
+        events, weights = list(mix), list(mix.values())
+        pending_stops = set()
+
+        async def stop_typing(communicator, room_id):
+            await asyncio.sleep(TYPING_DURATION)
+            await communicator.send_to(text_data=json.dumps({"type": "stop_typing", "room": room_id}))
+
+        def build(event, seq, room_id, user):
+            client_id = f"lt-{seq}"
+            match event:
+                case "send_message":
+                    sent[client_id] = (event, time.perf_counter())
+                    content = f"load test message {seq}"
+                    return {
+                        "type": "send_message",
+                        "client_id": client_id,
+                        "message": {"room": room_id, "content": content},
+                    }
+                case "add_message_reaction":
+                    sent[client_id] = (event, time.perf_counter())
+                    reaction = {"id": seq, "message": seed_messages[room_id], "emoji": "👍", "user": {"id": user.id}}
+                    return {
+                        "type": "add_message_reaction",
+                        "room": room_id,
+                        "client_id": client_id,
+                        "reaction": reaction,
+                    }
+                case "delete_message":
+                    message_id = DELETE_MESSAGE_ID_BASE + seq
+                    sent[message_id] = (event, time.perf_counter())
+                    return {"type": "delete_message", "room": room_id, "message_id": message_id}
+                case "typing":
+                    return {"type": "start_typing", "room": room_id}
+
+        calls_before = await sync_to_async(command_calls)(servers)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        total = int(rate * duration)
+        try:
+            for seq in range(total):
+                # Open loop: events are sent on schedule, whether or not the previous ones were delivered yet
+                delay = start + seq / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                room_id = rng.choices(room_ids, room_weights)[0]
+                user = rng.choice(members[room_id])
+                event = rng.choices(events, weights)[0]
+                communicator = communicators[user.id]
+                payload = build(event, seq, room_id, user)
+                sent_by_type[event] += 1
+                expected[event] += len(members[room_id])
+                await communicator.send_to(text_data=json.dumps(payload))
+                if event == "typing":
+                    task = asyncio.create_task(stop_typing(communicator, room_id))
+                    pending_stops.add(task)
+                    task.add_done_callback(pending_stops.discard)
+            send_elapsed = time.perf_counter() - start
+
+            await asyncio.gather(*pending_stops)
+            while time.perf_counter() - last_delivery < options["drain"]:
+                await asyncio.sleep(0.1)
+            elapsed = max(last_delivery - start, send_elapsed)
+            cpu = time.process_time() - cpu_start
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+        calls_after = await sync_to_async(command_calls)(servers)
+
+        redis_calls = {}
+        for server, calls in calls_after.items():
+            commands = {
+                command: count - calls_before[server].get(command, 0)
+                for command, count in calls.items()
+                if count != calls_before[server].get(command, 0)
+            }
+            redis_calls[server] = {
+                "total": sum(commands.values()),
+                "per_event": round(sum(commands.values()) / total, 2) if total else None,
+                "commands": dict(sorted(commands.items(), key=lambda item: -item[1])),
+            }
+
+        deliveries = sum(delivered.values())
+        return {
+            "events": {
+                "sent": total,
+                "by_type": sent_by_type,
+                "send_seconds": round(send_elapsed, 3),
+                "per_second": round(total / send_elapsed, 1),
+            },
+            "deliveries": {
+                "total": deliveries,
+                "frames": frames,
+                "per_second": round(deliveries / elapsed, 1),
+                "by_type": delivered,
+                # The typing snapshots are coalesced, there is no delivery per start_typing to expect
+                "missing": {event: expected[event] - delivered.get(event, 0) for event in latencies},
+            },
+            "latency_ms": {event: percentiles(samples) for event, samples in latencies.items()},
+            "cpu_seconds_per_event": round(cpu / total, 6) if total else None,
+            "redis": redis_calls,
+        }
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import ChatRoom, Membership
+from chat.read_positions import flush
+
+
+class Command(BaseCommand):
+    help = "Rebuild the unread message counters of every membership from the message history."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--room",
+            type=int,
+            action="append",
+            dest="rooms",
+            help="Only rebuild the counters of this room. Can be given multiple times.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rooms whose counters are rebuilt per transaction.",
+        )
+
+    def handle(self, *args, rooms=None, batch_size=500, **options):
+        # The counters are rebuilt from the read positions, so the buffered ones are written first
+        flush()
+        room_ids = rooms or list(ChatRoom.objects.order_by("id").values_list("id", flat=True))
+
+        updated = 0
+        for start in range(0, len(room_ids), batch_size):
+            with transaction.atomic():
+                updated += Membership.rebuild_unread_counts(room_ids[start : start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the unread counters of {updated} memberships."))
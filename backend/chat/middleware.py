@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .timing import measure
+
+
+class ServerTimingMiddleware:
+    """
+    Add a Server-Timing header with the number of queries and the time spent in SQL, serializers and image processing
+    to the responses, and log the requests slower than CHAT_SLOW_REQUEST_THRESHOLD with their slowest queries.
+
+    Removed from the middleware chain unless CHAT_SERVER_TIMING is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.CHAT_SERVER_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure(f"request {request.method} {request.path}") as timing:
+            response = self.get_response(request)
+        response["Server-Timing"] = timing.server_timing()
+        return response
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:55
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The index is built without blocking the writes to the message table, which can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("chat", "0009_chatroominvitation"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="message",
+            index=models.Index(
+                fields=["room", "timestamp", "id"], name="chat_message_room_ts_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:56
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_unread_counts(apps, schema_editor):
+    Membership = apps.get_model("chat", "Membership")
+    Message = apps.get_model("chat", "Message")
+
+    unread_messages = (
+        Message.objects.filter(
+            room=OuterRef("room"), timestamp__gt=OuterRef("last_read_timestamp")
+        )
+        .exclude(user=OuterRef("user"))
+        .order_by()
+        .values("room")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    Membership.objects.update(unread_count=Coalesce(Subquery(unread_messages), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0010_message_chat_message_room_ts_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="membership",
+            name="unread_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_unread_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Substr
+
+
+def populate_last_messages(apps, schema_editor):
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    Message = apps.get_model("chat", "Message")
+    MessageMedia = apps.get_model("chat", "MessageMedia")
+
+    last_message = Message.objects.filter(room=OuterRef("pk")).order_by(
+        "-timestamp", "-id"
+    )
+    ChatRoom.objects.filter(Exists(last_message)).update(
+        last_message=Subquery(last_message.values("pk")[:1]),
+        last_message_user=Subquery(last_message.values("user")[:1]),
+        last_message_preview=Subquery(
+            last_message.annotate(preview=Substr("content", 1, 255)).values("preview")[
+                :1
+            ]
+        ),
+        last_message_has_media=Exists(
+            MessageMedia.objects.filter(
+                message=Subquery(
+                    Message.objects.filter(room=OuterRef(OuterRef("pk")))
+                    .order_by("-timestamp", "-id")
+                    .values("pk")[:1]
+                )
+            )
+        ),
+        last_message_timestamp=Subquery(last_message.values("timestamp")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0011_membership_unread_count"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatroom",
+            name="last_message",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="chat.message",
+            ),
+        ),
+        migrations.AddField(
+            model_name="chatroom",
+            name="last_message_has_media",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="chatroom",
+            name="last_message_preview",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="chatroom",
+            name="last_message_timestamp",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chatroom",
+            name="last_message_user",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RunPython(populate_last_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.3 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0012_chatroom_last_message"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagemedia",
+            name="bubble",
+            field=models.ImageField(blank=True, null=True, upload_to="chat_media/bubble/"),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="bubble_height",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="bubble_width",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="full",
+            field=models.ImageField(blank=True, null=True, upload_to="chat_media/full/"),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="full_height",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="full_width",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="height",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="placeholder",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="messagemedia",
+            name="width",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
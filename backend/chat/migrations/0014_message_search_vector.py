@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-17 01:33
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Adding the stored column rewrites the message table, and the index is built without blocking the writes, which
+    # can't run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ("chat", "0013_messagemedia_renditions"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector("content", config="simple"),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="message",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="chat_message_search_idx"),
+        ),
+    ]
@@ -1,13 +1,29 @@
 import uuid
+from collections import Counter
 from datetime import timedelta
 from typing import final, override
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
+from .user_payloads import invalidate_user_payloads
+from .versions import bump_room_versions, bump_rooms_version, bump_user_rooms_versions
+
+
+LAST_MESSAGE_PREVIEW_LENGTH = 255
+# Text search configuration of the message search. Messages are written in any language, so words are only lowercased
+# and never stemmed.
+MESSAGE_SEARCH_CONFIG = "simple"
+
 
 def get_invitation_expiry_date():
     return timezone.now() + timedelta(days=7)
@@ -22,16 +38,78 @@ class Profile(models.Model):
     def __str__(self):
         return self.user.username
 
+    @staticmethod
+    def invalidate_rendered(user_id):
+        """Invalidate the cached `UserSerializer` payload of a user, and bump the versions of their rooms, which render it."""
+        invalidate_user_payloads(user_id)
+        bump_room_versions(*Membership.objects.filter(user_id=user_id).values_list("room_id", flat=True))
+
 
 class Membership(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room = models.ForeignKey("ChatRoom", on_delete=models.CASCADE)
     is_admin = models.BooleanField(default=False)
     last_read_timestamp = models.DateTimeField(auto_now_add=True)
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("user", "room")
 
+    @staticmethod
+    def member_ids_cache_key(room_id):
+        return f"chat:room-members:{room_id}"
+
+    @classmethod
+    def get_member_ids(cls, room_id) -> list[int]:
+        """Ids of the members of a room, served from the cache and invalidated whenever the membership changes."""
+        key = cls.member_ids_cache_key(room_id)
+        member_ids = cache.get(key)
+        if member_ids is None:
+            member_ids = list(cls.objects.filter(room_id=room_id).values_list("user_id", flat=True))
+            cache.set(key, member_ids, settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+        return member_ids
+
+    @classmethod
+    async def aget_member_ids(cls, room_id) -> list[int]:
+        """Async version of `get_member_ids`, for the WebSocket consumers."""
+        key = cls.member_ids_cache_key(room_id)
+        member_ids = await cache.aget(key)
+        if member_ids is None:
+            queryset = cls.objects.filter(room_id=room_id).values_list("user_id", flat=True)
+            member_ids = [user_id async for user_id in queryset]
+            await cache.aset(key, member_ids, settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+        return member_ids
+
+    @classmethod
+    def invalidate_member_ids(cls, *room_ids):
+        cache.delete_many([cls.member_ids_cache_key(room_id) for room_id in room_ids])
+
+    @classmethod
+    def increment_unread_counts(cls, room_id, author_id, count=1):
+        """Count `count` new messages sent by `author_id` as unread for every other member of the room."""
+        cls.objects.filter(room_id=room_id).exclude(user_id=author_id).update(unread_count=F("unread_count") + count)
+
+    @classmethod
+    def decrement_unread_counts(cls, message):
+        """Discount a message that is about to be deleted from the members that haven't read it yet."""
+        cls.objects.filter(room_id=message.room_id, last_read_timestamp__lt=message.timestamp, unread_count__gt=0).exclude(
+            user_id=message.user_id
+        ).update(unread_count=F("unread_count") - 1)
+
+    @classmethod
+    def rebuild_unread_counts(cls, room_ids=None):
+        """Recompute the unread counters from the message history. Returns the number of memberships updated."""
+        unread_messages = (
+            Message.objects.filter(room=OuterRef("room"), timestamp__gt=OuterRef("last_read_timestamp"))
+            .exclude(user=OuterRef("user"))
+            .order_by()
+            .values("room")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        memberships = cls.objects.all() if room_ids is None else cls.objects.filter(room_id__in=room_ids)
+        return memberships.update(unread_count=Coalesce(Subquery(unread_messages), 0))
+
 
 @final
 class ChatRoom(models.Model):
@@ -42,11 +120,55 @@ class ChatRoom(models.Model):
     is_dm = models.BooleanField(default=False)
     owner = models.ForeignKey(User, related_name="owned_rooms", on_delete=models.SET_NULL, null=True, blank=True)
     members = models.ManyToManyField(User, related_name="chat_rooms", blank=True, through=Membership)
+    # Summary of the newest message, kept in sync on message create/edit/delete for the room list previews
+    last_message = models.ForeignKey("Message", related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+    last_message_user = models.ForeignKey(User, related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+    last_message_preview = models.CharField(max_length=LAST_MESSAGE_PREVIEW_LENGTH, blank=True)
+    last_message_has_media = models.BooleanField(default=False)
+    last_message_timestamp = models.DateTimeField(null=True, blank=True)
 
     @override
     def __str__(self):
         return f"{self.name} ({"Private" if self.is_private else "Public"})"
 
+    @staticmethod
+    def last_message_summary(message, has_media):
+        return {
+            "last_message": message,
+            "last_message_user_id": message.user_id if message else None,
+            "last_message_preview": message.content[:LAST_MESSAGE_PREVIEW_LENGTH] if message else "",
+            "last_message_has_media": has_media,
+            "last_message_timestamp": message.timestamp if message else None,
+        }
+
+    @classmethod
+    def record_last_message(cls, message, has_media):
+        """Make `message` the last message of its room, unless the room already has a newer one."""
+        cls.objects.filter(
+            Q(last_message_timestamp__isnull=True) | Q(last_message_timestamp__lte=message.timestamp),
+            pk=message.room_id,
+        ).update(**cls.last_message_summary(message, has_media))
+
+    @classmethod
+    def refresh_edited_last_message(cls, message):
+        """Update the summary after `message` was edited, if it is the last message of its room."""
+        cls.objects.filter(pk=message.room_id, last_message=message).update(
+            last_message_preview=message.content[:LAST_MESSAGE_PREVIEW_LENGTH],
+            last_message_has_media=Exists(MessageMedia.objects.filter(message=message)),
+        )
+
+    @classmethod
+    def refresh_last_message(cls, room_id):
+        """Recompute the summary from the newest remaining message of the room, e.g. after a delete."""
+        last_message = (
+            Message.objects.filter(room_id=room_id)
+            .annotate(has_media=Exists(MessageMedia.objects.filter(message=OuterRef("pk"))))
+            .order_by("-timestamp", "-id")
+            .first()
+        )
+        has_media = last_message.has_media if last_message else False
+        cls.objects.filter(pk=room_id).update(**cls.last_message_summary(last_message, has_media))
+
 
 @final
 class Message(models.Model):
@@ -55,10 +177,20 @@ class Message(models.Model):
     content = models.TextField(blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     reply_to = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="replies")
+    # Stored and updated by the database whenever the content changes
+    search_vector = models.GeneratedField(
+        expression=SearchVector("content", config=MESSAGE_SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
     @final
     class Meta:
         ordering = ("timestamp",)
+        indexes = [
+            models.Index(fields=("room", "timestamp", "id"), name="chat_message_room_ts_id_idx"),
+            GinIndex(fields=("search_vector",), name="chat_message_search_idx"),
+        ]
 
     @override
     def __str__(self):
@@ -66,6 +198,26 @@ class Message(models.Model):
             f"Message(user={self.user}, content={self.content}, timestamp={self.timestamp}, reply_to={self.reply_to})"
         )
 
+    @classmethod
+    def record_created(cls, messages, with_media=frozenset()):
+        """
+        Update the state denormalized from the message history (unread counters and last message summaries) for
+        newly created messages. `with_media` holds the ids of the messages that have media attached.
+        """
+        new_messages = Counter((message.room_id, message.user_id) for message in messages)
+        for (room_id, author_id), count in new_messages.items():
+            Membership.increment_unread_counts(room_id, author_id, count)
+
+        last_messages = {}
+        for message in messages:
+            last_message = last_messages.get(message.room_id)
+            if last_message is None or (message.timestamp, message.pk) > (last_message.timestamp, last_message.pk):
+                last_messages[message.room_id] = message
+        for message in last_messages.values():
+            ChatRoom.record_last_message(message, has_media=message.pk in with_media)
+        # Bulk created messages don't send the post_save signal
+        bump_room_versions(*last_messages)
+
 
 @final
 class MessageReaction(models.Model):
@@ -83,6 +235,17 @@ class MessageReaction(models.Model):
 class MessageMedia(models.Model):
     message = models.ForeignKey(Message, related_name="media", on_delete=models.CASCADE, null=True, blank=True)
     file = models.ImageField(upload_to="chat_media/")
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    # WebP renditions generated after the upload, the clients fall back to `file` while they are missing. Animated
+    # images only get the placeholder.
+    placeholder = models.TextField(blank=True)
+    bubble = models.ImageField(upload_to="chat_media/bubble/", null=True, blank=True)
+    bubble_width = models.PositiveIntegerField(null=True, blank=True)
+    bubble_height = models.PositiveIntegerField(null=True, blank=True)
+    full = models.ImageField(upload_to="chat_media/full/", null=True, blank=True)
+    full_width = models.PositiveIntegerField(null=True, blank=True)
+    full_height = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"Media for Message {self.message.id}: {self.file.name}"
@@ -116,5 +279,71 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    """Save the profile automatically when an user is saved."""
+    """Save the profile automatically when an user is saved, which also invalidates their cached payload."""
     instance.profile.save()
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=User)
+def invalidate_user_payload(sender, instance, **kwargs):
+    """Invalidate the cached `UserSerializer` payload of a user once they or their profile change."""
+    Profile.invalidate_rendered(instance.user_id if sender is Profile else instance.pk)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def bump_room_version(sender, instance, **kwargs):
+    bump_room_versions(instance.pk)
+    bump_rooms_version()
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+@receiver(post_save, sender=MessageReaction)
+@receiver(post_delete, sender=MessageReaction)
+@receiver(post_save, sender=MessageMedia)
+@receiver(post_delete, sender=MessageMedia)
+def bump_message_room_version(sender, instance, origin=None, **kwargs):
+    """Bump the version of the room of a message when the message, its reactions or media change."""
+    if isinstance(origin, models.Model) and origin is not instance:
+        # Deleted along with the room, message or user, whose deletion bumps the versions
+        return
+
+    if sender is Message:
+        bump_room_versions(instance.room_id)
+    elif instance.message_id is not None:
+        bump_room_versions(Message.objects.values_list("room_id", flat=True).get(pk=instance.message_id))
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def invalidate_room_member_ids(sender, instance, **kwargs):
+    """
+    Drop the cached member ids of a room when one of its memberships is created or deleted, and bump the versions of
+    the room and of the rooms of the member.
+    """
+    Membership.invalidate_member_ids(instance.room_id)
+    bump_room_versions(instance.room_id)
+    bump_user_rooms_versions(instance.user_id)
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def invalidate_room_member_ids_on_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Same as `invalidate_room_member_ids` for changes made through `ChatRoom.members` or `User.chat_rooms`."""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    if not reverse:
+        Membership.invalidate_member_ids(instance.pk)
+        bump_room_versions(instance.pk)
+        if action == "pre_clear":
+            pk_set = Membership.objects.filter(room=instance).values_list("user_id", flat=True)
+        bump_user_rooms_versions(*(pk_set or ()))
+        return
+
+    if action == "pre_clear":
+        pk_set = Membership.objects.filter(user=instance).values_list("room_id", flat=True)
+    if pk_set:
+        Membership.invalidate_member_ids(*pk_set)
+        bump_room_versions(*pk_set)
+    bump_user_rooms_versions(instance.pk)
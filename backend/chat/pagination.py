@@ -0,0 +1,192 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(LimitOffsetPagination):
+    """
+    Keyset pagination over `(timestamp, id)` for the message history of a room.
+
+    Pages are always returned newest first. Without a cursor the newest page is returned, `before=<message_id>`
+    returns the messages older than the given one, `after=<message_id>` the messages newer than it and
+    `around=<message_id>` a page centered on it (e.g. to jump to a replied-to message). Every page is an index scan
+    on `(room_id, timestamp, id)` starting at the cursor, see `older_than`, so deep history costs the same as the
+    first page.
+
+    Listings that are not scoped to a room keep the limit/offset behaviour.
+    """
+
+    room_query_param = "room"
+    before_query_param = "before"
+    after_query_param = "after"
+    around_query_param = "around"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_keyset = self.room_query_param in request.query_params
+        if not self.use_keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.has_older = self.has_newer = False
+
+        if before := request.query_params.get(self.before_query_param):
+            timestamp, pk = self.get_anchor(queryset, before)
+            results = self.fetch_older(queryset.filter(older_than(timestamp, pk)), self.limit)
+            self.has_newer = True
+        elif after := request.query_params.get(self.after_query_param):
+            timestamp, pk = self.get_anchor(queryset, after)
+            results = self.fetch_newer(queryset.filter(newer_than(timestamp, pk)), self.limit)
+            self.has_older = True
+        elif around := request.query_params.get(self.around_query_param):
+            timestamp, pk = self.get_anchor(queryset, around)
+            newer = self.fetch_newer(queryset.filter(newer_than(timestamp, pk)), self.limit // 2)
+            older = self.fetch_older(queryset.filter(older_than(timestamp, pk, inclusive=True)), self.limit - len(newer))
+            results = newer + older
+        else:
+            results = self.fetch_older(queryset, self.limit)
+
+        self.results = results
+        return results
+
+    def get_anchor(self, queryset, message_id):
+        try:
+            anchor = queryset.filter(pk=int(message_id)).values_list("timestamp", "id").first()
+        except ValueError:
+            anchor = None
+
+        if anchor is None:
+            raise NotFound(self.invalid_cursor_message)
+        return anchor
+
+    def fetch_older(self, queryset, limit):
+        rows = list(queryset.order_by("-timestamp", "-id")[: limit + 1])
+        if len(rows) > limit:
+            self.has_older = True
+        return rows[:limit]
+
+    def fetch_newer(self, queryset, limit):
+        rows = list(queryset.order_by("timestamp", "id")[: limit + 1])
+        if len(rows) > limit:
+            self.has_newer = True
+        return rows[:limit][::-1]
+
+    def get_next_link(self):
+        if not self.use_keyset:
+            return super().get_next_link()
+        if not self.has_older or not self.results:
+            return None
+        return self.build_link(self.before_query_param, self.results[-1].pk)
+
+    def get_previous_link(self):
+        if not self.use_keyset:
+            return super().get_previous_link()
+        if not self.has_newer or not self.results:
+            return None
+        return self.build_link(self.after_query_param, self.results[0].pk)
+
+    def build_link(self, param, message_id):
+        url = self.request.build_absolute_uri()
+        for cursor_param in (self.before_query_param, self.after_query_param, self.around_query_param):
+            url = remove_query_param(url, cursor_param)
+        url = remove_query_param(url, self.offset_query_param)
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, param, message_id)
+
+    def get_paginated_response(self, data):
+        if not self.use_keyset:
+            return super().get_paginated_response(data)
+
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+class MessageSearchPagination(BasePagination):
+    """
+    Keyset pagination of the message search results, in descending order of `key` (the search rank or the timestamp)
+    then of id. The cursor of the next page is the opaque `(key, id)` of the last result, so every page is a filter on
+    the matches instead of an offset over them.
+    """
+
+    cursor_query_param = "cursor"
+    limit_query_param = "limit"
+    default_limit = 20
+    max_limit = 100
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None, key="timestamp"):
+        self.request = request
+        self.key = key
+        self.limit = self.get_limit(request)
+
+        if cursor := request.query_params.get(self.cursor_query_param):
+            value, pk = self.decode_cursor(cursor)
+            # Bounded on the key alone too, see `older_than`
+            queryset = queryset.filter(
+                Q(**{f"{key}__lte": value}), Q(**{f"{key}__lt": value}) | Q(**{key: value, "id__lt": pk})
+            )
+
+        rows = list(queryset.order_by(f"-{key}", "-id")[: self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        self.results = rows[: self.limit]
+        return self.results
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return min(max(limit, 1), self.max_limit)
+
+    def decode_cursor(self, cursor):
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return value, int(pk)
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row):
+        value = getattr(row, self.key)
+        # Ranks are kept as floats so they compare equal to the ones computed by the database
+        value = value if isinstance(value, float) else value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, row.pk]).encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.results[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([("next", self.get_next_link()), ("results", data)]))
+
+
+# The conditions on `(timestamp, id)` are ANDed with a bound on the timestamp alone, which Postgres uses as the start
+# of the index scan. The OR on its own is only a filter, which walks the index from the newest (or oldest) message of
+# the room up to the cursor.
+
+
+def older_than(timestamp, pk, inclusive=False):
+    """The messages before the message `(timestamp, pk)`, and the message itself if `inclusive`."""
+    same_instant = Q(timestamp=timestamp, id__lte=pk) if inclusive else Q(timestamp=timestamp, id__lt=pk)
+    return Q(timestamp__lte=timestamp) & (Q(timestamp__lt=timestamp) | same_instant)
+
+
+def newer_than(timestamp, pk):
+    """The messages after the message `(timestamp, pk)`."""
+    return Q(timestamp__gte=timestamp) & (Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
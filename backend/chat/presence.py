@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .delivery import group_send_to_room, group_send_to_user
+from .models import ChatRoom, Membership
+from .protocol import encode_payload
+from .redis import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of the users with at least one connection, scored by the time their presence expires
+ONLINE_USERS_KEY = "chat:online"
+
+# KEYS: the user connections hash, ONLINE_USERS_KEY, then the online set of every room of the user.
+# ARGV: channel name, expiry, now, user id.
+# Returns whether the user went online, which is the case when they had no live connection before this one.
+CONNECT_SCRIPT = """
+local was_online = false
+for _, expires in ipairs(redis.call("HVALS", KEYS[1])) do
+    if tonumber(expires) > tonumber(ARGV[3]) then
+        was_online = true
+        break
+    end
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("EXPIRE", KEYS[1], math.ceil(ARGV[2] - ARGV[3]))
+for i = 2, #KEYS do
+    redis.call("ZADD", KEYS[i], "GT", ARGV[2], ARGV[4])
+end
+return was_online and 0 or 1
+"""
+
+# Same KEYS as CONNECT_SCRIPT. ARGV: channel name, now, user id.
+# Returns whether the user went offline, which is the case when this was their last live connection.
+DISCONNECT_SCRIPT = """
+if redis.call("HDEL", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for _, expires in ipairs(redis.call("HVALS", KEYS[1])) do
+    if tonumber(expires) > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call("DEL", KEYS[1])
+for i = 2, #KEYS do
+    redis.call("ZREM", KEYS[i], ARGV[3])
+end
+return 1
+"""
+
+# Same KEYS as CONNECT_SCRIPT. ARGV: channel name, expiry, now, user id.
+# Extends the presence of a connection, unless it was already removed.
+HEARTBEAT_SCRIPT = """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("EXPIRE", KEYS[1], math.ceil(ARGV[2] - ARGV[3]))
+for i = 2, #KEYS do
+    redis.call("ZADD", KEYS[i], "GT", ARGV[2], ARGV[4])
+end
+return 1
+"""
+
+# KEYS: the user connections hash, ONLINE_USERS_KEY. ARGV: now, user id.
+# Drops the expired connections of a user, left behind by a server process that died. Returns whether the user went
+# offline, only to the first caller, so a single process reports it.
+SWEEP_SCRIPT = """
+local live = 0
+local connections = redis.call("HGETALL", KEYS[1])
+for i = 1, #connections, 2 do
+    local expires = tonumber(connections[i + 1])
+    if expires > tonumber(ARGV[1]) then
+        live = math.max(live, expires)
+    else
+        redis.call("HDEL", KEYS[1], connections[i])
+    end
+end
+if live > 0 then
+    redis.call("ZADD", KEYS[2], live, ARGV[2])
+    return 0
+end
+return redis.call("ZREM", KEYS[2], ARGV[2])
+"""
+
+
+def connections_key(user_id):
+    """Hash of the connections of the user, mapped to the time they expire unless refreshed by a heartbeat."""
+    return f"chat:presence:{user_id}"
+
+
+def room_online_key(room_id):
+    """Sorted set of the online members of the room, scored by the time their presence expires."""
+    return f"chat:online:{room_id}"
+
+
+def presence_keys(user_id, room_ids):
+    return [connections_key(user_id), ONLINE_USERS_KEY, *(room_online_key(room_id) for room_id in room_ids)]
+
+
+class PresenceTracker:
+    """
+    Tracks which users have a WebSocket connection open, in Redis.
+
+    Every connection is registered with an expiry that the process refreshes with a heartbeat every
+    `CHAT_PRESENCE_HEARTBEAT_INTERVAL` seconds, so the connections of a process that died without disconnecting them
+    expire after `CHAT_PRESENCE_TIMEOUT` seconds, and are swept by the other processes. A user is online while they
+    have any live connection.
+
+    Users going online or offline aren't broadcast one event at a time: the changes are collected and sent to each
+    room as a single `presence` diff every `CHAT_PRESENCE_FLUSH_INTERVAL` seconds.
+    """
+
+    def __init__(self):
+        # Channel name => (user id, room ids) of the connections of this process
+        self.connections = {}
+        # Room id => {user id: whether they are online} changes not broadcast yet
+        self.changes = {}
+        self.task = None
+
+    async def connect(self, channel_name, user_id, room_ids):
+        self.ensure_running()
+        self.connections[channel_name] = (user_id, list(room_ids))
+
+        now = time.time()
+        redis = get_async_redis()
+        went_online = await redis.register_script(CONNECT_SCRIPT)(
+            presence_keys(user_id, room_ids), [channel_name, now + settings.CHAT_PRESENCE_TIMEOUT, now, user_id]
+        )
+        if went_online:
+            self.record_change(user_id, room_ids, online=True)
+
+    async def disconnect(self, channel_name):
+        if channel_name not in self.connections:
+            return
+        user_id, room_ids = self.connections.pop(channel_name)
+
+        redis = get_async_redis()
+        went_offline = await redis.register_script(DISCONNECT_SCRIPT)(
+            presence_keys(user_id, room_ids), [channel_name, time.time(), user_id]
+        )
+        if went_offline:
+            self.record_change(user_id, room_ids, online=False)
+
+    async def update_rooms(self, channel_name, joined, left):
+        """
+        Follow the rooms the user of a connection joined or left since it was opened: the user is added to the online
+        members of the joined rooms, announced to them in the next diff, and removed from the left rooms.
+        """
+        if channel_name not in self.connections:
+            return
+        user_id, room_ids = self.connections[channel_name]
+        joined = [room_id for room_id in joined if room_id not in room_ids]
+        left = [room_id for room_id in left if room_id in room_ids]
+        self.connections[channel_name] = (user_id, [room_id for room_id in room_ids if room_id not in left] + joined)
+
+        redis = get_async_redis()
+        expires = await redis.hget(connections_key(user_id), channel_name)
+        async with redis.pipeline(transaction=False) as pipe:
+            if expires is not None:
+                for room_id in joined:
+                    pipe.zadd(room_online_key(room_id), {user_id: expires}, gt=True)
+            for room_id in left:
+                pipe.zrem(room_online_key(room_id), user_id)
+            await pipe.execute()
+        if expires is not None:
+            self.record_change(user_id, joined, online=True)
+
+    def record_change(self, user_id, room_ids, online):
+        for room_id in room_ids:
+            self.changes.setdefault(room_id, {})[user_id] = online
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        last_heartbeat = time.monotonic()
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+            try:
+                if time.monotonic() - last_heartbeat >= settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL:
+                    last_heartbeat = time.monotonic()
+                    await self.heartbeat()
+                    await self.sweep()
+                await self.flush()
+            except Exception:
+                # Redis or the channel layer being unavailable for a moment mustn't stop the presence updates
+                logger.exception("Failed to update the presence")
+
+    async def heartbeat(self):
+        if not self.connections:
+            return
+
+        now = time.time()
+        expires = now + settings.CHAT_PRESENCE_TIMEOUT
+        redis = get_async_redis()
+        # Sent with EVALSHA, the pipeline loads the script first if Redis doesn't know it yet
+        heartbeat = redis.register_script(HEARTBEAT_SCRIPT)
+        async with redis.pipeline(transaction=False) as pipe:
+            for channel_name, (user_id, room_ids) in self.connections.items():
+                await heartbeat(presence_keys(user_id, room_ids), [channel_name, expires, now, user_id], client=pipe)
+            await pipe.execute()
+
+    async def sweep(self):
+        """Take offline the users whose connections all expired."""
+        redis = get_async_redis()
+        sweep = redis.register_script(SWEEP_SCRIPT)
+        now = time.time()
+        # Every user looked at leaves the range, either taken offline or with the expiry of a live connection
+        while user_ids := await redis.zrangebyscore(
+            ONLINE_USERS_KEY, "-inf", now, start=0, num=settings.CHAT_PRESENCE_SWEEP_BATCH_SIZE
+        ):
+            async with redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    await sweep([connections_key(user_id), ONLINE_USERS_KEY], [now, user_id], client=pipe)
+                went_offline = await pipe.execute()
+            offline_user_ids = [int(user_id) for user_id, offline in zip(user_ids, went_offline) if offline]
+            if not offline_user_ids:
+                continue
+
+            room_ids = {}
+            async for user_id, room_id in Membership.objects.filter(user_id__in=offline_user_ids).values_list(
+                "user_id", "room_id"
+            ):
+                room_ids.setdefault(user_id, []).append(room_id)
+            async with redis.pipeline(transaction=False) as pipe:
+                for room_id in set().union(*room_ids.values()):
+                    pipe.zremrangebyscore(room_online_key(room_id), "-inf", now)
+                await pipe.execute()
+            for user_id, user_room_ids in room_ids.items():
+                self.record_change(user_id, user_room_ids, online=False)
+
+    async def flush(self):
+        changes, self.changes = self.changes, {}
+        channel_layer = get_channel_layer()
+        for room_id, users in changes.items():
+            payload = {
+                "type": "presence",
+                "room": room_id,
+                "online": sorted(user_id for user_id, online in users.items() if online),
+                "offline": sorted(user_id for user_id, online in users.items() if not online),
+            }
+            await group_send_to_room(channel_layer, room_id, {"type": "chat.presence", **encode_payload(payload)})
+
+
+def get_online_member_ids(room_id) -> set[int]:
+    """Ids of the members of the room that are online."""
+    online = get_redis().zrangebyscore(room_online_key(room_id), time.time(), "+inf")
+    return set(map(int, online)) & set(Membership.get_member_ids(room_id))
+
+
+def announce_room_changes(user_ids, joined=(), left=()):
+    """
+    Tell the connections of the users that they joined or left rooms, once the transaction commits, so they follow
+    the presence of their current rooms.
+    """
+    if not user_ids or not (joined or left):
+        return
+    event = {"type": "chat.rooms.changed", "joined": list(joined), "left": list(left)}
+
+    async def send():
+        channel_layer = get_channel_layer()
+        await asyncio.gather(*(group_send_to_user(channel_layer, user_id, event) for user_id in user_ids))
+
+    transaction.on_commit(async_to_sync(send))
+
+
+@receiver(post_save, sender=Membership)
+def announce_joined_room(sender, instance, created, **kwargs):
+    if created:
+        announce_room_changes([instance.user_id], joined=[instance.room_id])
+
+
+@receiver(post_delete, sender=Membership)
+def announce_left_room(sender, instance, **kwargs):
+    announce_room_changes([instance.user_id], left=[instance.room_id])
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def announce_room_changes_on_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Same as `announce_joined_room` and `announce_left_room` for changes made through `ChatRoom.members`."""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    change = "joined" if action == "post_add" else "left"
+    if not reverse:
+        if action == "pre_clear":
+            pk_set = Membership.objects.filter(room=instance).values_list("user_id", flat=True)
+        announce_room_changes(list(pk_set or ()), **{change: [instance.pk]})
+        return
+
+    if action == "pre_clear":
+        pk_set = Membership.objects.filter(user=instance).values_list("room_id", flat=True)
+    announce_room_changes([instance.pk], **{change: list(pk_set or ())})
+
+
+presence = PresenceTracker()
@@ -0,0 +1,51 @@
+import json
+from functools import lru_cache
+
+import msgpack
+
+# WebSocket subprotocol of the clients exchanging MessagePack binary frames instead of JSON text frames
+MSGPACK_SUBPROTOCOL = "zap2.msgpack"
+
+
+def encode_payload(payload, text_data=None, bytes_data=None):
+    """
+    Encode the payload of a channel layer event once for all of its recipients, in a single wire format. The frame the
+    payload was received as can be passed as `text_data` or `bytes_data`, to be forwarded as is in `payload` (JSON) or
+    `payload_bin` (MessagePack). Otherwise the payload is encoded as JSON, the format of most clients. The recipients
+    using the other format get it from `event_payload`.
+    """
+    if bytes_data is not None:
+        return {"payload_bin": bytes_data}
+    return {"payload": text_data if text_data is not None else json.dumps(payload)}
+
+
+def event_payload(event, binary):
+    """The payload of an event encoded by `encode_payload`, in MessagePack if `binary` is set, JSON otherwise."""
+    if binary:
+        return event["payload_bin"] if "payload_bin" in event else json_to_msgpack(event["payload"])
+    return event["payload"] if "payload" in event else msgpack_to_json(event["payload_bin"])
+
+
+# The payload is converted once for all the recipients of an event connected to this server process, whose events
+# are distinct copies of the same payload.
+
+
+@lru_cache(maxsize=1024)
+def json_to_msgpack(text_data):
+    return msgpack.packb(json.loads(text_data))
+
+
+@lru_cache(maxsize=1024)
+def msgpack_to_json(bytes_data):
+    return json.dumps(msgpack.unpackb(bytes_data))
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data)
+    return json.loads(text_data)
+
+
+def msgpack_array(items):
+    """Join MessagePack encoded items into an encoded array, without decoding them."""
+    return msgpack.Packer().pack_array_header(len(items)) + b"".join(items)
@@ -0,0 +1,182 @@
+from datetime import UTC, datetime, timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, Count, IntegerField, Subquery, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Membership, Message
+from .redis import get_redis
+from .versions import bump_user_rooms_versions
+
+# Set of the users with read positions not written to the database yet
+PENDING_USERS_KEY = "chat:read:pending"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+# KEYS: the read positions hash of the user, PENDING_USERS_KEY. ARGV: room id, timestamp, user id.
+# Records the read position, unless a newer one is already buffered.
+MARK_READ_SCRIPT = """
+local current = redis.call("HGET", KEYS[1], ARGV[1])
+if current and tonumber(current) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("SADD", KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: the read positions hash of the user. ARGV: room id, timestamp pairs.
+# Removes the flushed read positions, except the ones that moved forward since, which are flushed the next time.
+CLEAR_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call("HGET", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call("HDEL", KEYS[1], ARGV[i])
+    end
+end
+"""
+
+
+def positions_key(user_id):
+    """Hash of the buffered read positions of the user, room id => timestamp in microseconds."""
+    return f"chat:read:{user_id}"
+
+
+def to_microseconds(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_microseconds(value):
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def mark_read(user, room_id):
+    """
+    Mark every message in the room as read by `user`.
+
+    The read position is only buffered in Redis, loading the history of a room doesn't write to the database. The
+    buffered positions are written in batches by `flush`, which the `flush_read_positions --loop` command runs every
+    `CHAT_READ_POSITION_FLUSH_INTERVAL` seconds.
+    """
+    room_id = int(room_id)
+    if user.id not in Membership.get_member_ids(room_id):
+        return
+
+    marked = get_redis().eval(
+        MARK_READ_SCRIPT,
+        2,
+        positions_key(user.id),
+        PENDING_USERS_KEY,
+        room_id,
+        to_microseconds(timezone.now()),
+        user.id,
+    )
+    if marked:
+        # The unread count of the room changed in the room list of the user
+        bump_user_rooms_versions(user.id)
+
+
+def flush():
+    """Write the buffered read positions to the memberships. Returns the number of memberships updated."""
+    client = get_redis()
+    updated = 0
+    while user_ids := client.spop(PENDING_USERS_KEY, settings.CHAT_READ_POSITION_FLUSH_BATCH_SIZE):
+        with client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(positions_key(user_id))
+            buffered = pipe.execute()
+
+        positions = [
+            (int(user_id), int(room_id), from_microseconds(timestamp))
+            for user_id, user_positions in zip(user_ids, buffered)
+            for room_id, timestamp in user_positions.items()
+        ]
+        try:
+            updated += write_positions(positions)
+        except Exception:
+            client.sadd(PENDING_USERS_KEY, *user_ids)
+            raise
+
+        with client.pipeline(transaction=False) as pipe:
+            for user_id, user_positions in zip(user_ids, buffered):
+                pipe.eval(CLEAR_SCRIPT, 1, positions_key(user_id), *chain.from_iterable(user_positions.items()))
+            pipe.execute()
+    return updated
+
+
+def write_positions(positions):
+    """
+    Update the read positions of many memberships in a single statement, from (user id, room id, timestamp) tuples.
+    The newest position wins over the one stored, and the unread counters are recounted from it, as messages may have
+    been sent or deleted since the position was buffered.
+    """
+    if not positions:
+        return 0
+
+    values = ", ".join(["(%s, %s, %s::timestamptz)"] * len(positions))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {Membership._meta.db_table} AS membership
+            SET last_read_timestamp = position.timestamp, unread_count = (
+                SELECT count(*) FROM {Message._meta.db_table} AS message
+                WHERE message.room_id = membership.room_id AND message.timestamp > position.timestamp
+                    AND message.user_id <> membership.user_id
+            )
+            FROM (VALUES {values}) AS position (user_id, room_id, timestamp)
+            WHERE membership.user_id = position.user_id AND membership.room_id = position.room_id
+                AND membership.last_read_timestamp < position.timestamp
+            """,
+            list(chain.from_iterable(positions)),
+        )
+        return cursor.rowcount
+
+
+def get_read_positions(user_id) -> dict[int, datetime]:
+    """Read positions of the user not written to the database yet, by room id."""
+    return {
+        int(room_id): from_microseconds(timestamp)
+        for room_id, timestamp in get_redis().hgetall(positions_key(user_id)).items()
+    }
+
+
+def unread_since(user, room_id, timestamp):
+    messages = (
+        Message.objects.filter(room_id=room_id, timestamp__gt=timestamp)
+        .exclude(user=user)
+        .order_by()
+        .values("room")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    return Coalesce(Subquery(messages), 0)
+
+
+def unread_count_expression(user, stored_unread_count):
+    """
+    Unread count of `user` in the rooms of a `ChatRoom` queryset: `stored_unread_count`, the counter of the
+    membership, except in the rooms with a buffered read position, where the messages after it are counted instead.
+    """
+    positions = get_read_positions(user.id)
+    if not positions:
+        return stored_unread_count
+
+    return Case(
+        *(When(pk=room_id, then=unread_since(user, room_id, timestamp)) for room_id, timestamp in positions.items()),
+        default=stored_unread_count,
+        output_field=IntegerField(),
+    )
+
+
+def get_unread_count(user, room_id) -> int:
+    """Unread count of `user` in a room, taking the buffered read position into account."""
+    position = get_redis().hget(positions_key(user.id), room_id)
+    if position is not None:
+        return (
+            Message.objects.filter(room_id=room_id, timestamp__gt=from_microseconds(position))
+            .exclude(user=user)
+            .count()
+        )
+    return Membership.objects.filter(user=user, room_id=room_id).values_list("unread_count", flat=True).first() or 0
@@ -0,0 +1,24 @@
+import asyncio
+import weakref
+from functools import cache
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.asyncio.Redis] = weakref.WeakKeyDictionary()
+
+
+@cache
+def get_redis() -> redis.Redis:
+    """Client of the Redis database holding the short lived chat state shared by the server processes."""
+    return redis.Redis.from_url(settings.CHAT_REDIS_URL, decode_responses=True)
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """Async version of `get_redis`. Connections can't be shared between event loops, so each loop has its client."""
+    loop = asyncio.get_running_loop()
+    client = async_clients.get(loop)
+    if client is None:
+        client = async_clients[loop] = redis.asyncio.Redis.from_url(settings.CHAT_REDIS_URL, decode_responses=True)
+    return client
@@ -0,0 +1,87 @@
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from rest_framework.exceptions import Throttled
+
+from chat.utils.image import render_media_renditions
+
+from .image_jobs import image_jobs
+from .models import MessageMedia
+from .timing import section
+from .versions import bump_room_versions
+
+logger = logging.getLogger(__name__)
+
+# The WebP renditions of a chat image, stored in the MessageMedia fields of the same name
+RENDITIONS = ("bubble", "full")
+
+
+def rendition_sizes():
+    """Size of the square each rendition is scaled down to fit in."""
+    return {"bubble": settings.CHAT_MEDIA_BUBBLE_SIZE, "full": settings.CHAT_MEDIA_FULL_SIZE}
+
+
+@section("image")
+def generate_renditions(media: MessageMedia):
+    """
+    Generate the placeholder and WebP renditions of a chat image that was just uploaded.
+
+    They are generated in the image pool when there are image workers, and right away otherwise. When the pool is
+    full the image is left without renditions, to be picked up later by the `generate_media_renditions` command.
+    """
+    with media.file.open("rb"):
+        data = media.file.read()
+
+    if not settings.CHAT_IMAGE_WORKERS:
+        store_renditions(media.pk, media.file.name, render_media_renditions(data, rendition_sizes()))
+        media.refresh_from_db()
+        return
+
+    try:
+        image_jobs.submit(
+            render_media_renditions,
+            data,
+            rendition_sizes(),
+            on_done=lambda future: finish_renditions(future, media.pk, media.file.name),
+        )
+    except Throttled:
+        logger.warning("The image pool is full, skipped the renditions of media %s", media.pk)
+
+
+def finish_renditions(future, pk, source_name):
+    try:
+        store_renditions(pk, source_name, future.result())
+    except Exception:
+        logger.exception("Failed to generate the renditions of media %s", pk)
+    finally:
+        # This runs in a completion thread of the image jobs, outside of any request
+        close_old_connections()
+
+
+def store_renditions(pk, source_name, renditions):
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    fields = {key: renditions[key] for key in ("width", "height", "placeholder")}
+    for name in RENDITIONS:
+        if name not in renditions:
+            continue
+
+        content, width, height = renditions[name]
+        field = MessageMedia._meta.get_field(name)
+        fields[name] = field.storage.save(field.generate_filename(None, f"{stem}.webp"), ContentFile(content))
+        fields[f"{name}_width"] = width
+        fields[f"{name}_height"] = height
+
+    if not MessageMedia.objects.filter(pk=pk).update(**fields):
+        # The media was deleted while its renditions were being generated
+        for name in RENDITIONS:
+            if name in fields:
+                MessageMedia._meta.get_field(name).storage.delete(fields[name])
+        return
+
+    # Saved with an update, which doesn't send the post_save signal bumping the version of the room
+    room_id = MessageMedia.objects.filter(pk=pk).values_list("message__room_id", flat=True).first()
+    if room_id is not None:
+        bump_room_versions(room_id)
@@ -0,0 +1,49 @@
+from html import escape
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+
+from .models import MESSAGE_SEARCH_CONFIG, Membership, Message
+
+# Delimiters of the matches in the headlines computed by the database. Control characters don't occur in the messages
+# written by people, so they can be told apart from the content, which is escaped before they become <mark> tags.
+HEADLINE_START = "\x02"
+HEADLINE_STOP = "\x03"
+
+
+def search_messages(user, q, room=None, author=None, since=None, until=None):
+    """
+    Full-text search over the messages of the rooms `user` is a member of, optionally only in `room`, written by the
+    user named `author`, or sent between `since` and `until`.
+
+    `q` is parsed like a web search query (quoted phrases, `or`, `-word`). The matches come from the GIN index on
+    `Message.search_vector`, annotated with their `rank` and a `headline` of the content around the matched words.
+    """
+    query = SearchQuery(q, search_type="websearch", config=MESSAGE_SEARCH_CONFIG)
+    queryset = Message.objects.filter(
+        room_id__in=Membership.objects.filter(user=user).values("room_id"), search_vector=query
+    )
+
+    if room is not None:
+        queryset = queryset.filter(room_id=room)
+    if author is not None:
+        queryset = queryset.filter(user__username=author)
+    if since is not None:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until is not None:
+        queryset = queryset.filter(timestamp__lt=until)
+
+    return queryset.annotate(
+        # As a double, like the ranks of the pagination cursors, which wouldn't compare equal to the real computed by
+        # the database otherwise
+        rank=Cast(SearchRank(F("search_vector"), query), FloatField()),
+        headline=SearchHeadline(
+            "content", query, config=MESSAGE_SEARCH_CONFIG, start_sel=HEADLINE_START, stop_sel=HEADLINE_STOP
+        ),
+    )
+
+
+def highlight(headline):
+    """Render a headline of `search_messages` as HTML, with the matched words in <mark> tags."""
+    return escape(headline).replace(HEADLINE_START, "<mark>").replace(HEADLINE_STOP, "</mark>")
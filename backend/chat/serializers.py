@@ -1,15 +1,50 @@
+from contextlib import nullcontext
 from typing import Any, override
 
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.manager import BaseManager
 from rest_framework import serializers
 
-from chat.utils.image import crop_avatar_img
+from chat.utils.image import validate_image_pixels
 
+from .avatars import crop_avatar
 from .models import (ChatRoom, ChatRoomInvitation, Membership, Message,
                      MessageMedia, MessageReaction, Profile)
+from .read_positions import get_unread_count
+from .search import highlight
+from .timing import section
+from .user_payloads import (aget_user_payloads, aset_user_payloads,
+                            get_user_payloads, set_user_payloads)
 
 
-class ProfileSerializer(serializers.ModelSerializer[Profile]):
+class TimedSerializerMixin:
+    """
+    Count the rendering of the serializer in the "serialize" metric of the current timing, see `chat.timing`. Only the
+    top level serializers go through `data`, the nested ones are rendered by their parent's `to_representation`.
+    """
+
+    @property
+    def data(self):
+        with section("serialize"):
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class PendingAvatarMixin:
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if getattr(instance, "avatar_pending", False):
+            # The new avatar is still being processed, an `avatar_updated` event is sent when it replaces this one
+            data["avatar_status"] = "pending"
+        return data
+
+
+class ProfileSerializer(PendingAvatarMixin, serializers.ModelSerializer[Profile]):
     class Meta:
         model = Profile
         fields = ("bio", "avatar_img")
@@ -17,15 +52,31 @@ class ProfileSerializer(serializers.ModelSerializer[Profile]):
     def validate_avatar_img(self, value):
         if value.size > 5 * 1024 * 1024:  # 5MB
             raise serializers.ValidationError("File exceeded the 5MB limit.")
+        validate_image_pixels(value)
         return value
 
 
-class UserSerializer(serializers.ModelSerializer[User]):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer[User]):
     profile = ProfileSerializer(required=False)
 
     class Meta:
         model = User
         fields = ("id", "username", "is_superuser", "profile")
+        list_serializer_class = TimedListSerializer
+
+    @override
+    def to_representation(self, instance):
+        payloads = self.context.get("user_payloads")
+        if payloads is None or instance.pk not in payloads:
+            return super().to_representation(instance)
+
+        payload = payloads[instance.pk]
+        profile = payload.get("profile")
+        request = self.context.get("request")
+        if request is None or not profile or not profile["avatar_img"]:
+            return payload
+        # Cached with a relative URL, so the payload can be shared by every request
+        return {**payload, "profile": {**profile, "avatar_img": request.build_absolute_uri(profile["avatar_img"])}}
 
     @override
     def update(self, instance, validated_data: dict[Any, Any]):
@@ -37,6 +88,7 @@ class UserSerializer(serializers.ModelSerializer[User]):
         instance.username = validated_data.get("username", instance.username)
         request = self.context.get("request")
 
+        avatar_crop = None
         profile_data = validated_data.pop("profile")
         if profile_data:
             request = self.context.get("request")
@@ -52,17 +104,38 @@ class UserSerializer(serializers.ModelSerializer[User]):
                     "container_width": int(request.data.get("crop_container_width")),
                     "container_height": int(request.data.get("crop_container_height")),
                 }
-                profile.avatar_img = crop_avatar_img(
-                    profile_data.get("avatar_img"), f"avatar_{request.data.get("username")}", crop_data
-                )
+                avatar_crop = (profile_data.get("avatar_img"), f"avatar_{request.data.get("username")}", crop_data)
             else:
                 profile.avatar_img = profile_data.get("avatar_img", profile.avatar_img)
 
-        instance.save()
+        with crop_avatar(instance.profile, *avatar_crop, request) if avatar_crop else nullcontext():
+            instance.save()
 
         return instance
 
 
+def prefetch_user_payloads(context, users):
+    """
+    Look up the `UserSerializer` payloads of `users` in the cache in a single round trip, for the serializers using
+    `context` to render them from. The users missing from the cache are rendered and cached. The context must not
+    outlive the request, as the payloads it holds aren't invalidated.
+    """
+    users = {user.pk: user for user in users}
+    payloads, versions = get_user_payloads(users)
+    missing = {pk: UserSerializer().to_representation(user) for pk, user in users.items() if pk not in payloads}
+    set_user_payloads(missing, versions)
+    context["user_payloads"] = {**context.get("user_payloads", {}), **payloads, **missing}
+
+
+async def aprefetch_user_payloads(context, users):
+    """Async version of `prefetch_user_payloads`, for the WebSocket consumers."""
+    users = {user.pk: user for user in users}
+    payloads, versions = await aget_user_payloads(users)
+    missing = {pk: UserSerializer().to_representation(user) for pk, user in users.items() if pk not in payloads}
+    await aset_user_payloads(missing, versions)
+    context["user_payloads"] = {**context.get("user_payloads", {}), **payloads, **missing}
+
+
 class RepliedMessageSerializer(serializers.ModelSerializer[Message]):
     user = UserSerializer(read_only=True)
 
@@ -71,27 +144,61 @@ class RepliedMessageSerializer(serializers.ModelSerializer[Message]):
         fields = ("id", "user", "content")
 
 
-class MessageMediaSerializer(serializers.ModelSerializer[MessageMedia]):
+class MessageMediaSerializer(TimedSerializerMixin, serializers.ModelSerializer[MessageMedia]):
     class Meta:
         model = MessageMedia
-        fields = ("id", "file")
+        fields = (
+            "id",
+            "file",
+            "width",
+            "height",
+            "placeholder",
+            "bubble",
+            "bubble_width",
+            "bubble_height",
+            "full",
+            "full_width",
+            "full_height",
+        )
+        read_only_fields = (
+            "width",
+            "height",
+            "placeholder",
+            "bubble",
+            "bubble_width",
+            "bubble_height",
+            "full",
+            "full_width",
+            "full_height",
+        )
+        list_serializer_class = TimedListSerializer
 
     def validate_file(self, value):
         if value.size > 10 * 1024 * 1024:  # 10MB
             raise serializers.ValidationError("File exceeded the 10MB limit.")
+        validate_image_pixels(value)
         return value
 
 
-class MessageReactionSerializer(serializers.ModelSerializer[MessageReaction]):
+class MessageReactionSerializer(TimedSerializerMixin, serializers.ModelSerializer[MessageReaction]):
     user = UserSerializer(read_only=True)
 
     class Meta:
         model = MessageReaction
         fields = ("id", "emoji", "user", "message", "created_at")
         read_only_fields = ("id", "user", "message")
+        list_serializer_class = TimedListSerializer
 
 
-class MessageSerializer(serializers.ModelSerializer[Message]):
+class MessageListSerializer(TimedListSerializer):
+    @override
+    def to_representation(self, data):
+        messages = list(data.all() if isinstance(data, BaseManager) else data)
+        prefetch_user_payloads(self.context, MessageSerializer.rendered_users(messages))
+        return super().to_representation(messages)
+
+
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer[Message]):
     user = UserSerializer(read_only=True)
     reply_to = RepliedMessageSerializer(read_only=True)
     reply_to_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
@@ -114,6 +221,31 @@ class MessageSerializer(serializers.ModelSerializer[Message]):
             "reactions",
         ]
         read_only_fields = ("user", "reply_to", "media")
+        list_serializer_class = MessageListSerializer
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Load everything this serializer renders (authors, replied messages, media and reactions with their users)
+        up front, so serializing any number of messages costs a fixed number of queries.
+        """
+        return (
+            queryset.select_related("user__profile", "reply_to__user__profile")
+            .defer("search_vector", "reply_to__search_vector")
+            .prefetch_related(
+                "media",
+                Prefetch("reactions", queryset=MessageReaction.objects.select_related("user__profile")),
+            )
+        )
+
+    @staticmethod
+    def rendered_users(messages):
+        """The users rendered with the messages: the authors of the messages, of the replied messages and reactions."""
+        for message in messages:
+            yield message.user
+            if message.reply_to is not None:
+                yield message.reply_to.user
+            yield from (reaction.user for reaction in message.reactions.all())
 
     def validate(self, data):
         content = data.get("content")
@@ -135,11 +267,15 @@ class MessageSerializer(serializers.ModelSerializer[Message]):
             except Message.DoesNotExist:
                 raise serializers.ValidationError({"reply_to_id": "Referenced message does not exist."})
 
-        message = super().create(validated_data)
+        with transaction.atomic():
+            message = super().create(validated_data)
+
+            attached_media = 0
+            if media_ids:
+                media = MessageMedia.objects.filter(id__in=media_ids, message__isnull=True)
+                attached_media = media.update(message=message)
 
-        if media_ids:
-            media = MessageMedia.objects.filter(id__in=media_ids, message__isnull=True)
-            media.update(message=message)
+            Message.record_created([message], with_media={message.pk} if attached_media else set())
 
         return message
 
@@ -158,34 +294,86 @@ class MessageSerializer(serializers.ModelSerializer[Message]):
         else:
             validated_data["reply_to"] = None
 
-        message = super().update(instance, validated_data)
+        with transaction.atomic():
+            message = super().update(instance, validated_data)
 
-        if reaction:
-            MessageReaction.objects.create(
-                message=message,
-                emoji=reaction,
-            )
+            if reaction:
+                MessageReaction.objects.create(
+                    message=message,
+                    emoji=reaction,
+                )
 
-        if media_ids:
-            media = MessageMedia.objects.filter(id__in=media_ids, message__isnull=True)
-            media.update(message=message)
+            if media_ids:
+                media = MessageMedia.objects.filter(id__in=media_ids, message__isnull=True)
+                media.update(message=message)
+
+            ChatRoom.refresh_edited_last_message(message)
 
         return message
 
 
+class SendMessageSerializer(serializers.Serializer):
+    """Validates the `send_message` WebSocket event, which creates a message without going through the REST API."""
+
+    room = serializers.IntegerField()
+    content = serializers.CharField(required=False, allow_blank=True, default="")
+    reply_to_id = serializers.IntegerField(required=False, allow_null=True, default=None)
+    media_ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, data):
+        if not data["content"] and not data["media_ids"]:
+            raise serializers.ValidationError("Message must have content or at least one media file.")
+        return data
+
+
+class MessageSearchSerializer(serializers.Serializer):
+    """Validates the query parameters of the message search, see `search_messages`."""
+
+    q = serializers.CharField(max_length=200)
+    room = serializers.IntegerField(required=False)
+    author = serializers.CharField(required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    ordering = serializers.ChoiceField(choices=("rank", "newest"), default="rank")
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    """A message matching a search, with its rank and the content around the matched words as HTML."""
+
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.SerializerMethodField()
+
+    class Meta(MessageSerializer.Meta):
+        fields = [*MessageSerializer.Meta.fields, "rank", "headline"]
+
+    def get_headline(self, obj):
+        return highlight(obj.headline)
+
+
 class MembershipSerializer(serializers.ModelSerializer):
     class Meta:
         model = Membership
         fields = ("user", "room", "is_admin")
 
 
-class ChatRoomInvitationSerializer(serializers.ModelSerializer[ChatRoomInvitation]):
+class ChatRoomInvitationSerializer(TimedSerializerMixin, serializers.ModelSerializer[ChatRoomInvitation]):
     class Meta:
         model = ChatRoomInvitation
         fields = ("token",)
 
 
-class ChatRoomSerializer(serializers.ModelSerializer[ChatRoom]):
+class ChatRoomListSerializer(TimedListSerializer):
+    @override
+    def to_representation(self, data):
+        rooms = list(data.all() if isinstance(data, BaseManager) else data)
+        recipients = (
+            membership.user for room in rooms if room.is_dm for membership in getattr(room, "dm_memberships", ())
+        )
+        prefetch_user_payloads(self.context, recipients)
+        return super().to_representation(rooms)
+
+
+class ChatRoomSerializer(TimedSerializerMixin, PendingAvatarMixin, serializers.ModelSerializer[ChatRoom]):
     owner = serializers.ReadOnlyField(source="owner.username")
     last_message = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
@@ -209,64 +397,76 @@ class ChatRoomSerializer(serializers.ModelSerializer[ChatRoom]):
             "member_count",
             "is_member",
         )
+        list_serializer_class = ChatRoomListSerializer
 
     def validate_avatar_img(self, value):
         if value.size > 5 * 1024 * 1024:  # 5MB
             raise serializers.ValidationError("File exceeded the 5MB limit.")
+        validate_image_pixels(value)
         return value
 
-    def get_last_message(self, obj):
-        last_message = obj.messages.last()
-        if not last_message:
+    def get_last_message(self, obj: ChatRoom):
+        if obj.last_message_timestamp is None:
             return None
 
         content = ""
-        media_exists = last_message.media.exists()
-        if media_exists and last_message.content:
-            content = f"📷 {last_message.content}"
-        elif media_exists:
+        if obj.last_message_has_media and obj.last_message_preview:
+            content = f"📷 {obj.last_message_preview}"
+        elif obj.last_message_has_media:
             content = "📷 Media"
         else:
-            content = last_message.content
+            content = obj.last_message_preview
 
-        return {"username": last_message.user.username, "message": content, "timestamp": last_message.timestamp}
+        username = obj.last_message_user.username if obj.last_message_user else None
+        return {"username": username, "message": content, "timestamp": obj.last_message_timestamp}
 
     def get_unread_count(self, obj: ChatRoom) -> int:
         user = self.context["request"].user
         if not user.is_authenticated:
             return 0
 
-        try:
-            membership = Membership.objects.get(user=user, room=obj)
-            last_read = membership.last_read_timestamp
-            return Message.objects.filter(room=obj, timestamp__gt=last_read).exclude(user=user).count()
-        except Membership.DoesNotExist:
-            return 0
+        if hasattr(obj, "unread_count"):
+            return obj.unread_count
+
+        return get_unread_count(user, obj.id)
 
     def get_dm_recipient(self, obj: ChatRoom):
         if not obj.is_dm:
             return None
 
         request_user = self.context["request"].user
-        members = obj.members.all()
-        if members.count() == 1:
-            # Messaging yourself
-            recipient = members.first()
+        if hasattr(obj, "dm_memberships"):
+            members = [membership.user for membership in obj.dm_memberships]
+            if len(members) == 1:
+                # Messaging yourself
+                recipient = members[0]
+            else:
+                # Messaging another user
+                recipient = next((member for member in members if member.id != request_user.id), None)
         else:
-            # Messaging another user
-            recipient = members.exclude(id=request_user.id).first()
+            members = obj.members.all()
+            if members.count() == 1:
+                # Messaging yourself
+                recipient = members.first()
+            else:
+                # Messaging another user
+                recipient = members.exclude(id=request_user.id).first()
 
         if recipient:
             return UserSerializer(recipient, context=self.context).data
         return None
 
     def get_member_count(self, obj: ChatRoom) -> int:
+        if hasattr(obj, "member_count"):
+            return obj.member_count
         return obj.members.count()
 
     def get_is_member(self, obj: ChatRoom) -> bool:
         user = self.context["request"].user
         if not user.is_authenticated:
             return False
+        if hasattr(obj, "is_member"):
+            return obj.is_member
         return obj.members.filter(id=user.id).exists()
 
     @override
@@ -277,6 +477,7 @@ class ChatRoomSerializer(serializers.ModelSerializer[ChatRoom]):
         request = self.context.get("request")
         avatar_img_file = validated_data.get("avatar_img")
 
+        crop_data = None
         if avatar_img_file and request:
             if "crop_x" in request.data:
                 crop_data = {
@@ -287,11 +488,16 @@ class ChatRoomSerializer(serializers.ModelSerializer[ChatRoom]):
                     "container_width": int(request.data.get("crop_container_width")),
                     "container_height": int(request.data.get("crop_container_height")),
                 }
-                instance.avatar_img = crop_avatar_img(avatar_img_file, f"room_avatar_{instance.id}", crop_data)
             else:
                 instance.avatar_img = avatar_img_file
 
-        instance.save()
+        with (
+            crop_avatar(instance, avatar_img_file, f"room_avatar_{instance.id}", crop_data, request)
+            if crop_data
+            else nullcontext()
+        ):
+            instance.save()
+
         return instance
 
 
@@ -1,3 +1,1055 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from difflib import unified_diff
+from io import BytesIO
+from threading import BoundedSemaphore, Event, current_thread
+from unittest.mock import patch
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels_redis.core import RedisChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from .avatars import avatar_job_cache_key, finish_avatar_crop
+from .batching import FrameBatcher, MessageBatcher, create_messages
+from .consumers import UserChatConsumer
+from .delivery import group_send_many, room_group_name, user_group_name
+from .image_jobs import ImageJobPool, image_jobs
+from .models import ChatRoom, ChatRoomInvitation, Membership, Message, MessageMedia, MessageReaction, Profile
+from .pagination import newer_than, older_than
+from .presence import ONLINE_USERS_KEY, connections_key, get_online_member_ids, presence, room_online_key
+from .protocol import MSGPACK_SUBPROTOCOL, encode_payload, event_payload
+from .read_positions import flush, positions_key
+from .redis import get_redis
+from .serializers import MessageSerializer, prefetch_user_payloads
+from .timing import add_query_recorder, current_timing, measure, record_query
+from .user_payloads import user_payload_version_key
+from .versions import room_version_key, user_rooms_version_key
+
+# Literals replaced in the SQL of the query diffs, which only differ by the ids of the rows otherwise
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+# Number of users, rooms and messages each batch of fixtures adds, see `QueryBudgetTests.seed`
+BATCH_SIZE = 5
+
+
+def normalize_sql(sql):
+    return SQL_LITERALS.sub("?", sql)
+
+
+# The cached membership indexes and user payloads are keyed by ids, which the test database reuses between runs
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class QueryBudgetTests(TestCase):
+    """
+    Every REST endpoint runs a fixed number of queries, whatever the number of rooms, members, messages, replies, media
+    and reactions it renders. The budgets are checked before and after growing the fixtures, so N+1 queries fail the
+    tests with the queries they added.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.batches = 0
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room, is_admin=True)
+        Membership.objects.create(user=self.bob, room=self.room)
+        self.dm = ChatRoom.objects.create(name=f"dm_{self.alice.id}_{self.bob.id}", is_dm=True, is_private=True)
+        self.dm.members.add(self.alice, self.bob)
+        self.message = Message.objects.create(room=self.room, user=self.bob, content="hello everyone")
+        self.invitation = ChatRoomInvitation.objects.create(room=self.room, created_by=self.alice)
+        self.seed()
+        self.client = self.client_for(self.alice)
+
+    def seed(self):
+        """
+        Add a batch of fixtures rendered by the endpoints: members of the room, public, private and DM rooms of alice,
+        messages replying to each other with media, and reactions.
+        """
+        batch = self.batches = self.batches + 1
+        users = [User.objects.create_user(f"user-{batch}-{i}") for i in range(BATCH_SIZE)]
+        Membership.objects.bulk_create(
+            [Membership(user=user, room=self.room, is_admin=i == 0) for i, user in enumerate(users)]
+        )
+
+        for i, user in enumerate(users):
+            public = ChatRoom.objects.create(name=f"public-{batch}-{i}", owner=user)
+            private = ChatRoom.objects.create(name=f"private-{batch}-{i}", owner=user, is_private=True)
+            dm = ChatRoom.objects.create(name=f"dm_{self.alice.id}_{user.id}", is_dm=True, is_private=True)
+            Membership.objects.bulk_create(
+                [
+                    Membership(user=user, room=public),
+                    Membership(user=user, room=private),
+                    Membership(user=self.alice, room=private),
+                    Membership(user=self.alice, room=dm),
+                    Membership(user=user, room=dm),
+                ]
+            )
+            Message.record_created(
+                [Message.objects.create(room=room, user=user, content="hi") for room in (public, dm)]
+            )
+
+        messages = []
+        reply_to = self.message
+        for user in users:
+            reply_to = Message.objects.create(room=self.room, user=user, content="hello again", reply_to=reply_to)
+            messages.append(reply_to)
+        MessageMedia.objects.bulk_create(
+            [MessageMedia(message=message, file=f"chat_media/{message.id}.png") for message in messages]
+        )
+        MessageReaction.objects.bulk_create(
+            [MessageReaction(message=message, user=user, emoji="👍") for message in messages for user in users]
+            + [MessageReaction(message=self.message, user=user, emoji="🎉") for user in users]
+        )
+        Message.record_created(messages, with_media={message.id for message in messages})
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def new_member(self, room=None):
+        user = User.objects.create_user(f"member-{User.objects.count()}")
+        if room is not None:
+            Membership.objects.create(user=user, room=room)
+        return user
+
+    def capture(self, request, prepare):
+        args = prepare() if prepare else ()
+        with CaptureQueriesContext(connection) as queries:
+            response = request(*args)
+        self.assertLess(response.status_code, 400, getattr(response, "data", response))
+        return response, [query["sql"] for query in queries.captured_queries]
+
+    def assertQueryBudget(self, budget, request, prepare=None):
+        """
+        Assert that `request` runs at most `budget` queries, and no more once the fixtures grew. The request is made a
+        first time to fill the caches, the queries of the following requests are counted.
+
+        Requests that change the data get a fresh setup from `prepare`, whose return values are passed to `request`.
+        """
+        self.capture(request, prepare)
+        _, before = self.capture(request, prepare)
+        self.seed()
+        self.capture(request, prepare)
+        response, after = self.capture(request, prepare)
+
+        endpoint = f"{response.wsgi_request.method} {response.wsgi_request.get_full_path()}"
+        if len(after) > len(before):
+            diff = unified_diff(
+                [normalize_sql(sql) for sql in before],
+                [normalize_sql(sql) for sql in after],
+                "before the fixtures grew",
+                "after",
+                lineterm="",
+            )
+            self.fail(
+                f"{endpoint} ran {len(before)} queries, then {len(after)} with more data (budget {budget}):\n"
+                + "\n".join(diff)
+            )
+        if len(after) > budget:
+            executed = "\n".join(f"{i}. {sql}" for i, sql in enumerate(after, start=1))
+            self.fail(f"{endpoint} ran {len(after)} queries, over its budget of {budget}:\n{executed}")
+
+    # Rooms
+
+    def test_room_list(self):
+        self.assertQueryBudget(3, lambda: self.client.get("/api/rooms/"))
+
+    def test_room_detail(self):
+        self.assertQueryBudget(2, lambda: self.client.get(f"/api/rooms/{self.room.id}/"))
+
+    def test_room_create(self):
+        self.assertQueryBudget(
+            7,
+            lambda name: self.client.post("/api/rooms/", {"name": name}),
+            lambda: (f"room-{ChatRoom.objects.count()}",),
+        )
+
+    def test_room_members(self):
+        self.assertQueryBudget(3, lambda: self.client.get(f"/api/rooms/{self.room.id}/members/"))
+
+    def test_dm_members(self):
+        self.assertQueryBudget(3, lambda: self.client.get(f"/api/rooms/{self.dm.id}/members/"))
+
+    def test_room_presence(self):
+        self.assertQueryBudget(2, lambda: self.client.get(f"/api/rooms/{self.room.id}/presence/"))
+
+    def test_room_invite(self):
+        self.assertQueryBudget(4, lambda: self.client.post(f"/api/rooms/{self.room.id}/invite/"))
+
+    def test_room_update_admin(self):
+        self.assertQueryBudget(
+            7,
+            lambda: self.client.post(
+                f"/api/rooms/{self.room.id}/update-admin/", {"username": "bob", "is_admin": True}, format="json"
+            ),
+        )
+
+    def test_room_leave(self):
+        self.assertQueryBudget(
+            4,
+            lambda client: client.post(f"/api/rooms/{self.room.id}/leave/", format="json"),
+            lambda: (self.client_for(self.new_member(self.room)),),
+        )
+
+    # Messages
+
+    def test_message_list(self):
+        self.assertQueryBudget(3, lambda: self.client.get("/api/messages/", {"room": self.room.id}))
+
+    def test_message_list_before(self):
+        self.assertQueryBudget(
+            4,
+            lambda before: self.client.get("/api/messages/", {"room": self.room.id, "before": before}),
+            lambda: (ChatRoom.objects.get(pk=self.room.pk).last_message_id,),
+        )
+
+    def test_message_detail(self):
+        self.assertQueryBudget(3, lambda: self.client.get(f"/api/messages/{self.message.id}/"))
+
+    def test_message_search(self):
+        self.assertQueryBudget(3, lambda: self.client.get("/api/messages/search/", {"q": "hello"}))
+
+    def test_message_create(self):
+        self.assertQueryBudget(
+            11,
+            lambda: self.client.post(
+                "/api/messages/",
+                {"room": self.room.id, "content": "hello", "reply_to_id": self.message.id},
+                format="json",
+            ),
+        )
+
+    def test_message_update(self):
+        self.assertQueryBudget(
+            13,
+            lambda: self.client_for(self.bob).patch(
+                f"/api/messages/{self.message.id}/", {"content": "edited"}, format="json"
+            ),
+        )
+
+    def test_message_delete(self):
+        self.assertQueryBudget(
+            13,
+            lambda message: self.client.delete(f"/api/messages/{message.id}/"),
+            lambda: (Message.objects.create(room=self.room, user=self.alice, content="oops"),),
+        )
+
+    # Reactions
+
+    def test_reaction_list(self):
+        self.assertQueryBudget(2, lambda: self.client.get(f"/api/messages/{self.message.id}/reactions/"))
+
+    def test_reaction_create(self):
+        self.assertQueryBudget(
+            3,
+            lambda client: client.post(f"/api/messages/{self.message.id}/reactions/", {"emoji": "🔥"}, format="json"),
+            lambda: (self.client_for(self.new_member(self.room)),),
+        )
+
+    def test_reaction_delete(self):
+        self.assertQueryBudget(
+            4,
+            lambda reaction: self.client.delete(f"/api/messages/{self.message.id}/reactions/{reaction.id}/"),
+            lambda: (MessageReaction.objects.update_or_create(message=self.message, user=self.alice, emoji="🔥")[0],),
+        )
+
+    # Invitations
+
+    def test_invitation_details(self):
+        self.assertQueryBudget(2, lambda: APIClient().get(f"/api/invitations/{self.invitation.token}/details/"))
+
+    def test_invitation_join(self):
+        self.assertQueryBudget(
+            7,
+            lambda client: client.post(f"/api/invitations/{self.invitation.token}/join/"),
+            lambda: (self.client_for(self.new_member()),),
+        )
+
+    # Users
+
+    def test_user_list(self):
+        self.assertQueryBudget(2, lambda: self.client.get("/api/user/"))
+
+    def test_user_detail(self):
+        self.assertQueryBudget(1, lambda: self.client.get(f"/api/user/{self.bob.id}/"))
+
+    def test_user_detail_by_username(self):
+        self.assertQueryBudget(1, lambda: self.client.get("/api/user/bob/"))
+
+    def test_user_exists(self):
+        self.assertQueryBudget(1, lambda: APIClient().get("/api/user/exists/bob/"))
+
+    def test_start_dm(self):
+        self.assertQueryBudget(
+            11,
+            lambda user: self.client.post(f"/api/user/{user.id}/start-dm/"),
+            lambda: (self.new_member(),),
+        )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MessagePaginationTests(TestCase):
+    """The message history of a room is paginated by `(timestamp, id)` cursors, newest first."""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room)
+        self.messages = [
+            Message.objects.create(room=self.room, user=self.alice, content=f"message {i}") for i in range(7)
+        ]
+        # The middle messages are sent in the same instant, and ordered by id
+        start = timezone.now()
+        for i, message in enumerate(self.messages):
+            message.timestamp = start + timedelta(seconds=3 if 2 <= i <= 4 else i)
+        Message.objects.bulk_update(self.messages, ["timestamp"])
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def page(self, **params):
+        response = self.client.get("/api/messages/", {"room": self.room.id, "limit": 3, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def ids(self, page):
+        return [message["id"] for message in page["results"]]
+
+    def test_walk_history(self):
+        expected = [message.id for message in reversed(self.messages)]
+        page = self.page()
+        seen = self.ids(page)
+        self.assertIsNone(page["previous"])
+        while page["next"]:
+            page = self.client.get(page["next"]).data
+            seen.extend(self.ids(page))
+            self.assertIsNotNone(page["previous"])
+        self.assertEqual(seen, expected)
+
+    def test_after(self):
+        page = self.page(after=self.messages[1].id)
+        self.assertEqual(self.ids(page), [self.messages[4].id, self.messages[3].id, self.messages[2].id])
+        self.assertIn(f"before={self.messages[2].id}", page["next"])
+        self.assertIn(f"after={self.messages[4].id}", page["previous"])
+
+    def test_around(self):
+        page = self.page(around=self.messages[3].id)
+        self.assertEqual(self.ids(page), [self.messages[4].id, self.messages[3].id, self.messages[2].id])
+        self.assertIsNotNone(page["next"])
+        self.assertIsNotNone(page["previous"])
+
+    def test_cursor_starts_index_scan(self):
+        anchor = self.messages[3]
+        with connection.cursor() as cursor:
+            # The table is far too small for the planner to pick the index on its own
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+        for condition, ordering in (
+            (older_than(anchor.timestamp, anchor.pk), ("-timestamp", "-id")),
+            (older_than(anchor.timestamp, anchor.pk, inclusive=True), ("-timestamp", "-id")),
+            (newer_than(anchor.timestamp, anchor.pk), ("timestamp", "id")),
+        ):
+            plan = Message.objects.filter(condition, room=self.room).order_by(*ordering)[:4].explain()
+            self.assertIn("chat_message_room_ts_id_idx", plan)
+            self.assertRegex(plan, r"Index Cond: \(\(room_id = \d+\) AND \(\"?timestamp\"? [<>]= ")
+
+    def test_invalid_cursor(self):
+        other_room = ChatRoom.objects.create(name="other", owner=self.alice)
+        other = Message.objects.create(room=other_room, user=self.alice, content="elsewhere")
+        for cursor in ("nope", other.id):
+            response = self.client.get("/api/messages/", {"room": self.room.id, "before": cursor})
+            self.assertEqual(response.status_code, 404)
+
+
+async def connect(user, path="/ws/chat/", subprotocols=None):
+    communicator = WebsocketCommunicator(UserChatConsumer.as_asgi(), path, subprotocols=subprotocols)
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    # The connection is accepted before it joins its groups
+    await communicator.receive_nothing()
+    return communicator
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        self.room.members.add(self.alice, self.bob)
+
+    def test_send_message(self):
+        outsider = User.objects.create_user("outsider")
+
+        async def run():
+            alice, bob, intruder = await connect(self.alice), await connect(self.bob), await connect(outsider)
+            await asyncio.gather(
+                alice.send_json_to(
+                    {"type": "send_message", "client_id": "a", "message": {"room": self.room.id, "content": "hi"}}
+                ),
+                bob.send_json_to(
+                    {"type": "send_message", "client_id": "b", "message": {"room": self.room.id, "content": "hey"}}
+                ),
+            )
+            events = [await alice.receive_json_from(), await alice.receive_json_from()]
+            await intruder.send_json_to(
+                {"type": "send_message", "client_id": "c", "message": {"room": self.room.id, "content": "hi"}}
+            )
+            error = await intruder.receive_json_from()
+            for communicator in (alice, bob, intruder):
+                await communicator.disconnect()
+            return events, error
+
+        with patch("chat.batching.create_messages", wraps=create_messages) as batch:
+            events, error = async_to_sync(run)()
+
+        # Both messages are committed in the same batch
+        self.assertEqual(batch.call_count, 2)
+        self.assertEqual(len(batch.call_args_list[0].args[0]), 2)
+        self.assertEqual(
+            {(event["client_id"], event["message"]["content"]) for event in events}, {("a", "hi"), ("b", "hey")}
+        )
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(error["type"], "error")
+        self.assertEqual(error["event"], "send_message")
+        self.assertEqual(error["client_id"], "c")
+        self.assertIn("room", error["detail"])
+
+    def test_msgpack_clients(self):
+        async def run():
+            alice = await connect(self.alice, subprotocols=[MSGPACK_SUBPROTOCOL])
+            bob = await connect(self.bob, "/ws/chat/?batch=1", subprotocols=[MSGPACK_SUBPROTOCOL])
+            json_client = await connect(self.alice)
+            reaction = {"type": "add_message_reaction", "room": self.room.id, "message_id": 1, "emoji": "🔥"}
+            await alice.send_to(bytes_data=msgpack.packb(reaction))
+            events = [await alice.receive_from(), await bob.receive_from(), await json_client.receive_from()]
+            await json_client.send_json_to({"type": "start_typing", "room": self.room.id})
+            typing = await bob.receive_from(timeout=2)
+            for communicator in (alice, bob, json_client):
+                await communicator.disconnect()
+            return events, typing
+
+        (alice_frame, bob_frame, json_frame), typing = async_to_sync(run)()
+        reaction = {"type": "add_message_reaction", "room": self.room.id, "message_id": 1, "emoji": "🔥"}
+        # The frame of the sender is forwarded as is to the MessagePack clients, and converted for the JSON ones
+        self.assertEqual(msgpack.unpackb(alice_frame), reaction)
+        self.assertEqual(msgpack.unpackb(bob_frame), [reaction])
+        self.assertEqual(json.loads(json_frame), reaction)
+        self.assertEqual(msgpack.unpackb(typing)[0]["type"], "typing")
+
+    def test_delete_message_with_string_ids(self):
+        previous = Message.objects.create(room=self.room, user=self.alice, content="previous")
+        deleted = Message.objects.create(room=self.room, user=self.alice, content="deleted")
+        ChatRoom.record_last_message(deleted, False)
+        deleted_id = deleted.id
+        deleted.delete()
+        ChatRoom.refresh_last_message(self.room.id)
+
+        async def run():
+            alice, bob = await connect(self.alice), await connect(self.bob)
+            await alice.send_json_to(
+                {"type": "delete_message", "message_id": str(deleted_id), "room": str(self.room.id)}
+            )
+            event = await bob.receive_json_from()
+            await alice.disconnect()
+            await bob.disconnect()
+            return event
+
+        event = async_to_sync(run)()
+        self.assertEqual(event["message_id"], deleted_id)
+        self.assertEqual(event["last_message"]["content"], previous.content)
+
+    def test_forwarded_events_skip_closing_old_connections(self):
+        async def run():
+            bob = await connect(self.bob)
+            with patch("channels.consumer.aclose_old_connections") as close_old_connections:
+                await get_channel_layer().group_send(
+                    room_group_name(self.room.id), {"type": "chat.typing", "payload": "{}"}
+                )
+                await bob.receive_from()
+                self.assertFalse(close_old_connections.called)
+
+                await bob.send_json_to({"type": "start_typing", "room": self.room.id})
+                await bob.receive_nothing()
+                self.assertTrue(close_old_connections.called)
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_IMAGE_WORKERS=1,
+)
+class AvatarCropTests(TestCase):
+    crop = {
+        "crop_x": "0",
+        "crop_y": "0",
+        "crop_scale": "1",
+        "crop_size": "64",
+        "crop_container_width": "100",
+        "crop_container_height": "100",
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room, is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def upload(self):
+        image = BytesIO()
+        Image.new("RGB", (100, 100), "red").save(image, "PNG")
+        return SimpleUploadedFile("avatar.png", image.getvalue(), content_type="image/png")
+
+    def test_full_pool_saves_nothing(self):
+        slots = BoundedSemaphore(1)
+        slots.acquire()
+        with patch.object(image_jobs, "slots", slots):
+            response = self.client.patch(
+                f"/api/rooms/{self.room.id}/",
+                {"name": "renamed", "avatar_img": self.upload(), **self.crop},
+                format="multipart",
+            )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).name, "general")
+        self.assertIsNone(cache.get(avatar_job_cache_key(self.room)))
+
+    def test_failed_crop_is_announced(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(room_group_name(self.room.id), channel)
+        job_key = avatar_job_cache_key(self.room)
+        cache.set(job_key, "job")
+        future = Future()
+        future.set_exception(OSError("broken image"))
+
+        # The pool thread closes its connections when done, which would be the connection of the test
+        with self.assertLogs("chat.avatars", "ERROR"), patch("chat.avatars.close_old_connections"):
+            finish_avatar_crop(future, ChatRoom, self.room.pk, job_key, "job", "avatar", "http://testserver/")
+
+        event = json.loads(async_to_sync(layer.receive)(channel)["payload"])
+        self.assertEqual(event["type"], "avatar_updated")
+        self.assertEqual(event["room"], self.room.pk)
+        self.assertIn("error", event)
+        self.assertIsNone(cache.get(job_key))
+
+
+class ImageJobPoolTests(SimpleTestCase):
+    def test_results_are_handled_off_the_pool_thread(self):
+        pool = ImageJobPool(1, 1)
+        workers = ThreadPoolExecutor(1, thread_name_prefix="worker")
+        self.addCleanup(workers.shutdown)
+        self.addCleanup(pool.completions.shutdown)
+        done = Event()
+        threads = []
+
+        def on_done(future):
+            threads.append(current_thread().name)
+            done.set()
+
+        # The worker processes are stood in for by a thread, which runs the done callbacks like the process pool's
+        with patch.object(pool, "get_executor", return_value=workers):
+            pool.submit(abs, -1, on_done=on_done)
+        self.assertTrue(done.wait(5))
+        self.assertTrue(threads[0].startswith("image-jobs"), threads)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room)
+        Membership.objects.create(user=self.bob, room=self.room)
+        # Read positions buffered by earlier runs, for users with the same ids
+        get_redis().delete(*(positions_key(user.id) for user in (self.alice, self.bob)))
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def send(self, user, content="hello"):
+        response = self.client_for(user).post("/api/messages/", {"room": self.room.id, "content": content})
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data["id"]
+
+    def unread_count(self, user):
+        rooms = self.client_for(user).get("/api/rooms/").data["results"]
+        return next(room["unread_count"] for room in rooms if room["id"] == self.room.id)
+
+    def test_messages_of_others_are_unread(self):
+        self.send(self.bob)
+        self.send(self.bob)
+        self.send(self.alice)
+        self.assertEqual(self.unread_count(self.alice), 2)
+        self.assertEqual(self.unread_count(self.bob), 1)
+
+    def test_deleted_messages_are_discounted(self):
+        self.send(self.bob)
+        message_id = self.send(self.bob)
+        self.client_for(self.bob).delete(f"/api/messages/{message_id}/")
+        self.assertEqual(self.unread_count(self.alice), 1)
+
+    def test_rebuild(self):
+        self.send(self.bob)
+        self.send(self.alice)
+        Membership.objects.update(unread_count=0)
+        Membership.rebuild_unread_counts()
+        self.assertEqual(self.unread_count(self.alice), 1)
+        self.assertEqual(self.unread_count(self.bob), 1)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ReadPositionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room)
+        Membership.objects.create(user=self.bob, room=self.room)
+        get_redis().delete(*(positions_key(user.id) for user in (self.alice, self.bob)))
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, count):
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        for i in range(count):
+            client.post("/api/messages/", {"room": self.room.id, "content": f"message {i}"})
+
+    def unread_counts(self):
+        """The unread count of alice in the room list, the room details and the membership."""
+        rooms = self.client.get("/api/rooms/").data["results"]
+        return (
+            next(room["unread_count"] for room in rooms if room["id"] == self.room.id),
+            self.client.get(f"/api/rooms/{self.room.id}/").data["unread_count"],
+            Membership.objects.get(user=self.alice, room=self.room).unread_count,
+        )
+
+    def test_reading_is_buffered(self):
+        self.send(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/messages/", {"room": self.room.id})
+        self.assertFalse([query for query in queries.captured_queries if query["sql"].startswith("UPDATE")])
+        self.assertIn(str(self.room.id), get_redis().hgetall(positions_key(self.alice.id)))
+        # Only the stored counter is stale until the position is flushed
+        self.assertEqual(self.unread_counts(), (0, 0, 3))
+
+    def test_buffered_and_flushed_counts_agree(self):
+        self.send(3)
+        self.client.get("/api/messages/", {"room": self.room.id})
+        self.send(2)
+        buffered = self.unread_counts()[:2]
+
+        flush()
+
+        self.assertEqual(get_redis().hgetall(positions_key(self.alice.id)), {})
+        self.assertEqual(buffered, (2, 2))
+        self.assertEqual(self.unread_counts(), (2, 2, 2))
+
+
+class CreateMessagesTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        Membership.objects.create(user=self.alice, room=self.room)
+
+    def test_invalid_submissions_are_rejected_alone(self):
+        results = create_messages(
+            [
+                (self.alice, {"room": self.room.id, "content": "hello"}, {}),
+                (self.alice, {"room": self.room.id, "content": ""}, {}),
+                (self.bob, {"room": self.room.id, "content": "not a member"}, {}),
+                (self.alice, {"room": self.room.id, "content": "reply", "reply_to_id": 10**9}, {}),
+            ]
+        )
+
+        self.assertEqual(results[0]["content"], "hello")
+        self.assertIn("non_field_errors", results[1].detail)
+        self.assertIn("room", results[2].detail)
+        self.assertIn("reply_to_id", results[3].detail)
+        self.assertEqual(Message.objects.get().content, "hello")
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).last_message_preview, "hello")
+
+    def test_without_context(self):
+        results = create_messages(
+            [
+                (self.alice, {"room": self.room.id, "content": "hello"}, None),
+                (self.alice, {"room": self.room.id, "content": "again"}, {}),
+            ]
+        )
+        self.assertEqual([result["content"] for result in results], ["hello", "again"])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_FLUSH_INTERVAL=0.1,
+)
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        self.room.members.add(self.alice, self.bob)
+        presence.connections.clear()
+        presence.changes.clear()
+        self.clear_presence(self.alice.id, self.bob.id)
+
+    def clear_presence(self, *user_ids):
+        # Presence recorded by earlier runs, for users and rooms with the same ids
+        redis = get_redis()
+        redis.delete(*(connections_key(user_id) for user_id in user_ids), room_online_key(self.room.id))
+        redis.zrem(ONLINE_USERS_KEY, *user_ids)
+
+    def test_diffs(self):
+        async def run():
+            alice = await connect(self.alice)
+            events = [await alice.receive_json_from(timeout=2)]
+            bob = await connect(self.bob)
+            events.append(await alice.receive_json_from(timeout=2))
+            await bob.disconnect()
+            events.append(await alice.receive_json_from(timeout=2))
+            await alice.disconnect()
+            return events
+
+        self.assertEqual(
+            [(event["room"], event["online"], event["offline"]) for event in async_to_sync(run)()],
+            [
+                (self.room.id, [self.alice.id], []),
+                (self.room.id, [self.bob.id], []),
+                (self.room.id, [], [self.bob.id]),
+            ],
+        )
+
+    @override_settings(CHAT_PRESENCE_SWEEP_BATCH_SIZE=2)
+    def test_sweep(self):
+        users = [User.objects.create_user(f"ghost-{i}") for i in range(5)]
+        self.room.members.add(*users)
+        self.clear_presence(*(user.id for user in users))
+        # Connections of a server process that died
+        expired = time.time() - 1
+        redis = get_redis()
+        for user in users:
+            redis.hset(connections_key(user.id), "dead", expired)
+            redis.zadd(ONLINE_USERS_KEY, {user.id: expired})
+            redis.zadd(room_online_key(self.room.id), {user.id: expired})
+
+        async_to_sync(presence.sweep)()
+
+        self.assertFalse({str(user.id) for user in users} & set(redis.zrange(ONLINE_USERS_KEY, 0, -1)))
+        self.assertEqual(redis.zcard(room_online_key(self.room.id)), 0)
+        self.assertEqual(presence.changes[self.room.id], {user.id: False for user in users})
+
+    def test_joining_and_leaving_rooms(self):
+        other_room = ChatRoom.objects.create(name="other", owner=self.bob)
+        self.addCleanup(get_redis().delete, room_online_key(other_room.id))
+
+        async def run():
+            alice = await connect(self.alice)
+            await alice.receive_json_from(timeout=2)
+            await sync_to_async(Membership.objects.create)(user=self.alice, room=other_room)
+            joined = await alice.receive_json_from(timeout=2)
+            online = await sync_to_async(get_online_member_ids)(other_room.id)
+            await sync_to_async(other_room.members.remove)(self.alice)
+            await alice.receive_nothing()
+            left_online = await sync_to_async(get_online_member_ids)(other_room.id)
+            await alice.disconnect()
+            return joined, online, left_online
+
+        joined, online, left_online = async_to_sync(run)()
+        self.assertEqual(joined, {"type": "presence", "room": other_room.id, "online": [self.alice.id], "offline": []})
+        self.assertEqual(online, {self.alice.id})
+        self.assertEqual(left_online, set())
+        self.assertEqual(presence.connections, {})
+
+
+class ProtocolTests(SimpleTestCase):
+    payload = {"type": "typing", "room": 1, "users": [{"id": 2, "username": "bob"}]}
+
+    def test_payloads_are_encoded_once(self):
+        self.assertEqual(encode_payload(self.payload), {"payload": json.dumps(self.payload)})
+        self.assertEqual(encode_payload(self.payload, text_data="{}"), {"payload": "{}"})
+        self.assertEqual(encode_payload(self.payload, bytes_data=b"\x80"), {"payload_bin": b"\x80"})
+
+    def test_event_payload(self):
+        for event in (
+            encode_payload(self.payload),
+            encode_payload(self.payload, bytes_data=msgpack.packb(self.payload)),
+        ):
+            self.assertEqual(json.loads(event_payload(event, binary=False)), self.payload)
+            self.assertEqual(msgpack.unpackb(event_payload(event, binary=True)), self.payload)
+
+
+class GroupSendManyTests(SimpleTestCase):
+    async def test_redis_channel_layer(self):
+        layer = RedisChannelLayer(hosts=settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"], prefix="test-delivery")
+        try:
+            channels = [await layer.new_channel() for _ in range(3)]
+            await layer.group_add(user_group_name(1), channels[0])
+            await layer.group_add(user_group_name(1), channels[1])
+            await layer.group_add(user_group_name(2), channels[2])
+
+            with patch.object(layer, "group_send") as group_send:
+                groups = [user_group_name(1), user_group_name(2), user_group_name(3)]
+                await group_send_many(layer, groups, {"type": "hi"})
+            group_send.assert_not_called()
+
+            for channel in channels:
+                self.assertEqual(await asyncio.wait_for(layer.receive(channel), 1), {"type": "hi"})
+        finally:
+            await layer.flush()
+
+
+class FrameBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.frames = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.frames.append(text_data if bytes_data is None else msgpack.unpackb(bytes_data))
+
+    async def test_window(self):
+        batcher = FrameBatcher(self.send, window=0.05, max_size=10)
+        await batcher.add('{"n": 1}')
+        await batcher.add('{"n": 2}')
+        self.assertEqual(self.frames, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.frames, ['[{"n": 1},{"n": 2}]'])
+
+    async def test_max_size(self):
+        batcher = FrameBatcher(self.send, window=10, max_size=2, binary=True)
+        for n in range(3):
+            await batcher.add(msgpack.packb({"n": n}))
+        self.assertEqual(self.frames, [[{"n": 0}, {"n": 1}]])
+        batcher.close()
+        await asyncio.sleep(0)
+        self.assertEqual(batcher.pending, [])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        self.room.members.add(self.alice, self.bob)
+        private = ChatRoom.objects.create(name="private", owner=self.bob, is_private=True)
+        private.members.add(self.bob)
+        Message.objects.create(room=private, user=self.bob, content="deploy the secret")
+        self.once = Message.objects.create(room=self.room, user=self.alice, content="the deploy <b>failed</b> & more")
+        self.twice = Message.objects.create(room=self.room, user=self.bob, content="deploy again, deploy now")
+        Message.objects.create(room=self.room, user=self.bob, content="unrelated")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        response = self.client.get("/api/messages/search/", params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def ids(self, results):
+        return [message["id"] for message in results["results"]]
+
+    def test_ranking(self):
+        results = self.search(q="deploy")
+        self.assertEqual(self.ids(results), [self.twice.id, self.once.id])
+        self.assertGreater(results["results"][0]["rank"], results["results"][1]["rank"])
+        self.assertEqual(self.ids(self.search(q="deploy", ordering="newest")), [self.twice.id, self.once.id])
+
+    def test_headline_is_escaped(self):
+        headline = self.search(q="failed")["results"][0]["headline"]
+        self.assertIn("<mark>failed</mark>", headline)
+        self.assertNotIn("<b>", headline)
+        self.assertIn("&amp;", headline)
+
+    def test_filters(self):
+        self.assertEqual(self.ids(self.search(q="deploy", author="alice")), [self.once.id])
+        self.assertEqual(self.ids(self.search(q="deploy -again")), [self.once.id])
+        self.assertEqual(self.ids(self.search(q="deploy", until=self.once.timestamp.isoformat())), [])
+
+    def test_pages(self):
+        first = self.search(q="deploy", limit=1)
+        second = self.client.get(first["next"]).data
+        self.assertEqual(self.ids(first) + self.ids(second), [self.twice.id, self.once.id])
+        self.assertIsNone(second["next"])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get("/api/messages/search/").status_code, 400)
+        self.assertEqual(self.client.get("/api/messages/search/", {"q": "deploy", "cursor": "nope"}).status_code, 404)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class UserPayloadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+
+    def payload(self):
+        context = {}
+        prefetch_user_payloads(context, [User.objects.select_related("profile").get(pk=self.alice.pk)])
+        return context["user_payloads"][self.alice.pk]
+
+    def test_cached_until_changed(self):
+        self.assertEqual(self.payload()["profile"]["bio"], "")
+        with self.captureOnCommitCallbacks(execute=True):
+            Profile.objects.filter(user=self.alice).update(bio="not invalidated")
+        self.assertEqual(self.payload()["profile"]["bio"], "")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.profile.bio = "hello"
+            self.alice.profile.save()
+        self.assertEqual(self.payload()["profile"]["bio"], "hello")
+
+    def test_invalidated_on_commit(self):
+        stale = User.objects.select_related("profile").get(pk=self.alice.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.alice.profile.bio = "hello"
+            self.alice.profile.save()
+            self.assertIsNone(cache.get(user_payload_version_key(self.alice.pk)))
+            # A concurrent request still reading the rows from before the commit caches them
+            prefetch_user_payloads({}, [stale])
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.payload()["profile"]["bio"], "hello")
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ETagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        self.room.members.add(self.alice, self.bob)
+        self.other_room = ChatRoom.objects.create(name="other", owner=self.bob)
+        self.other_room.members.add(self.bob)
+        self.message = Message.objects.create(room=self.room, user=self.bob, content="hello")
+        self.addCleanup(
+            get_redis().delete,
+            *(room_version_key(room.id) for room in (self.room, self.other_room)),
+            *(user_rooms_version_key(user.id) for user in (self.alice, self.bob)),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def get(self, path, etag=None, **params):
+        headers = {} if etag is None else {"If-None-Match": etag}
+        # Reading the messages moves the read position, whose version bump runs on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.get(path, params, headers=headers)
+
+    def change(self, func):
+        with self.captureOnCommitCallbacks(execute=True):
+            func()
+
+    def test_room_list(self):
+        etag = self.get("/api/rooms/")["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get("/api/rooms/", etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+        # The visible rooms are cached along with the versions they were loaded for
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.get("/api/rooms/", f"W/{etag}").status_code, 304)
+        self.assertEqual(self.get("/api/rooms/", etag, limit=1).status_code, 200)
+
+        self.change(lambda: Message.objects.create(room=self.room, user=self.bob, content="again"))
+        response = self.get("/api/rooms/", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_message_page(self):
+        etag = self.get("/api/messages/", room=self.room.id)["ETag"]
+        self.assertEqual(self.get("/api/messages/", etag, room=self.room.id).status_code, 304)
+
+        self.change(lambda: Message.objects.create(room=self.other_room, user=self.bob, content="elsewhere"))
+        self.assertEqual(self.get("/api/messages/", etag, room=self.room.id).status_code, 304)
+
+        def rename():
+            self.bob.username = "robert"
+            self.bob.save()
+
+        self.change(rename)
+        response = self.get("/api/messages/", etag, room=self.room.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"][0]["user"]["username"], "robert")
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CHAT_SERVER_TIMING=True,
+)
+class ServerTimingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # The app only instruments the connections when started with CHAT_SERVER_TIMING set
+        if record_query not in connection.execute_wrappers:
+            add_query_recorder(connection)
+            self.addCleanup(connection.execute_wrappers.remove, record_query)
+        self.alice = User.objects.create_user("alice")
+        self.room = ChatRoom.objects.create(name="general", owner=self.alice)
+        self.room.members.add(self.alice)
+        self.message = Message.objects.create(room=self.room, user=self.alice, content="hello")
+
+    def test_header(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        header = client.get("/api/rooms/")["Server-Timing"]
+        self.assertRegex(header, r'^db;dur=[\d.]+;desc="\d+ queries", serialize;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_only_chat_serializers_are_timed(self):
+        class OtherSerializer(serializers.Serializer):
+            name = serializers.CharField()
+
+        with measure("event") as timing:
+            OtherSerializer({"name": "other"}).data
+        self.assertEqual(timing.sections, {})
+
+        message = MessageSerializer.setup_eager_loading(Message.objects).get(pk=self.message.pk)
+        with measure("event") as timing:
+            MessageSerializer(message).data
+        self.assertEqual(list(timing.sections), ["serialize"])
+
+    async def test_batch_commit_is_not_timed(self):
+        batcher = MessageBatcher(0, 1)
+        timings = []
+
+        async def commit(batch):
+            timings.append(current_timing.get())
+            batch[0][-1].set_result(None)
+
+        with patch.object(batcher, "commit", commit), measure("event") as timing:
+            await batcher.submit(self.alice, {})
+        self.assertIsNotNone(timing)
+        self.assertEqual(timings, [None])
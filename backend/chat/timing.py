@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+# Timing of the request or WebSocket event being handled. It's copied along with the context into the threads running
+# the synchronous code (e.g. `sync_to_async`), so their queries are counted too.
+current_timing: ContextVar["Timing | None"] = ContextVar("current_timing", default=None)
+
+
+class Timing:
+    """Where the time of a request or WebSocket event went: the queries, the serializers and the image processing."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.total = None
+        self.query_count = 0
+        self.sql_time = 0.0
+        # Time of the sections, without the queries run inside them
+        self.sections = {}
+        self.active_sections = set()
+        # The CHAT_SLOW_REQUEST_QUERIES slowest queries, as a min-heap of (duration, sequence, sql)
+        self.slowest_queries = []
+        self.sequence = itertools.count()
+
+    def add_query(self, sql, duration):
+        self.query_count += 1
+        self.sql_time += duration
+        entry = (duration, next(self.sequence), sql)
+        if len(self.slowest_queries) < settings.CHAT_SLOW_REQUEST_QUERIES:
+            heapq.heappush(self.slowest_queries, entry)
+        elif self.slowest_queries and duration > self.slowest_queries[0][0]:
+            heapq.heapreplace(self.slowest_queries, entry)
+
+    @contextmanager
+    def section(self, name):
+        # Nested sections (e.g. a serializer rendering another one) are only counted once
+        if name in self.active_sections:
+            yield
+            return
+
+        self.active_sections.add(name)
+        start, sql_time = time.perf_counter(), self.sql_time
+        try:
+            yield
+        finally:
+            self.active_sections.discard(name)
+            elapsed = time.perf_counter() - start - (self.sql_time - sql_time)
+            self.sections[name] = self.sections.get(name, 0.0) + elapsed
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        if self.total >= settings.CHAT_SLOW_REQUEST_THRESHOLD:
+            slowest = sorted(self.slowest_queries, reverse=True)
+            logger.warning(
+                "Slow %s: %s, slowest queries:\n%s",
+                self.name,
+                self.summary(),
+                "\n".join(f"{duration * 1000:.1f}ms {sql}" for duration, _, sql in slowest),
+            )
+
+    def summary(self):
+        parts = [f"{self.total * 1000:.1f}ms total", f"{self.query_count} queries in {self.sql_time * 1000:.1f}ms"]
+        parts.extend(f"{name} {duration * 1000:.1f}ms" for name, duration in self.sections.items())
+        return ", ".join(parts)
+
+    def server_timing(self):
+        """Value of the Server-Timing header."""
+        metrics = [f'db;dur={self.sql_time * 1000:.1f};desc="{self.query_count} queries"']
+        metrics.extend(f"{name};dur={duration * 1000:.1f}" for name, duration in self.sections.items())
+        metrics.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+@contextmanager
+def measure(name):
+    """Time the request or event `name`, the `Timing` is logged when it's slower than CHAT_SLOW_REQUEST_THRESHOLD."""
+    if not settings.CHAT_SERVER_TIMING:
+        yield None
+        return
+
+    timing = Timing(name)
+    token = current_timing.set(timing)
+    try:
+        yield timing
+    finally:
+        current_timing.reset(token)
+        timing.finish()
+
+
+@contextmanager
+def section(name):
+    """Count the time spent in the block in the `name` metric of the current timing, if any."""
+    timing = current_timing.get()
+    if timing is None:
+        yield
+        return
+    with timing.section(name):
+        yield
+
+
+def record_query(execute, sql, params, many, context):
+    timing = current_timing.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        # Only the SQL is kept, the parameters may hold private data that doesn't belong in the logs
+        timing.add_query(sql, time.perf_counter() - start)
+
+
+def add_query_recorder(connection, **kwargs):
+    # The signal is sent again whenever the connection is reopened, the wrappers outlive it
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def detached_context():
+    """
+    Copy of the current context without the current timing, for the tasks shared by several requests or events, whose
+    queries don't belong to the one that happened to start them.
+    """
+    context = copy_context()
+    context.run(current_timing.set, None)
+    return context
+
+
+def install():
+    """Instrument the database connections for the timings. Only called with CHAT_SERVER_TIMING set."""
+    connection_created.connect(add_query_recorder)
+    for connection in connections.all(initialized_only=True):
+        add_query_recorder(connection)
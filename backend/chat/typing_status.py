@@ -0,0 +1,123 @@
+import asyncio
+import math
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .delivery import group_send_to_room
+from .models import Membership
+from .protocol import encode_payload
+from .redis import get_async_redis
+
+# Snapshot tasks waiting to run, referenced so they aren't garbage collected
+tasks = set()
+
+
+def typing_key(room_id):
+    """Hash of the users typing in the room, mapped to the time their typing status expires."""
+    return f"chat:typing:{room_id}"
+
+
+def snapshot_lock_key(room_id):
+    return f"chat:typing-snapshot:{room_id}"
+
+
+def expiry_lock_key(room_id):
+    return f"chat:typing-expiry:{room_id}"
+
+
+class TypingTracker:
+    """
+    Typing status of the user of a WebSocket connection.
+
+    The status is kept per room in Redis, and the changes are broadcast as a coalesced snapshot of the users typing in
+    the room (see `schedule_snapshot`) instead of an event per change. Starts are rate limited per connection: a
+    start within `CHAT_TYPING_MIN_INTERVAL` seconds of the previous one is dropped before reaching Redis. Typing isn't
+    broadcast at all in rooms with more than `CHAT_TYPING_MAX_MEMBERS` members.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        # Room id => time of the last start that reached Redis
+        self.rooms = {}
+
+    async def start(self, room_id):
+        now = time.monotonic()
+        last_start = self.rooms.get(room_id)
+        if last_start is not None and now - last_start < settings.CHAT_TYPING_MIN_INTERVAL:
+            return
+
+        member_ids = await Membership.aget_member_ids(room_id)
+        if self.user.id not in member_ids or len(member_ids) > settings.CHAT_TYPING_MAX_MEMBERS:
+            return
+
+        self.rooms[room_id] = now
+        redis = get_async_redis()
+        key = typing_key(room_id)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, self.user.username, time.time() + settings.CHAT_TYPING_TIMEOUT)
+            pipe.expire(key, math.ceil(settings.CHAT_TYPING_TIMEOUT) * 2)
+            added, _ = await pipe.execute()
+
+        # Starts that only refresh the expiration don't change the snapshot
+        if added:
+            await schedule_snapshot(room_id)
+
+    async def stop(self, room_id):
+        if self.rooms.pop(room_id, None) is None:
+            return
+
+        if await get_async_redis().hdel(typing_key(room_id), self.user.username):
+            await schedule_snapshot(room_id)
+
+    async def stop_all(self):
+        for room_id in list(self.rooms):
+            await self.stop(room_id)
+
+
+async def schedule_snapshot(room_id):
+    """
+    Broadcast the users typing in the room in `CHAT_TYPING_SNAPSHOT_INTERVAL` seconds, unless a server process already
+    has a snapshot of the room scheduled, which will include this change.
+    """
+    interval = settings.CHAT_TYPING_SNAPSHOT_INTERVAL
+    # The lock outlives the interval, so a process that died before sending its snapshot doesn't block the room forever
+    if await get_async_redis().set(snapshot_lock_key(room_id), 1, nx=True, px=math.ceil(interval * 2000)):
+        spawn(send_snapshot(room_id, delay=interval))
+
+
+async def schedule_expiry(room_id, delay):
+    """Check for typing statuses that expired without a stop (e.g. the connection was lost) in `delay` seconds."""
+    if await get_async_redis().set(expiry_lock_key(room_id), 1, nx=True, px=math.ceil(delay * 1000) + 1000):
+        spawn(send_snapshot(room_id, delay=delay, expiry=True))
+
+
+async def send_snapshot(room_id, delay, expiry=False):
+    await asyncio.sleep(delay)
+
+    redis = get_async_redis()
+    # Released before reading the state, so changes made from now on schedule a new snapshot
+    await redis.delete(expiry_lock_key(room_id) if expiry else snapshot_lock_key(room_id))
+
+    now = time.time()
+    statuses = {username: float(expires) for username, expires in (await redis.hgetall(typing_key(room_id))).items()}
+    expired = [username for username, expires in statuses.items() if expires <= now]
+    if expired:
+        await redis.hdel(typing_key(room_id), *expired)
+
+    typing = {username: expires for username, expires in statuses.items() if expires > now}
+    if typing:
+        await schedule_expiry(room_id, min(typing.values()) - now)
+
+    if expiry and not expired:
+        return
+
+    payload = {"type": "typing", "room": room_id, "users": sorted(typing)}
+    await group_send_to_room(get_channel_layer(), room_id, {"type": "chat.typing", **encode_payload(payload)})
+
+
+def spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
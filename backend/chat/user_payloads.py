@@ -0,0 +1,75 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# Part of the cache keys, bumped whenever the fields rendered by `UserSerializer` change, so the payloads cached by the
+# previous version aren't served
+USER_PAYLOAD_VERSION = 1
+
+
+def user_payload_cache_key(user_id):
+    """The payload of the user, cached along with the version of the user it was rendered for."""
+    return f"chat:user-payload:{USER_PAYLOAD_VERSION}:{user_id}"
+
+
+def user_payload_version_key(user_id):
+    """Random version of the user, replaced whenever the user or their profile change. Missing until the first one."""
+    return f"chat:user-payload-version:{user_id}"
+
+
+def read_user_payloads(user_ids, cached):
+    versions = {user_id: cached.get(user_payload_version_key(user_id)) for user_id in user_ids}
+    payloads = {}
+    for user_id in user_ids:
+        entry = cached.get(user_payload_cache_key(user_id))
+        # Payloads rendered before the last change of the user are stale
+        if entry is not None and entry[0] == versions[user_id]:
+            payloads[user_id] = entry[1]
+    return payloads, versions
+
+
+def get_user_payloads(user_ids) -> tuple[dict[int, dict], dict[int, str | None]]:
+    """
+    Cached `UserSerializer` payloads of the users by user id, fetched in a single round trip along with the versions
+    of the users, which the missing payloads are cached with by `set_user_payloads`.
+    """
+    keys = [key for user_id in user_ids for key in (user_payload_cache_key(user_id), user_payload_version_key(user_id))]
+    return read_user_payloads(user_ids, cache.get_many(keys))
+
+
+async def aget_user_payloads(user_ids) -> tuple[dict[int, dict], dict[int, str | None]]:
+    """Async version of `get_user_payloads`, for the WebSocket consumers."""
+    keys = [key for user_id in user_ids for key in (user_payload_cache_key(user_id), user_payload_version_key(user_id))]
+    return read_user_payloads(user_ids, await cache.aget_many(keys))
+
+
+def set_user_payloads(payloads, versions):
+    if payloads:
+        cache.set_many(
+            {user_payload_cache_key(user_id): (versions[user_id], payload) for user_id, payload in payloads.items()},
+            settings.CHAT_USER_PAYLOAD_CACHE_TIMEOUT,
+        )
+
+
+async def aset_user_payloads(payloads, versions):
+    if payloads:
+        await cache.aset_many(
+            {user_payload_cache_key(user_id): (versions[user_id], payload) for user_id, payload in payloads.items()},
+            settings.CHAT_USER_PAYLOAD_CACHE_TIMEOUT,
+        )
+
+
+def invalidate_user_payloads(*user_ids):
+    """
+    Replace the versions of the users once the current transaction commits, which makes their cached payloads stale.
+    A payload rendered from the rows before the commit is cached with the previous version, so it's never served.
+    """
+    if not user_ids:
+        return
+
+    def bump():
+        cache.set_many({user_payload_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+
+    transaction.on_commit(bump)
@@ -1,16 +1,92 @@
+import base64
+import math
+from collections.abc import Callable, Iterable
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any
 
-from django.core.files.base import ContentFile
-from PIL import Image, ImageDraw, ImageSequence
+from django.conf import settings
+from django.core.files import File
+from PIL import ExifTags, GifImagePlugin, Image, ImageChops, ImageDraw, ImageFilter, ImageOps, ImageSequence
 from rest_framework import serializers
 
+# Processed avatars larger than this are spooled to a temporary file instead of being kept in memory
+AVATAR_SPOOL_SIZE = 1024 * 1024
+# Images are downscaled with a box filter down to this many times the target size before the LANCZOS resampling
+RESIZE_REDUCING_GAP = 3.0
+# Size of the longest side of the blurred placeholders shown while a chat image loads
+PLACEHOLDER_SIZE = 16
+
+
+class ImageLimitExceeded(ValueError):
+    pass
+
+
+def open_image(fp) -> Image.Image:
+    """
+    Open an image, only reading its header. Raises `ImageLimitExceeded` if it has more than `CHAT_IMAGE_MAX_PIXELS`
+    pixels, which could exhaust the memory once decoded.
+    """
+    img = Image.open(fp)
+    if img.width * img.height > settings.CHAT_IMAGE_MAX_PIXELS:
+        raise ImageLimitExceeded(f"The image is larger than {settings.CHAT_IMAGE_MAX_PIXELS} pixels.")
+    return img
+
+
+def validate_image_pixels(image_file):
+    """Serializer field validation for uploaded images, see `open_image`."""
+    try:
+        open_image(image_file)
+    except ImageLimitExceeded as exc:
+        raise serializers.ValidationError(str(exc))
+    except Exception:
+        raise serializers.ValidationError("Failed to open image file")
+    finally:
+        image_file.seek(0)
+
 
 def crop_avatar_img(image_file, filename, crop_data: dict[str, int | float]):
     try:
-        img = Image.open(image_file)
+        img = open_image(image_file)
+    except ImageLimitExceeded as exc:
+        raise serializers.ValidationError(str(exc))
     except Exception:
         raise serializers.ValidationError("Failed to open image file")
 
+    try:
+        result = render_avatar(img, crop_data)
+    except ImageLimitExceeded as exc:
+        raise serializers.ValidationError(str(exc))
+    if result is None:
+        image_file.seek(0)
+        return image_file
+
+    output, extension = result
+    return File(output, name=f"{filename}.{extension}")
+
+
+def crop_avatar_bytes(data: bytes, crop_data: dict[str, int | float]) -> tuple[bytes, str]:
+    """
+    Crop an avatar from the raw bytes of the uploaded image, returning the bytes and the file extension of the result.
+
+    Meant to run in the image processing worker processes, so it only takes and returns picklable values.
+    """
+    img = open_image(BytesIO(data))
+    result = render_avatar(img, crop_data)
+    if result is None:
+        return data, img.format.lower()
+
+    output, extension = result
+    with output:
+        return output.read(), extension
+
+
+def render_avatar(img: Image.Image, crop_data: dict[str, int | float]) -> tuple[IO[bytes], str] | None:
+    """
+    Crop the avatar out of `img` with a circular mask, as a PNG or as an animated GIF for GIFs.
+
+    Returns a file positioned at the start of the result and its extension, or None if the image has no frames.
+    """
     natural_width, natural_height = img.size
 
     scale = crop_data["scale"]
@@ -36,11 +112,17 @@ def crop_avatar_img(image_file, filename, crop_data: dict[str, int | float]):
     source_top = (crop_top_in_container - image_top_in_container) / scale
     source_size = output_size / scale
 
+    # The image is only shown at `scale` in the cropper, so JPEGs can be decoded at a fraction of their size (scaled
+    # down by a power of two while decoding, which is much faster and lighter than decoding it at full size), as long
+    # as the decoded image stays larger than the displayed one. The crop box is then scaled to match.
+    img.draft(None, (math.ceil(scaled_width), math.ceil(scaled_height)))
+    reduction = img.width / natural_width
+
     box = (
-        int(source_left),
-        int(source_top),
-        int(source_left + source_size),
-        int(source_top + source_size),
+        int(source_left * reduction),
+        int(source_top * reduction),
+        int((source_left + source_size) * reduction),
+        int((source_top + source_size) * reduction),
     )
 
     # Create a circular mask
@@ -51,42 +133,129 @@ def crop_avatar_img(image_file, filename, crop_data: dict[str, int | float]):
 
     def process_image(image: Image.Image):
         cropped_img = image.crop(box)
-        resized_img = cropped_img.resize((output_size, output_size), Image.Resampling.LANCZOS).convert("RGBA")
+        # With a reducing gap the image is first shrunk with a cheap box filter to a few times the output size, so
+        # LANCZOS doesn't run over the whole crop of a large image
+        resized_img = cropped_img.resize(
+            (output_size, output_size), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP
+        ).convert("RGBA")
 
         result = Image.new("RGBA", (output_size, output_size), (0, 0, 0, 0))
         result.paste(resized_img, (0, 0), mask)
         return result
 
+    output = SpooledTemporaryFile(max_size=AVATAR_SPOOL_SIZE)
     if img.format == "GIF":
-        frames = []
-        duration = img.info.get("duration", 100)
-        loop = img.info.get("loop", 0)
-
-        for frame in ImageSequence.Iterator(img):
-            processed_frame = process_image(frame)
-            frames.append(processed_frame.convert("P", palette=Image.Palette.ADAPTIVE))
-
-        if not frames:
-            image_file.seek(0)
-            return image_file
-
-        output_buffer = BytesIO()
-        frames[0].save(
-            output_buffer,
-            format="GIF",
-            save_all=True,
-            append_images=frames[1:],
-            optimize=False,
-            duration=duration,
-            loop=loop,
-            disposal=2,
-        )
-        output_buffer.seek(0)
-        return ContentFile(output_buffer.read(), name=f"{filename}.gif")
-
+        if not write_gif(output, avatar_frames(img, process_image), loop=img.info.get("loop", 0)):
+            return None
+        extension = "gif"
     else:
         processed_image = process_image(img)
-        output_buffer = BytesIO()
-        processed_image.save(output_buffer, format="PNG", quality=95)
-        output_buffer.seek(0)
-        return ContentFile(output_buffer.read(), name=f"{filename}.png")
+        processed_image.save(output, format="PNG", quality=95)
+        extension = "png"
+
+    output.seek(0)
+    return output, extension
+
+
+def avatar_frames(img: Image.Image, process_image: Callable[[Image.Image], Image.Image]):
+    """
+    Process the frames of an animated image one at a time, yielding each processed frame with its duration.
+
+    Consecutive frames that are identical after processing are merged into one frame with the sum of their durations.
+    Raises `ImageLimitExceeded` once the animation goes over any of the frame count, frame size or total decoded size
+    limits.
+    """
+    default_duration = img.info.get("duration", 100)
+    decoded_bytes = 0
+    previous, previous_duration = None, 0
+
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index >= settings.CHAT_GIF_MAX_FRAMES:
+            raise ImageLimitExceeded(f"The image has more than {settings.CHAT_GIF_MAX_FRAMES} frames.")
+        if frame.width * frame.height > settings.CHAT_GIF_MAX_PIXELS:
+            raise ImageLimitExceeded(f"The image is larger than {settings.CHAT_GIF_MAX_PIXELS} pixels.")
+        decoded_bytes += frame.width * frame.height * len(frame.getbands())
+        if decoded_bytes > settings.CHAT_GIF_MAX_DECODED_BYTES:
+            raise ImageLimitExceeded("The image is too large to be processed.")
+
+        processed = process_image(frame)
+        duration = frame.info.get("duration", default_duration)
+        if previous is not None and ImageChops.difference(previous, processed).getbbox(alpha_only=False) is None:
+            previous_duration += duration
+            continue
+
+        if previous is not None:
+            yield previous, previous_duration
+        previous, previous_duration = processed, duration
+
+    if previous is not None:
+        yield previous, previous_duration
+
+
+def write_gif(fp: IO[bytes], frames: Iterable[tuple[Image.Image, int]], loop: int = 0) -> bool:
+    """
+    Write RGBA frames to `fp` as an animated GIF, encoding each frame as soon as it is produced instead of holding the
+    whole animation in memory like `Image.save(save_all=True)` does. Every frame gets its own palette, and fully
+    transparent pixels are kept transparent. Returns whether any frame was written.
+    """
+    written = False
+    for frame, duration in frames:
+        frame = frame.convert("P", palette=Image.Palette.ADAPTIVE)
+        params = {"duration": duration, "disposal": 2, "include_color_table": True}
+        if frame.palette.mode == "RGBA":
+            transparency = next((index for color, index in frame.palette.colors.items() if color[3] == 0), None)
+            if transparency is not None:
+                params["transparency"] = transparency
+
+        if not written:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": loop})
+            fp.writelines(header)
+            written = True
+        fp.writelines(GifImagePlugin.getdata(frame, **params))
+
+    if written:
+        fp.write(b";")  # GIF trailer
+    return written
+
+
+def render_media_renditions(data: bytes, sizes: dict[str, int]) -> dict[str, Any]:
+    """
+    Render the WebP renditions of an uploaded chat image, from the raw bytes of the upload.
+
+    Returns the dimensions of the image, a tiny blurred placeholder as a data URI, and for every name in `sizes` the
+    WebP bytes and dimensions of the image scaled down to fit in a square of that size. Animated images only get the
+    placeholder, they are shown from the original file. Meant to run in the image processing worker processes.
+    """
+    img = open_image(BytesIO(data))
+    animated = getattr(img, "is_animated", False)
+    width, height = img.size
+    if img.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        # Rotated by a quarter turn
+        width, height = height, width
+    result: dict[str, Any] = {"width": width, "height": height}
+
+    # Decode JPEGs at a fraction of their size when even the largest rendition is much smaller
+    largest = max(sizes.values(), default=PLACEHOLDER_SIZE)
+    img.draft(None, (largest, largest))
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+
+    placeholder = img.copy()
+    placeholder.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    placeholder = placeholder.filter(ImageFilter.GaussianBlur(1))
+    output = BytesIO()
+    placeholder.save(output, format="WEBP", quality=30)
+    result["placeholder"] = f"data:image/webp;base64,{base64.b64encode(output.getvalue()).decode()}"
+
+    if animated:
+        return result
+
+    # Largest first, so every rendition is scaled down from the previous one instead of from the original
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        img.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        output = BytesIO()
+        img.save(output, format="WEBP", quality=80, method=4)
+        result[name] = (output.getvalue(), img.width, img.height)
+
+    return result
@@ -0,0 +1,57 @@
+import uuid
+
+from django.db import transaction
+
+from .redis import get_redis
+
+# Random value of the current generation of version counters, part of every ETag so that the counters starting over
+# after Redis lost its data don't reproduce the ETags of earlier responses
+EPOCH_KEY = "chat:version:epoch"
+# Bumped whenever a room is created, deleted or its metadata changes, which may change the rooms visible to anyone
+ROOMS_VERSION_KEY = "chat:version:rooms"
+
+
+def room_version_key(room_id):
+    """Counter bumped on every change to what the room list and message pages render of the room."""
+    return f"chat:version:room:{room_id}"
+
+
+def user_rooms_version_key(user_id):
+    """Counter bumped when the user joins or leaves a room, or reads one, which changes their unread counts."""
+    return f"chat:version:user-rooms:{user_id}"
+
+
+def bump_versions(keys):
+    """Increment the counters once the current transaction commits, so they never get ahead of the database."""
+    if not keys:
+        return
+
+    def bump():
+        with get_redis().pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.incr(key)
+            pipe.execute()
+
+    transaction.on_commit(bump)
+
+
+def bump_room_versions(*room_ids):
+    bump_versions([room_version_key(room_id) for room_id in room_ids])
+
+
+def bump_user_rooms_versions(*user_ids):
+    bump_versions([user_rooms_version_key(user_id) for user_id in user_ids])
+
+
+def bump_rooms_version():
+    bump_versions([ROOMS_VERSION_KEY])
+
+
+def get_versions(keys) -> list[str]:
+    """The current epoch followed by the values of the counters, read in a single round trip."""
+    client = get_redis()
+    epoch, *versions = client.mget([EPOCH_KEY, *keys])
+    if epoch is None:
+        client.set(EPOCH_KEY, uuid.uuid4().hex, nx=True)
+        epoch = client.get(EPOCH_KEY)
+    return [epoch, *(version or "0" for version in versions)]
@@ -1,11 +1,13 @@
+from functools import partial
 from typing import override
 
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.http import JsonResponse
 from django.middleware.csrf import get_token
-from django.utils import timezone
 from rest_framework import permissions, status, views, viewsets
 from rest_framework.decorators import action
 from rest_framework.generics import get_object_or_404
@@ -13,12 +15,20 @@ from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from .etags import conditional_response, message_list_etag, room_list_etag
 from .models import (ChatRoom, ChatRoomInvitation, Membership, Message,
                      MessageMedia, MessageReaction)
+from .pagination import MessageKeysetPagination, MessageSearchPagination
 from .permissions import IsOwnerOrReadOnly, UserPermissions
+from .presence import get_online_member_ids
+from .read_positions import mark_read, unread_count_expression
+from .renditions import generate_renditions
+from .search import search_messages
 from .serializers import (ChatRoomInvitationSerializer, ChatRoomSerializer,
                           MessageMediaSerializer, MessageReactionSerializer,
-                          MessageSerializer, UserSerializer)
+                          MessageSearchResultSerializer,
+                          MessageSearchSerializer, MessageSerializer,
+                          UserSerializer, prefetch_user_payloads)
 
 
 def get_csrf(request):
@@ -26,7 +36,7 @@ def get_csrf(request):
 
 
 class UserViewSet(viewsets.ModelViewSet[User]):
-    queryset = User.objects.all()
+    queryset = User.objects.select_related("profile")
     serializer_class = UserSerializer
     permission_classes = [UserPermissions]
 
@@ -35,9 +45,9 @@ class UserViewSet(viewsets.ModelViewSet[User]):
 
         # Try to interpret as integer ID first
         if lookup_value.isdigit():
-            return get_object_or_404(User, id=int(lookup_value))
+            return get_object_or_404(self.get_queryset(), id=int(lookup_value))
         # Fallback to username
-        return get_object_or_404(User, username=lookup_value)
+        return get_object_or_404(self.get_queryset(), username=lookup_value)
 
     @action(
         methods=["get"],
@@ -107,9 +117,36 @@ class ChatRoomViewSet(viewsets.ModelViewSet[ChatRoom]):
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
     parser_classes = [MultiPartParser, FormParser]
 
+    @override
+    def list(self, request, *args, **kwargs):
+        return conditional_response(request, room_list_etag(request), partial(super().list, request, *args, **kwargs))
+
     def get_queryset(self):
         user = self.request.user
-        return ChatRoom.objects.filter(Q(is_private=False) | Q(members=user)).distinct()
+        memberships = Membership.objects.filter(room=OuterRef("pk"))
+
+        # Everything the room list renders is resolved here as subqueries/prefetches, so listing N rooms
+        # costs a constant number of queries instead of several per room.
+        return (
+            ChatRoom.objects.annotate(
+                is_member=Exists(memberships.filter(user=user)),
+                member_count=Coalesce(
+                    Subquery(memberships.order_by().values("room").annotate(count=Count("pk")).values("count")), 0
+                ),
+                unread_count=unread_count_expression(
+                    user, Coalesce(Subquery(memberships.filter(user=user).values("unread_count")[:1]), 0)
+                ),
+            )
+            .filter(Q(is_private=False) | Q(is_member=True))
+            .select_related("owner", "last_message_user")
+            .prefetch_related(
+                Prefetch(
+                    "membership_set",
+                    queryset=Membership.objects.filter(room__is_dm=True).select_related("user__profile").order_by("id"),
+                    to_attr="dm_memberships",
+                )
+            )
+        )
 
     @override
     def perform_create(self, serializer):
@@ -142,23 +179,43 @@ class ChatRoomViewSet(viewsets.ModelViewSet[ChatRoom]):
     @action(detail=True, methods=["GET"], permission_classes=[permissions.IsAuthenticated], url_path="members")
     def list_members(self, request, pk=None):
         room = self.get_object()
-        memberships = Membership.objects.filter(room=room).select_related("user")
+        memberships = Membership.objects.filter(room=room).select_related("user__profile")
+        context = self.get_serializer_context()
+        prefetch_user_payloads(context, (membership.user for membership in memberships))
         data = []
         if room.is_dm:
             for membership in memberships:
                 data.append(
-                    UserSerializer(membership.user, context=self.get_serializer_context()).data,
+                    UserSerializer(membership.user, context=context).data,
                 )
         else:
             for membership in memberships:
                 data.append(
                     {
-                        **UserSerializer(membership.user, context=self.get_serializer_context()).data,
+                        **UserSerializer(membership.user, context=context).data,
                         "is_admin": membership.is_admin,
                     }
                 )
         return Response(data, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["GET"], permission_classes=[permissions.IsAuthenticated])
+    def presence(self, request, pk=None):
+        """Online status of all the members of the room, kept up to date afterwards by the `presence` events."""
+        room = self.get_object()
+        member_ids = Membership.get_member_ids(room.id)
+        if request.user.id not in member_ids:
+            return Response({"detail": "You are not a member of this room."}, status=status.HTTP_403_FORBIDDEN)
+
+        online = get_online_member_ids(room.id)
+        return Response(
+            {
+                "room": room.id,
+                "online": sorted(online),
+                "offline": sorted(user_id for user_id in member_ids if user_id not in online),
+            },
+            status=status.HTTP_200_OK,
+        )
+
     @action(
         detail=True,
         methods=["POST"],
@@ -260,7 +317,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet[ChatRoom]):
 
 
 class InvitationViewSet(viewsets.GenericViewSet):
-    queryset = ChatRoomInvitation.objects.all()
+    queryset = ChatRoomInvitation.objects.select_related("room__owner", "room__last_message_user")
     lookup_field = "token"
 
     @action(detail=True, methods=["get"], permission_classes=[permissions.AllowAny])
@@ -281,7 +338,7 @@ class InvitationViewSet(viewsets.GenericViewSet):
         room = invitation.room
         user = request.user
 
-        if user in room.members.all():
+        if room.members.filter(id=user.id).exists():
             serializer = ChatRoomSerializer(room, context={"request": request})
             return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -294,6 +351,7 @@ class MessageViewSet(viewsets.ModelViewSet[Message]):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
 
     @override
     def get_queryset(self):
@@ -301,26 +359,45 @@ class MessageViewSet(viewsets.ModelViewSet[Message]):
         room_id = self.request.query_params.get("room")
         if room_id is not None:
             queryset = queryset.filter(room__id=room_id)
-        return queryset.order_by("-timestamp")
+        return MessageSerializer.setup_eager_loading(queryset).order_by("-timestamp", "-id")
 
     @override
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @override
+    def perform_update(self, serializer):
+        message = serializer.save()
+        # Saving drops the prefetched media and reactions, which are loaded again for the response
+        serializer.instance = self.get_queryset().get(pk=message.pk)
+
     @override
     def list(self, request: Request, *args, **kwargs):
         room_id = request.query_params.get("room")
         if room_id:
-            try:
-                room = ChatRoom.objects.get(id=room_id)
-                membership = Membership.objects.get(user=request.user, room=room)
-                membership.last_read_timestamp = timezone.now()
-                membership.save()
-            except ChatRoom.DoesNotExist:
-                pass  # Room doesn’t exist, proceed with default response
+            mark_read(request.user, room_id)
+            etag = message_list_etag(request, room_id)
+            return conditional_response(request, etag, partial(super().list, request, *args, **kwargs))
 
         return super().list(request, *args, **kwargs)
 
+    @action(detail=False, methods=["GET"])
+    def search(self, request: Request):
+        """
+        Full-text search over the messages of the requester's rooms, with the `q`, `room`, `author`, `since` and
+        `until` query parameters. Results are ordered by rank, or newest first with `ordering=newest`, and paginated
+        with a `cursor`.
+        """
+        params = MessageSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        ordering = params.validated_data.pop("ordering")
+
+        queryset = MessageSerializer.setup_eager_loading(search_messages(request.user, **params.validated_data))
+        paginator = MessageSearchPagination()
+        page = paginator.paginate_queryset(queryset, request, self, key="rank" if ordering == "rank" else "timestamp")
+        serializer = MessageSearchResultSerializer(page, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
     @override
     def destroy(self, request: Request, *args, **kwargs) -> Response:
         target_message = self.get_object()
@@ -341,7 +418,17 @@ class MessageViewSet(viewsets.ModelViewSet[Message]):
                 status=status.HTTP_401_UNAUTHORIZED,
             )
 
-        return super().destroy(request, *args, **kwargs)
+        self.perform_destroy(target_message)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @override
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            Membership.decrement_unread_counts(instance)
+            was_last_message = instance.room.last_message_id == instance.pk
+            instance.delete()
+            if was_last_message:
+                ChatRoom.refresh_last_message(instance.room_id)
 
     @override
     def update(self, request: Request, *args, **kwargs) -> Response:
@@ -360,7 +447,7 @@ class MessageReactionViewSet(viewsets.ModelViewSet[MessageReaction]):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return MessageReaction.objects.filter(message_id=self.kwargs["message_pk"])
+        return MessageReaction.objects.filter(message_id=self.kwargs["message_pk"]).select_related("user__profile")
 
     def perform_create(self, serializer):
         message = get_object_or_404(Message, pk=self.kwargs["message_pk"])
@@ -401,4 +488,5 @@ class MessageMediaViewSet(viewsets.ModelViewSet[MessageMedia]):
     parser_classes = (MultiPartParser,)
 
     def perform_create(self, serializer):
-        serializer.save()
+        media = serializer.save()
+        generate_renditions(media)
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -29,7 +31,8 @@ DEBUG = True
 ALLOWED_HOSTS = []
 
 CORS_ALLOWED_ORIGINS = ["http://localhost:5173", "http://127.0.0.1:5173"]
-CORS_EXPOSE_HEADERS = ["Content-Type", "X-CSRFToken"]
+CORS_EXPOSE_HEADERS = ["Content-Type", "X-CSRFToken", "ETag", "Server-Timing"]
+CORS_ALLOW_HEADERS = (*default_headers, "if-none-match")
 CORS_ALLOW_CREDENTIALS = True
 
 CSRF_COOKIE_SAMESITE = "Lax"
@@ -49,6 +52,7 @@ INSTALLED_APPS = [
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.messages",
+    "django.contrib.postgres",
     "django.contrib.sessions",
     "django.contrib.staticfiles",
     "rest_framework",
@@ -56,6 +60,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost so its total covers the whole request, only enabled with CHAT_SERVER_TIMING
+    "chat.middleware.ServerTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -94,6 +100,16 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Redis database of the short lived chat state shared by the server processes, like who is typing
+CHAT_REDIS_URL = os.environ.get("CHAT_REDIS_URL", "redis://redis:6379/2")
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/1",
+    },
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -166,3 +182,69 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 20,
     "MAX_LIMIT": 100,
 }
+
+# Chat
+
+# How room events reach the connected clients:
+# - "room": every connection joins one channel layer group per room it belongs to (one group_add per room on connect).
+# - "user": every connection joins a single per-user group, and room events are fanned out to the groups of the
+#   room members, looked up in a cached membership index. The fan-out costs three Redis round trips per shard
+#   whatever the size of the room (see `chat.delivery.group_send_many`). Like in the "room" mode, the event is still
+#   queued once per connection: about 140ms for a 2,000-member room against a local Redis, versus about 1.25s with
+#   one `group_send` per member.
+CHAT_DELIVERY_MODE = os.environ.get("CHAT_DELIVERY_MODE", "room")
+# Seconds the member ids of a room are cached for. The cache is also invalidated on every membership change.
+CHAT_MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+# Seconds the rendered user payloads (user and profile, as nested in messages, reactions and member lists) are cached
+# for. The cache is also invalidated whenever a user or their profile is saved.
+CHAT_USER_PAYLOAD_CACHE_TIMEOUT = 10 * 60
+# Messages sent over WebSocket within this many seconds of each other are inserted together in a single transaction,
+# up to CHAT_MESSAGE_BATCH_SIZE messages per batch.
+CHAT_MESSAGE_BATCH_WINDOW = 0.005
+CHAT_MESSAGE_BATCH_SIZE = 100
+# WebSocket clients connecting with `?batch=1` get the events sent to them within CHAT_WS_BATCH_WINDOW seconds of
+# each other in a single JSON array frame, of at most CHAT_WS_BATCH_SIZE events.
+CHAT_WS_BATCH_WINDOW = 0.015
+CHAT_WS_BATCH_SIZE = 100
+# Number of worker processes cropping the uploaded avatars off the request workers. With 0 the avatars are cropped
+# in the request instead. At most CHAT_IMAGE_QUEUE_SIZE images can be queued or processing in each server process,
+# further uploads are rejected with 429 until the queue drains.
+CHAT_IMAGE_WORKERS = int(os.environ.get("CHAT_IMAGE_WORKERS", 2))
+CHAT_IMAGE_QUEUE_SIZE = int(os.environ.get("CHAT_IMAGE_QUEUE_SIZE", 16))
+# Uploaded images with more pixels than this are rejected before being decoded (decompression bomb protection).
+CHAT_IMAGE_MAX_PIXELS = 50_000_000
+# Limits of the animated GIF avatars, which are processed one frame at a time: the number of frames, the pixels of a
+# frame, and the total decoded size of all the frames.
+CHAT_GIF_MAX_FRAMES = 500
+CHAT_GIF_MAX_PIXELS = 2048 * 2048
+CHAT_GIF_MAX_DECODED_BYTES = 1024 * 1024 * 1024
+# Longest side of the WebP renditions of the chat images, shown in the message bubbles and in the full view.
+CHAT_MEDIA_BUBBLE_SIZE = 480
+CHAT_MEDIA_FULL_SIZE = 1920
+# Typing status: rooms get at most one "who is typing" snapshot every CHAT_TYPING_SNAPSHOT_INTERVAL seconds, a
+# connection's typing starts are rate limited to one every CHAT_TYPING_MIN_INTERVAL seconds, and a typing status
+# expires after CHAT_TYPING_TIMEOUT seconds without being refreshed by the client. Typing isn't broadcast in rooms with
+# more than CHAT_TYPING_MAX_MEMBERS members.
+CHAT_TYPING_SNAPSHOT_INTERVAL = 0.3
+CHAT_TYPING_MIN_INTERVAL = 1
+CHAT_TYPING_TIMEOUT = 10
+CHAT_TYPING_MAX_MEMBERS = 200
+# Presence: every server process refreshes the presence of its connections every CHAT_PRESENCE_HEARTBEAT_INTERVAL
+# seconds, and a connection that isn't refreshed for CHAT_PRESENCE_TIMEOUT seconds (its process died) is dropped. The
+# users going online or offline are broadcast to their rooms in a diff every CHAT_PRESENCE_FLUSH_INTERVAL seconds.
+CHAT_PRESENCE_HEARTBEAT_INTERVAL = 30
+CHAT_PRESENCE_TIMEOUT = 90
+CHAT_PRESENCE_FLUSH_INTERVAL = 1
+# Number of users with expired connections looked up at once by the sweep, which runs until none are left
+CHAT_PRESENCE_SWEEP_BATCH_SIZE = 100
+# Read positions: loading the history of a room marks it as read in Redis, and the positions are written to the
+# memberships every CHAT_READ_POSITION_FLUSH_INTERVAL seconds by `manage.py flush_read_positions --loop`, in UPDATEs of
+# up to CHAT_READ_POSITION_FLUSH_BATCH_SIZE users each.
+CHAT_READ_POSITION_FLUSH_INTERVAL = 5
+CHAT_READ_POSITION_FLUSH_BATCH_SIZE = 500
+# Server timing: with CHAT_SERVER_TIMING set, every response gets a Server-Timing header with its number of queries and
+# the time spent in SQL, serializers and image processing. The requests and WebSocket events taking longer than
+# CHAT_SLOW_REQUEST_THRESHOLD seconds are logged with their CHAT_SLOW_REQUEST_QUERIES slowest queries.
+CHAT_SERVER_TIMING = os.environ.get("CHAT_SERVER_TIMING") == "1"
+CHAT_SLOW_REQUEST_THRESHOLD = float(os.environ.get("CHAT_SLOW_REQUEST_THRESHOLD", 0.5))
+CHAT_SLOW_REQUEST_QUERIES = 5
@@ -6,9 +6,14 @@ import {
     Message,
     MessagePayload,
     MessageReaction,
+    MessageSearchParams,
+    MessageSearchResult,
     PaginatedResponse,
     RegistrationCredentials,
+    RoomPresence,
+    SearchResponse,
     User,
+    WebSocketEvent,
 } from "./types";
 
 export const baseURL = "http://localhost:8000";
@@ -120,6 +125,11 @@ export class APIService {
         return response.data;
     }
 
+    async getRoomPresence(roomId: number): Promise<RoomPresence> {
+        const response = await this.request(`/rooms/${roomId}/presence/`);
+        return response.data;
+    }
+
     async updateChatMemberAdminStatus(roomId: number, username: string, value: boolean) {
         const response = await this.request(`/rooms/${roomId}/update-admin/`, {
             method: "POST",
@@ -209,6 +219,25 @@ export class APIService {
         return response;
     }
 
+    async searchMessages(
+        params: MessageSearchParams,
+        next: string | null = null,
+    ): Promise<SearchResponse<MessageSearchResult>> {
+        if (next) {
+            const response = await this.request(next);
+            return response.data;
+        }
+
+        const query = new URLSearchParams();
+        for (const [key, value] of Object.entries(params)) {
+            if (value !== undefined) {
+                query.set(key, `${value}`);
+            }
+        }
+        const response = await this.request(`/messages/search/?${query}`);
+        return response.data;
+    }
+
     async getMessages(
         roomId: number,
         next: string | null = null,
@@ -224,13 +253,6 @@ export class APIService {
         return response.data;
     }
 
-    async sendMessage(message: MessagePayload) {
-        return this.request("/messages/", {
-            method: "POST",
-            body: JSON.stringify(message),
-        });
-    }
-
     async deleteMessage(messageId: number) {
         this.request(`/messages/${messageId}/`, {
             method: "DELETE",
@@ -370,6 +392,11 @@ type Event =
     | { type: EventType.message; data: Message }
     | { type: EventType.error; data: any };
 
+type PendingMessage = {
+    resolve: (message: Message) => void;
+    reject: (error: any) => void;
+};
+
 export class WebSocketService {
     socket?: WebSocket;
     reconnectAttempts: number;
@@ -377,6 +404,8 @@ export class WebSocketService {
     reconnectDelay: number;
     shouldReconnect: boolean;
     listeners: Map<EventType, EventCallback | undefined>;
+    // Messages sent over this connection that the server hasn't echoed or rejected yet, by client id
+    pendingMessages: Map<string, PendingMessage>;
 
     constructor() {
         this.socket = undefined;
@@ -384,6 +413,7 @@ export class WebSocketService {
         this.maxReconnectAttempts = 5;
         this.reconnectDelay = 1000;
         this.listeners = new Map();
+        this.pendingMessages = new Map();
         this.shouldReconnect = true;
     }
 
@@ -394,7 +424,8 @@ export class WebSocketService {
         }
 
         this.shouldReconnect = true;
-        const wsUrl = `${API_CONFIG.wsUrl}/chat/`;
+        // Events are received in batches, as JSON arrays
+        const wsUrl = `${API_CONFIG.wsUrl}/chat/?batch=1`;
         this.socket = new WebSocket(wsUrl);
 
         this.socket.onopen = () => {
@@ -405,11 +436,15 @@ export class WebSocketService {
 
         this.socket.onmessage = (event) => {
             const data = JSON.parse(event.data);
-            this.emit({ type: EventType.message, data });
+            for (const message of Array.isArray(data) ? data : [data]) {
+                this.settlePendingMessage(message);
+                this.emit({ type: EventType.message, data: message });
+            }
         };
 
         this.socket.onclose = () => {
             console.log("WebSocket disconnected");
+            this.rejectPendingMessages();
             this.emit({ type: EventType.disconnect });
             if (this.shouldReconnect) {
                 this.handleReconnect();
@@ -432,10 +467,36 @@ export class WebSocketService {
         }
     }
 
-    sendMessage(message: Message) {
-        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-            this.socket.send(JSON.stringify({ type: "send_message", message }));
+    // Resolves with the stored message once the server broadcasts it, or rejects with the validation errors
+    sendMessage(message: MessagePayload, clientId: string): Promise<Message> {
+        return new Promise((resolve, reject) => {
+            if (!this.socket || this.socket.readyState !== WebSocket.OPEN) {
+                reject(new Error("WebSocket is not connected"));
+                return;
+            }
+            this.pendingMessages.set(clientId, { resolve, reject });
+            this.socket.send(JSON.stringify({ type: "send_message", client_id: clientId, message }));
+        });
+    }
+
+    settlePendingMessage(event: WebSocketEvent) {
+        if ((event.type !== "send_message" && event.type !== "error") || !event.client_id) return;
+        const pending = this.pendingMessages.get(event.client_id);
+        if (!pending) return;
+
+        this.pendingMessages.delete(event.client_id);
+        if (event.type === "send_message") {
+            pending.resolve(event.message);
+        } else {
+            pending.reject(event.detail);
+        }
+    }
+
+    rejectPendingMessages() {
+        for (const pending of this.pendingMessages.values()) {
+            pending.reject(new Error("WebSocket disconnected"));
         }
+        this.pendingMessages.clear();
     }
 
     editMessage(message: Message) {
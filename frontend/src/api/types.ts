@@ -14,6 +14,16 @@ export type UserProfile = {
 export type Media = {
     id: number;
     file: string;
+    width: number | null;
+    height: number | null;
+    placeholder: string;
+    // WebP renditions, null until they are generated or for animated images
+    bubble: string | null;
+    bubble_width: number | null;
+    bubble_height: number | null;
+    full: string | null;
+    full_width: number | null;
+    full_height: number | null;
 };
 
 export type Message = {
@@ -25,6 +35,9 @@ export type Message = {
     reply_to?: Message;
     media?: Media[];
     reactions: MessageReaction[];
+    // Set on the optimistic copy of a message being sent, until the server echoes the stored message
+    client_id?: string;
+    pending?: boolean;
 };
 
 export interface MessageReaction {
@@ -68,6 +81,26 @@ export type RegistrationCredentials = {
     password: string;
 };
 
+export type MessageSearchResult = Message & {
+    rank: number;
+    // HTML of the content around the matched words, which are wrapped in <mark> tags
+    headline: string;
+};
+
+export type MessageSearchParams = {
+    q: string;
+    room?: number;
+    author?: string;
+    since?: string;
+    until?: string;
+    ordering?: "rank" | "newest";
+};
+
+export type SearchResponse<T> = {
+    next: string | null;
+    results: T[];
+};
+
 export type PaginatedResponse<T> = {
     count: number;
     next: string | null;
@@ -88,6 +121,15 @@ export type WebSocketEvent =
     | {
         type: "send_message";
         message: Message;
+        // Id chosen by the sender, which matches the message with its optimistic copy
+        client_id?: string;
+    }
+    | {
+        // A `send_message` event of this connection was rejected
+        type: "error";
+        event: string;
+        client_id?: string;
+        detail: unknown;
     }
     | {
         type: "edit_message";
@@ -102,14 +144,28 @@ export type WebSocketEvent =
     | { type: "add_message_reaction"; reaction: MessageReaction }
     | { type: "delete_message_reaction"; message: Message; reaction_id: number }
     | {
-        type: "typing_status";
-        user: string;
+        // Everyone typing in the room, including the current user
+        type: "typing";
+        room: number;
+        users: string[];
+    }
+    | {
+        // Members of the room that went online or offline since the previous presence event
+        type: "presence";
         room: number;
-        is_typing: boolean;
+        online: number[];
+        offline: number[];
     }
     | {
         type: "user_left";
         room_id: number;
         user: User;
         new_owner: User | null;
-    };
+    }
+    | { type: "avatar_updated"; avatar_img: string; room?: number; user?: number; error?: string };
+
+export type RoomPresence = {
+    room: number;
+    online: number[];
+    offline: number[];
+};
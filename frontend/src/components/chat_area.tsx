@@ -76,6 +76,8 @@ type ChatAreaProps = {
     onStartTyping: (roomId: number) => void;
     onStopTyping: (roomId: number) => void;
     typingUsers: string[];
+    // Ids of the members of the current room that are online
+    onlineUsers: number[];
 };
 
 export const ChatArea = ({
@@ -106,6 +108,7 @@ export const ChatArea = ({
     onStartTyping,
     onStopTyping,
     typingUsers,
+    onlineUsers,
     onCreateInvitation,
     onLeaveRoom,
 }: ChatAreaProps) => {
@@ -195,6 +198,17 @@ export const ChatArea = ({
     const isDmItself = isDM && recipient?.id === user.id;
     const isGroup = !isDM && !isDmItself;
 
+    const getPresenceText = () => {
+        if (isDmItself) {
+            return "";
+        }
+        if (isDM) {
+            return recipient && onlineUsers.includes(recipient.id) ? "online" : "";
+        }
+        return onlineUsers.length > 0 ? `${onlineUsers.length} online` : "";
+    };
+    const presenceText = getPresenceText();
+
     const isChatGroupOwner = currentRoom.owner === user.username;
     const displayName = isDM ? recipient?.username : currentRoom.name;
     const displayAvatar = isDM ? recipient?.profile.avatar_img : currentRoom.avatar_img;
@@ -371,6 +385,14 @@ export const ChatArea = ({
                                     </Box>
                                 </Typography>
                             </Box>
+                            {typingUsers.length === 0 && presenceText && (
+                                <Typography
+                                    variant="caption"
+                                    sx={{ color: "text.secondary", fontSize: "0.75rem", lineHeight: 1.2 }}
+                                >
+                                    {presenceText}
+                                </Typography>
+                            )}
                         </Box>
                     </Box>
                     {isGroup && (
@@ -139,7 +139,7 @@ export const ImageViewer = ({
                     }}
                 >
                     <img
-                        src={media[currentIndex].file}
+                        src={media[currentIndex].full ?? media[currentIndex].file}
                         alt="lightbox"
                         style={{
                             maxWidth: "100%",
@@ -189,7 +189,7 @@ export const ImageViewer = ({
                         <Box
                             key={mediaItem.id}
                             component="img"
-                            src={mediaItem.file}
+                            src={mediaItem.bubble ?? mediaItem.file}
                             alt="thumbnail"
                             onClick={() => onNavigate(index)}
                             sx={{
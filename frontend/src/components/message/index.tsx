@@ -150,6 +150,8 @@ export const Message = memo(
                     py: isHighlighted ? 1 : 0,
                     px: isHighlighted ? 1 : 0,
                     my: 0.5,
+                    // Not stored yet, see `handleSendMessage`
+                    opacity: message.pending ? 0.6 : 1,
                 }}
             >
                 <Stack
@@ -219,7 +221,7 @@ export const Message = memo(
                         }}
                         data-reaction-area
                     >
-                        <div onContextMenu={(e) => onCtxMenu(e, message)}>
+                        <div onContextMenu={(e) => !message.pending && onCtxMenu(e, message)}>
                             {/* Replied message section */}
                             {message.reply_to && (
                                 <Box
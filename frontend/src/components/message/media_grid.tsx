@@ -32,7 +32,7 @@ export const MediaGrid = ({
             >
                 <Box
                     component="img"
-                    src={media[0].file}
+                    src={media[0].bubble ?? media[0].file}
                     alt="chat media"
                     onClick={() => onImageClick(0)}
                     sx={{
@@ -81,7 +81,7 @@ export const MediaGrid = ({
                         <Box
                             key={mediaItem.id}
                             component="img"
-                            src={mediaItem.file}
+                            src={mediaItem.bubble ?? mediaItem.file}
                             alt="chat media"
                             onClick={() => onImageClick(index)}
                             sx={{
@@ -130,7 +130,7 @@ export const MediaGrid = ({
                 >
                     <Box
                         component="img"
-                        src={media[0].file}
+                        src={media[0].bubble ?? media[0].file}
                         alt="chat media"
                         onClick={() => onImageClick(0)}
                         sx={{
@@ -151,7 +151,7 @@ export const MediaGrid = ({
                         <Box
                             key={mediaItem.id}
                             component="img"
-                            src={mediaItem.file}
+                            src={mediaItem.bubble ?? mediaItem.file}
                             alt="chat media"
                             onClick={() => onImageClick(index + 1)}
                             sx={{
@@ -213,7 +213,7 @@ export const MediaGrid = ({
                     >
                         <Box
                             component="img"
-                            src={mediaItem.file}
+                            src={mediaItem.bubble ?? mediaItem.file}
                             alt="chat media"
                             sx={{
                                 width: "100%",
@@ -7,6 +7,9 @@ import { MessageInputActions } from "./input_actions";
 import { MediaPreview } from "./media_preview";
 import { FilePreviewModal } from "./file_preview";
 
+// Milliseconds between the typing status refreshes sent while the user keeps typing
+const TYPING_REFRESH_INTERVAL = 4000;
+
 export const MessageInput = ({
     isConnected,
     onSendMessage,
@@ -38,6 +41,7 @@ export const MessageInput = ({
     const textFieldRef = useRef<HTMLDivElement>(null);
     const isEditingMessage = messageEdit !== null;
     const typingTimeoutRef = useRef<NodeJS.Timeout | null>(null);
+    const typingStartedAtRef = useRef(0);
 
     useEffect(() => {
         if (messageEdit) {
@@ -80,8 +84,14 @@ export const MessageInput = ({
     const handleTypingChange = (e: React.ChangeEvent<HTMLInputElement>) => {
         setNewMessage(e.target.value);
 
-        if (!typingTimeoutRef.current && e.target.value.length > 0) {
+        // The server forgets the typing status if it isn't refreshed for a while
+        const now = Date.now();
+        if (
+            e.target.value.length > 0 &&
+            (!typingTimeoutRef.current || now - typingStartedAtRef.current > TYPING_REFRESH_INTERVAL)
+        ) {
             onStartTyping();
+            typingStartedAtRef.current = now;
         }
 
         if (typingTimeoutRef.current) {
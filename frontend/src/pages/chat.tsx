@@ -7,6 +7,7 @@ import {
     ChatRoom,
     CropAvatarData,
     LoginCredentials,
+    Media,
     Message,
     MessagePayload,
     MessageReaction,
@@ -38,11 +39,15 @@ enum ChatActionType {
     SetHighlightedMessage,
     SetMessagesLoading,
     SendMessage,
+    AddPendingMessage,
+    RemovePendingMessage,
     DeleteMessage,
     EditMessage,
     AddMessageReaction,
     DeleteMessageReaction,
     SetTypingStatus,
+    UpdatePresence,
+    UpdateAvatar,
     Error,
 }
 
@@ -65,6 +70,7 @@ type ChatState = {
     searchTerm: string;
     highlightedMessageId?: number;
     typingUsers: { [roomId: number]: string[] };
+    onlineUsers: { [roomId: number]: number[] };
 };
 
 type ChatAction =
@@ -100,7 +106,9 @@ type ChatAction =
             lastMessage?: { username: string; content: string; timestamp: string; room: number };
         };
     }
-    | { type: ChatActionType.SendMessage; payload: Message }
+    | { type: ChatActionType.SendMessage; payload: { message: Message; clientId?: string } }
+    | { type: ChatActionType.AddPendingMessage; payload: Message }
+    | { type: ChatActionType.RemovePendingMessage; payload: { clientId: string } }
     | { type: ChatActionType.EditMessage; payload: Message }
     | {
         type: ChatActionType.AddMessageReaction;
@@ -112,12 +120,21 @@ type ChatAction =
     }
     | {
         type: ChatActionType.SetTypingStatus;
-        payload: { roomId: number; user: string; isTyping: boolean };
+        payload: { roomId: number; users: string[] };
+    }
+    | {
+        // Sets the given users online or offline, keeping the status of the other members of the room
+        type: ChatActionType.UpdatePresence;
+        payload: { roomId: number; online: number[]; offline: number[] };
     }
     | { type: ChatActionType.RemoveRoom; payload: { roomId: number } }
     | {
         type: ChatActionType.UpdateRoomOnUserLeave;
         payload: { roomId: number; newOwner: User | null };
+    }
+    | {
+        type: ChatActionType.UpdateAvatar;
+        payload: { avatarImg: string; roomId?: number; userId?: number };
     };
 
 const initialState: ChatState = {
@@ -132,8 +149,12 @@ const initialState: ChatState = {
     nextMessagesUrl: null,
     messagesLoading: false,
     typingUsers: {},
+    onlineUsers: {},
 };
 
+// Ids of the optimistic copies of the messages being sent, negative so they never collide with the stored ones
+let nextPendingMessageId = -1;
+
 function chatReducer(state: ChatState, action: ChatAction) {
     switch (action.type) {
         case ChatActionType.RegistrationStart:
@@ -199,7 +220,7 @@ function chatReducer(state: ChatState, action: ChatAction) {
             };
         }
         case ChatActionType.SendMessage: {
-            const message = action.payload;
+            const { message, clientId } = action.payload;
             const { rooms, currentRoom, messages } = state;
 
             const updatedRooms = rooms.map((room) =>
@@ -221,8 +242,17 @@ function chatReducer(state: ChatState, action: ChatAction) {
                     : room,
             );
 
-            const updatedMessages =
-                currentRoom?.id === message.room ? [...messages, message] : messages;
+            let updatedMessages = messages;
+            if (currentRoom?.id === message.room) {
+                // The stored message replaces its optimistic copy, if this client sent it
+                const pendingIdx = clientId
+                    ? messages.findIndex((pending) => pending.pending && pending.client_id === clientId)
+                    : -1;
+                updatedMessages =
+                    pendingIdx === -1
+                        ? [...messages, message]
+                        : messages.map((pending, idx) => (idx === pendingIdx ? message : pending));
+            }
 
             return {
                 ...state,
@@ -230,6 +260,21 @@ function chatReducer(state: ChatState, action: ChatAction) {
                 messages: updatedMessages,
             };
         }
+        case ChatActionType.AddPendingMessage:
+            if (state.currentRoom?.id !== action.payload.room) {
+                return state;
+            }
+            return {
+                ...state,
+                messages: [...state.messages, action.payload],
+            };
+        case ChatActionType.RemovePendingMessage:
+            return {
+                ...state,
+                messages: state.messages.filter(
+                    (message) => !(message.pending && message.client_id === action.payload.clientId),
+                ),
+            };
         case ChatActionType.ResetUnreadCount:
             return {
                 ...state,
@@ -351,23 +396,28 @@ function chatReducer(state: ChatState, action: ChatAction) {
                 messages: updatedMessages,
             };
         case ChatActionType.SetTypingStatus: {
-            const { roomId, user, isTyping } = action.payload;
-            const currentTypingUsers = state.typingUsers[roomId] || [];
-            let newTypingUsers;
-
-            if (isTyping) {
-                newTypingUsers = currentTypingUsers.includes(user)
-                    ? currentTypingUsers
-                    : [...currentTypingUsers, user];
-            } else {
-                newTypingUsers = currentTypingUsers.filter((u) => u !== user);
-            }
+            const { roomId, users } = action.payload;
 
             return {
                 ...state,
                 typingUsers: {
                     ...state.typingUsers,
-                    [roomId]: newTypingUsers,
+                    [roomId]: users.filter((user) => user !== state.user?.username),
+                },
+            };
+        }
+        case ChatActionType.UpdatePresence: {
+            const { roomId, online, offline } = action.payload;
+            const changed = new Set([...online, ...offline]);
+
+            return {
+                ...state,
+                onlineUsers: {
+                    ...state.onlineUsers,
+                    [roomId]: [
+                        ...(state.onlineUsers[roomId] || []).filter((userId) => !changed.has(userId)),
+                        ...online,
+                    ],
                 },
             };
         }
@@ -404,6 +454,21 @@ function chatReducer(state: ChatState, action: ChatAction) {
                         }
                         : state.currentRoom,
             };
+        case ChatActionType.UpdateAvatar: {
+            const { avatarImg, roomId, userId } = action.payload;
+            const updateRoomAvatar = (room: ChatRoom) =>
+                room.id === roomId ? { ...room, avatar_img: avatarImg } : room;
+
+            return {
+                ...state,
+                user:
+                    state.user && state.user.id === userId
+                        ? { ...state.user, profile: { ...state.user.profile, avatar_img: avatarImg } }
+                        : state.user,
+                rooms: state.rooms.map(updateRoomAvatar),
+                currentRoom: state.currentRoom && updateRoomAvatar(state.currentRoom),
+            };
+        }
         default:
             //@ts-ignore
             throw new Error(`Unhandled action type: ${action.type}`);
@@ -424,6 +489,7 @@ export const ChatApp = () => {
         nextMessagesUrl,
         messagesLoading,
         typingUsers,
+        onlineUsers,
     } = state;
 
     const [replyingTo, setReplyingTo] = useState<Message | null>(null);
@@ -470,7 +536,14 @@ export const ChatApp = () => {
         const handleMessageEvents = (event: WebSocketEvent) => {
             switch (event.type) {
                 case "send_message":
-                    dispatch({ type: ChatActionType.SendMessage, payload: event.message });
+                    dispatch({
+                        type: ChatActionType.SendMessage,
+                        payload: { message: event.message, clientId: event.client_id },
+                    });
+                    break;
+                case "error":
+                    // The rejected messages are reported to `handleSendMessage` by `sendMessage`
+                    console.error(`WebSocket ${event.event} failed: `, event.detail);
                     break;
                 case "edit_message":
                     dispatch({ type: ChatActionType.EditMessage, payload: event.message });
@@ -497,14 +570,16 @@ export const ChatApp = () => {
                         payload: { message: event.message, reactionId: event.reaction_id },
                     });
                     break;
-                case "typing_status":
+                case "typing":
                     dispatch({
                         type: ChatActionType.SetTypingStatus,
-                        payload: {
-                            roomId: event.room,
-                            user: event.user,
-                            isTyping: event.is_typing,
-                        },
+                        payload: { roomId: event.room, users: event.users },
+                    });
+                    break;
+                case "presence":
+                    dispatch({
+                        type: ChatActionType.UpdatePresence,
+                        payload: { roomId: event.room, online: event.online, offline: event.offline },
                     });
                     break;
                 case "user_left":
@@ -513,6 +588,12 @@ export const ChatApp = () => {
                         payload: { roomId: event.room_id, newOwner: event.new_owner },
                     });
                     break;
+                case "avatar_updated":
+                    dispatch({
+                        type: ChatActionType.UpdateAvatar,
+                        payload: { avatarImg: event.avatar_img, roomId: event.room, userId: event.user },
+                    });
+                    break;
                 default:
                     //@ts-ignore
                     console.error("WebSocket event not handled: ", event.type);
@@ -557,7 +638,19 @@ export const ChatApp = () => {
                     console.error("Error fetching messages: ", error);
                 }
             };
+            const fetchPresence = async () => {
+                try {
+                    const presence = await apiService.current.getRoomPresence(currentRoom.id);
+                    dispatch({
+                        type: ChatActionType.UpdatePresence,
+                        payload: { roomId: presence.room, online: presence.online, offline: presence.offline },
+                    });
+                } catch (error) {
+                    console.error("Error fetching presence: ", error);
+                }
+            };
             fetchMessages();
+            fetchPresence();
         }
     }, [currentRoom]);
 
@@ -702,8 +795,9 @@ export const ChatApp = () => {
     };
 
     const handleSendMessage = async (content: string, files: File[]) => {
-        if (!currentRoom) return;
+        if (!currentRoom || !user) return;
 
+        const clientId = crypto.randomUUID();
         try {
             const messagePayload: MessagePayload = {
                 content: content,
@@ -714,16 +808,32 @@ export const ChatApp = () => {
             if (replyingTo) {
                 messagePayload.reply_to_id = replyingTo.id;
             }
+            let uploadedMedia: Media[] = [];
             if (files.length > 0) {
-                const uploadedMedia = await Promise.all(
+                uploadedMedia = await Promise.all(
                     Array.from(files).map((file) => apiService.current.sendMedia(file)),
                 );
                 const mediaIds = uploadedMedia.map((media) => media.id);
                 messagePayload.media_ids = mediaIds;
             }
 
-            const response = await apiService.current.sendMessage(messagePayload);
-            wsService.current.sendMessage(response.data);
+            // Shown right away, and replaced by the stored message when the server broadcasts it
+            dispatch({
+                type: ChatActionType.AddPendingMessage,
+                payload: {
+                    id: nextPendingMessageId--,
+                    room: currentRoom.id,
+                    user,
+                    content,
+                    timestamp: new Date().toISOString(),
+                    reply_to: replyingTo ?? undefined,
+                    media: uploadedMedia,
+                    reactions: [],
+                    client_id: clientId,
+                    pending: true,
+                },
+            });
+            await wsService.current.sendMessage(messagePayload, clientId);
 
             if (currentRoom.unread_count > 0) {
                 currentRoom.unread_count = 0;
@@ -731,6 +841,7 @@ export const ChatApp = () => {
             }
             setReplyingTo(null);
         } catch (error) {
+            dispatch({ type: ChatActionType.RemovePendingMessage, payload: { clientId } });
             console.error("Failed to send message: ", error);
             throw error;
         }
@@ -963,6 +1074,7 @@ export const ChatApp = () => {
                         onStopTyping={handleStopTyping}
                         onLeaveRoom={handleLeaveRoom}
                         typingUsers={typingUsers[currentRoom?.id || 0] || []}
+                        onlineUsers={onlineUsers[currentRoom?.id || 0] || []}
                     />
                 </Box>
             </Box>